@@ -0,0 +1,70 @@
+"""Microbenchmark of the timestamp conversions of the feed and history paths.
+
+Compares the strptime / utcfromtimestamp + date2num conversions used before
+with capitalcom.contrib.timeconv. Run from the repository root:
+
+    python -m benchmarks.bench_timeconv
+"""
+import calendar
+from datetime import datetime
+import timeit
+
+from backtrader import date2num
+
+from capitalcom.contrib import timeconv
+
+RFC3339 = "%Y-%m-%dT%H:%M:%S"
+N = 100000
+
+start = 1707120000  # 2024-02-05T08:00:00
+stamps = [timeconv.format_rfc3339(start + 60 * i) for i in range(N)]
+millis = [(start + i) * 1000 + 123 for i in range(N)]
+
+
+def candles_strptime():
+    return [date2num(datetime.strptime(s, RFC3339)) for s in stamps]
+
+
+def candles_timeconv():
+    return [timeconv.rfc3339_to_num(s) for s in stamps]
+
+
+def candles_vectorized():
+    return timeconv.epoch_to_num_array(timeconv.parse_rfc3339_array(stamps))
+
+
+def ticks_datetime():
+    return [date2num(datetime.utcfromtimestamp(ms / 10 ** 3)) for ms in millis]
+
+
+def ticks_timeconv():
+    return [timeconv.epoch_ms_to_num(ms) for ms in millis]
+
+
+def epoch_timegm():
+    return [calendar.timegm(datetime.strptime(s, RFC3339).timetuple()) for s in stamps]
+
+
+def epoch_timeconv():
+    return [timeconv.parse_rfc3339(s) for s in stamps]
+
+
+def bench(name, baseline, *contenders):
+    base = min(timeit.repeat(baseline, number=1, repeat=3))
+    print('{:<28} {:8.1f} ms'.format(name + ' (' + baseline.__name__ + ')', base * 1000))
+    for fn in contenders:
+        t = min(timeit.repeat(fn, number=1, repeat=3))
+        print('{:<28} {:8.1f} ms  x{:.1f}'.format('  ' + fn.__name__, t * 1000, base / t))
+
+
+if __name__ == '__main__':
+    # the results must agree before the timings mean anything
+    assert max(abs(a - b) for a, b in zip(candles_strptime(), candles_timeconv())) < 1e-9
+    assert max(abs(a - b) for a, b in zip(candles_strptime(), candles_vectorized())) < 1e-9
+    assert max(abs(a - b) for a, b in zip(ticks_datetime(), ticks_timeconv())) < 1e-9
+    assert epoch_timegm() == epoch_timeconv()
+
+    print('{} conversions'.format(N))
+    bench('candles', candles_strptime, candles_timeconv, candles_vectorized)
+    bench('ticks', ticks_datetime, ticks_timeconv)
+    bench('epoch', epoch_timegm, epoch_timeconv)
@@ -1,4 +1,4 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
-from .capitalcomfeed import CapitalcomData
+from .capitalcomfeed import CapitalcomData, CapitalcomBidAskData
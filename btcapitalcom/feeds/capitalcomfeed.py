@@ -22,14 +22,21 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+import array
+import collections
 from datetime import datetime, timedelta
+import time as _time
 
 from backtrader.feed import DataBase
-from backtrader import TimeFrame, date2num, num2date
+from backtrader import TimeFrame, num2date
 from backtrader.utils.py3 import (integer_types, queue, string_types,
                                   with_metaclass)
 from backtrader.metabase import MetaParams
+import numpy as np
 from btcapitalcom.stores import capitalcomstore
+from capitalcom.contrib.columnar import CandleBatch
+from capitalcom.contrib.generic import granularity_to_time
+from capitalcom.contrib.timeconv import epoch_ms_to_num, epoch_to_num, format_rfc3339
 
 
 class MetaCapitalcomData(DataBase.__class__):
@@ -38,8 +45,10 @@ class MetaCapitalcomData(DataBase.__class__):
         # Initialize the class
         super(MetaCapitalcomData, cls).__init__(name, bases, dct)
 
-        # Register with the store
-        capitalcomstore.CapitalcomStore.DataCls = cls
+        # Register with the store, subclasses (e.g. CapitalcomBidAskData)
+        # must not replace the default data of getdata
+        if capitalcomstore.CapitalcomStore.DataCls is None:
+            capitalcomstore.CapitalcomStore.DataCls = cls
 
 class CapitalcomData(with_metaclass(MetaCapitalcomData, DataBase)):
     '''Capitalcom Data Feed.
@@ -64,10 +73,17 @@ class CapitalcomData(with_metaclass(MetaCapitalcomData, DataBase)):
 
         Perform backfilling at the start. fromdate will be used.
 
+        The live stream is subscribed at the same time. Its quotes are kept
+        in the live queue (up to ``qmaxsize``) while the history is loaded.
+        The candle still in progress is not backfilled, the live data within
+        the backfilled candles is skipped.
+
       - ``backfill`` (default: ``True``)
 
-        Perform backfilling after a disconnection/reconnection cycle. The gap
-        duration will be used to download the smallest possible amount of data
+        Perform backfilling after a disconnection/reconnection cycle. Only
+        the gap from the last tick to the first quote after the reconnection
+        is downloaded, as minute candles (or the feed's own bars with
+        ``livebars``)
 
       - ``backfill_from`` (default: ``None``)
 
@@ -103,6 +119,36 @@ class CapitalcomData(with_metaclass(MetaCapitalcomData, DataBase)):
 
         Time in seconds to wait in between reconnection attemps
 
+      - ``livebars`` (default: ``False``)
+
+        If ``True`` live quotes are aggregated into bars of the ``timeframe``
+        and ``compression`` of the data, with the number of ticks as volume.
+        Bars are completed on time even if no quote arrives. Datas of the
+        same epic share the aggregation. If ``False`` every quote is
+        delivered as a bar with open = high = low = close
+
+      - ``price`` (default: ``None``)
+
+        Prices of the history, the live ticks and the live bars: ``bid``,
+        ``ask`` or ``mid``. ``None`` uses ``ask`` if ``useask`` is set and
+        ``bid`` otherwise
+
+      - ``conflate`` (default: ``all``)
+
+        What to do with live quotes when the strategy falls behind: ``all``
+        delivers every quote, ``latest`` only the most recent one per epic
+        and ``snapshot`` the most recent ones every ``conflate_interval``
+        seconds
+
+      - ``qmaxsize`` (default: ``10000``)
+
+        Maximum number of live quotes waiting for the strategy, the oldest
+        ones are dropped (and a notification sent) beyond it
+
+      - ``conflate_interval`` (default: ``0.25``)
+
+        Seconds between the releases of the ``snapshot`` policy
+
     This data feed supports only this mapping of ``timeframe`` and
     ``compression``, which comply with the definitions in the CAPITALCOM API
     Developer's Guide::
@@ -131,6 +177,11 @@ class CapitalcomData(with_metaclass(MetaCapitalcomData, DataBase)):
         ('reconnect', True),
         ('reconnections', -1),  # forever
         ('reconntimeout', 5.0),
+        ('livebars', False),
+        ('price', None),
+        ('conflate', 'all'),
+        ('qmaxsize', 10000),
+        ('conflate_interval', 0.25),
     )
 
     _store = capitalcomstore.CapitalcomStore
@@ -144,14 +195,21 @@ class CapitalcomData(with_metaclass(MetaCapitalcomData, DataBase)):
         # Effective way to overcome the non-notification?
         return self._TOFFSET
 
+    @property
+    def lastTickdt(self):
+        '''datetime (UTC) of the last live tick / bar'''
+        if self.lastTick is None:
+            return None
+        return datetime.utcfromtimestamp(self.lastTick)
+
     def islive(self):
         '''Returns ``True`` to notify ``Cerebro`` that preloading and runonce
-        should be deactivated'''
-        return True
+        should be deactivated. Purely historical datas can be preloaded'''
+        return not self.p.historical
 
     def __init__(self, **kwargs):
         self.o = self._store(**kwargs)
-        self.lastTickdt = None
+        self.lastTick = None  # epoch seconds of the last live tick / bar
         self.notifDelayedSent = False
         self.leverage = kwargs.get('leverage', 1)
 
@@ -170,6 +228,10 @@ class CapitalcomData(with_metaclass(MetaCapitalcomData, DataBase)):
         self._statelivereconn = False  # if reconnecting in live state
         self._storedmsg = dict()  # keep pending live message (under None)
         self.qlive = queue.Queue()
+        self._histrows = collections.deque()  # rows of the current CandleBatch
+        self._gapfrom = None  # epoch seconds a reconnection gap starts at
+        self._histlen = None  # seconds of the candles of a backfill (None: historical)
+        self._histend = None  # epoch seconds the backfilled candles end at
         self._state = self._ST_OVER
         self.RFC3339 = "%Y-%m-%dT%H:%M:%S"
 
@@ -219,6 +281,12 @@ class CapitalcomData(with_metaclass(MetaCapitalcomData, DataBase)):
             self._state = self._ST_HISTORBACK
             return True
 
+        if instart:
+            # subscribe before requesting the backfill: the quotes wait in the
+            # bounded live queue (qmaxsize) while the history is loaded and
+            # those already covered by it are skipped at the handoff
+            self.qlive = self._streaming_prices(tmout=tmout)
+
         if (self.p.backfill_start and instart) or (not instart and self.p.backfill):
             if not self.notifDelayedSent:
                 self.put_notification(self.DELAYED)
@@ -228,19 +296,18 @@ class CapitalcomData(with_metaclass(MetaCapitalcomData, DataBase)):
             if self.fromdate > float('-inf') and self.p.backfill_start and instart:
                 dtbegin = datetime.strftime(num2date(self.fromdate), self.RFC3339)
             elif not instart and self.p.backfill:
-                dtbegin = datetime.strftime(self.lastTickdt, self.RFC3339)
+                dtbegin = format_rfc3339(self.lastTick)
 
             self.qhist = self.o.candles(
                 self.p.dataname, dtbegin, dtend,
                 self._timeframe, self._compression)
+            self._histlen = self._hist_seconds(self._timeframe, self._compression)
             if self.qhist != None:
                 self._state = self._ST_HISTORBACK
             else:
                 self.qlive.put(None)
                 return False
 
-        if self._state != self._ST_HISTORBACK and instart:
-            self.qlive = self.o.streaming_prices(self.p.dataname, tmout=tmout)
         if instart:
             self._statelivereconn = self.p.backfill_start
         else:
@@ -256,9 +323,66 @@ class CapitalcomData(with_metaclass(MetaCapitalcomData, DataBase)):
 
         return True  # no return before - implicit continue
 
+    def _st_reconnect(self, tmout=None):
+        '''Registers with the stream of the store again after a break, the
+        store reopens the socket (after ``tmout``) and renews the session
+        if needed. The gap since the last tick is backfilled once the first
+        quote comes in, i.e. when the connection is back'''
+        self.qlive = self._streaming_prices(tmout=tmout)
+        if self.p.backfill and self.lastTick is not None and self._gapfrom is None:
+            self._gapfrom = self.lastTick
+
+        self._state = self._ST_LIVE
+        self._statelivereconn = True
+
+    def _st_backfill_gap(self, msg):
+        '''Requests the candles from the last tick up to now and keeps
+        ``msg`` to be loaded after them. Returns False if the store cannot
+        download yet (session not restored), the gap is then kept'''
+        timeframe, compression = self._gap_timeframe()
+        qhist = self.o.candles(
+            self.p.dataname, format_rfc3339(self._gapfrom), format_rfc3339(_time.time()),
+            timeframe, compression)
+        if qhist is None:
+            return False
+        self.qhist = qhist
+        self._gapfrom = None
+        self._histlen = self._hist_seconds(timeframe, compression)
+
+        self.put_notification(self.DELAYED)
+        self._storedmsg[None] = msg
+        self._state = self._ST_HISTORBACK
+        return True
+
+    def _bar_seconds(self, timeframe, compression):
+        return granularity_to_time(self.o.get_granularity(timeframe, compression))
+
+    def _hist_seconds(self, timeframe, compression):
+        # seconds of the downloaded candles, sub-minute candles are expanded
+        # from minute candles
+        return max(60, self._bar_seconds(timeframe, compression))
+
+    def _gap_timeframe(self):
+        '''Timeframe and compression to backfill a gap with: the feed's own
+        for live bars (sub-minute ones expanded from minute candles with
+        ``subminute_fill``), else minutes for the tick series'''
+        if self.p.livebars:
+            return self._timeframe, self._compression
+
+        return TimeFrame.Minutes, 1
+
+    def _streaming_prices(self, tmout=None):
+        if self.p.livebars:
+            seconds = self._bar_seconds(self._timeframe, self._compression)
+            return self.o.streaming_bars(self.p.dataname, seconds, tmout=tmout,
+                                         maxsize=self.p.qmaxsize)
+        return self.o.streaming_prices(self.p.dataname, tmout=tmout, conflate=self.p.conflate,
+                                       maxsize=self.p.qmaxsize, interval=self.p.conflate_interval)
+
     def stop(self):
         '''Stops and tells the store to stop'''
         super(CapitalcomData, self).stop()
+        self.o.stop_streaming(self.p.dataname, self.qlive)
         self.o.stop()
 
     def haslivedata(self):
@@ -274,6 +398,9 @@ class CapitalcomData(with_metaclass(MetaCapitalcomData, DataBase)):
                     msg = (self._storedmsg.pop(None, None) or
                            self.qlive.get(timeout=self._qcheck))
                 except queue.Empty:
+                    # close live bars on time when no quote arrives
+                    if self.p.livebars and self.o.flush_bars(self.p.dataname):
+                        continue
                     return None  # indicate timeout situation
 
                 if msg is None:  # Conn broken during historical/backfilling
@@ -288,21 +415,20 @@ class CapitalcomData(with_metaclass(MetaCapitalcomData, DataBase)):
                         return False  # failed
 
                     self._reconns -= 1
-                    self._st_start(instart=False, tmout=self.p.reconntimeout)
+                    self._st_reconnect(tmout=self.p.reconntimeout)
                     continue
 
-                    if not self.p.reconnect or self._reconns == 0:
-                        # Can no longer reconnect
-                        self.put_notification(self.DISCONNECTED)
-                        self._state = self._ST_OVER
-                        return False  # failed
+                self._reconns = self.p.reconnections
 
-                    # Can reconnect
-                    self._reconns -= 1
-                    self._st_start(instart=False, tmout=self.p.reconntimeout)
-                    continue
+                if self._gapfrom is not None:
+                    if self._st_backfill_gap(msg):
+                        continue  # the quote waits for the gap backfill
 
-                self._reconns = self.p.reconnections
+                    # delivered now, the quote would hide the gap: it waits
+                    # until the keepalive has restored the session
+                    self._storedmsg[None] = msg
+                    _time.sleep(self._qcheck)
+                    return None
 
                 # Process the message according to expected return type
                 #if not self._statelivereconn:
@@ -310,7 +436,10 @@ class CapitalcomData(with_metaclass(MetaCapitalcomData, DataBase)):
                     if self._laststatus != self.LIVE:
                         if self.qlive.qsize() <= 1:  # very short live queue
                             self.put_notification(self.LIVE)
-                    ret = self._load_tick(msg)
+                    if self.p.livebars:
+                        ret = self._load_bar(msg)
+                    else:
+                        ret = self._load_tick(msg)
                     if ret:
                         return True
 
@@ -321,6 +450,12 @@ class CapitalcomData(with_metaclass(MetaCapitalcomData, DataBase)):
                 self._storedmsg[None] = msg  # keep the msg
 
             elif self._state == self._ST_HISTORBACK:
+                if self._histrows:
+                    if self._load_history(self._histrows.popleft()):
+                        return True  # loading worked
+
+                    continue  # not loaded ... date may have been seen
+
                 msg = self.qhist.get()
                 if msg is None:  # Conn broken during historical/backfilling
                     # Situation not managed. Simply bail out
@@ -328,24 +463,34 @@ class CapitalcomData(with_metaclass(MetaCapitalcomData, DataBase)):
                     self._state = self._ST_OVER
                     return False  # error management cancelled the queue
 
-                if msg:
-                    if self._load_history(msg):
-                        return True  # loading worked
+                if isinstance(msg, CandleBatch):
+                    if self._histlen:
+                        # the candle in progress is left to the live data,
+                        # which skips what the complete candles cover. The
+                        # sub-minute candles of a minute share its end
+                        ends = msg.time - msg.time % 60 + self._histlen
+                        done = ends <= _time.time()
+                        msg = msg[done]
+                        if len(msg):
+                            self._histend = max(self._histend or 0.0, float(ends[done][-1]))
+                    self._histrows.extend(self._history_rows(msg))
+                    continue
 
-                    continue  # not loaded ... date may have been seen
+                if isinstance(msg, Exception):
+                    self.o.put_notification("Error loading historical data: " + str(msg))
+                    continue
+
+                if msg:
+                    continue  # unknown message, ignore it
                 else:
                     # End of histdata
                     if self.p.historical:  # only historical
                         self.put_notification(self.DISCONNECTED)
                         self._state = self._ST_OVER
                         return False  # end of historical
-                    if self.p.backfill_start:
-                        #start backfill completed
-                        self.qlive = self.o.streaming_prices(self.p.dataname, tmout=None)
-                        self._state = self._ST_LIVE
-                        self.notifDelayedSent = False
+                    self.notifDelayedSent = False
 
-                # Live is also wished - go for it
+                # Live is also wished - go for it, the stream is already open
                 self._state = self._ST_LIVE
                 continue
 
@@ -369,11 +514,16 @@ class CapitalcomData(with_metaclass(MetaCapitalcomData, DataBase)):
                     self._state = self._ST_OVER
                     return False
 
+    def _price(self):
+        '''The price of the standard lines: bid, ask or mid'''
+        return self.p.price or ('ask' if self.p.useask else 'bid')
+
     def _load_tick(self, msg):
-        self.lastTickdt = datetime.utcfromtimestamp(int(msg['timestamp']) / 10 ** 3)
-        dt = date2num(self.lastTickdt)
-        if dt <= self.lines.datetime[-1]:
-            return False  # time already seen
+        ms = int(msg['timestamp'])
+        self.lastTick = ms / 1000.0
+        dt = epoch_ms_to_num(ms)
+        if dt <= self.lines.datetime[-1] or (self._histend and self.lastTick < self._histend):
+            return False  # time already seen, or in a backfilled candle
 
         # Common fields
         self.lines.datetime[0] = dt
@@ -381,7 +531,11 @@ class CapitalcomData(with_metaclass(MetaCapitalcomData, DataBase)):
         self.lines.openinterest[0] = 0.0
 
         # Put the prices into the bar
-        tick = float(msg['ofr']) if self.p.useask else float(msg['bid'])
+        price = self._price()
+        if price == 'mid':
+            tick = (float(msg['bid']) + float(msg['ofr'])) / 2.0
+        else:
+            tick = float(msg['ofr']) if price == 'ask' else float(msg['bid'])
         self.lines.open[0] = tick
         self.lines.high[0] = tick
         self.lines.low[0] = tick
@@ -391,27 +545,130 @@ class CapitalcomData(with_metaclass(MetaCapitalcomData, DataBase)):
 
         return True
 
-    def _load_history(self, msg):
-        dtobj = datetime.strptime(msg['snapshotTimeUTC'], self.RFC3339)
-        dt = date2num(dtobj)
-        if dt <= self.lines.datetime[-1]:
-            return False  # time already seen
+    def _load_bar(self, bar):
+        self.lastTick = bar['start']
+        dt = epoch_to_num(bar['start'])
+        if dt <= self.lines.datetime[-1] or (self._histend and bar['start'] < self._histend):
+            return False  # time already seen, or in a backfilled candle
 
-        # Common fields
+        o, h, l, c = bar[self._price()]
         self.lines.datetime[0] = dt
-        self.lines.volume[0] = float(msg['lastTradedVolume'])
+        self.lines.open[0] = o
+        self.lines.high[0] = h
+        self.lines.low[0] = l
+        self.lines.close[0] = c
+        self.lines.volume[0] = bar['ticks']
         self.lines.openinterest[0] = 0.0
 
-        # Put the prices into the bar
-        if not self.p.useask:
-            self.lines.open[0] = float(msg['openPrice']['bid'])
-            self.lines.high[0] = float(msg['highPrice']['bid'])
-            self.lines.low[0] = float(msg['lowPrice']['bid'])
-            self.lines.close[0] = float(msg['closePrice']['bid'])
-        else:
-            self.lines.open[0] = float(msg['openPrice']['ask'])
-            self.lines.high[0] = float(msg['highPrice']['ask'])
-            self.lines.low[0] = float(msg['lowPrice']['ask'])
-            self.lines.close[0] = float(msg['closePrice']['ask'])
+        return True
+
+    # lines filled from the history, in the order of _history_columns
+    _HISTLINES = ('datetime', 'open', 'high', 'low', 'close', 'volume', 'openinterest')
+
+    def _history_columns(self, batch):
+        '''Returns the values of the ``_HISTLINES`` for a CandleBatch, as
+        arrays'''
+        prices = batch.prices(self._price())
+        return [batch.num(), prices[:, 0], prices[:, 1], prices[:, 2], prices[:, 3],
+                batch.volume, np.zeros(len(batch))]
+
+    def _history_rows(self, batch):
+        '''Converts a CandleBatch into rows of ``_HISTLINES`` values in a
+        few vectorized operations'''
+        return zip(*[column.tolist() for column in self._history_columns(batch)])
+
+    def _load_history(self, row):
+        if row[0] <= self.lines.datetime[-1]:
+            return False  # time already seen
+
+        for alias, value in zip(self._HISTLINES, row):
+            getattr(self.lines, alias)[0] = value
+
+        return True
+
+    def preload(self):
+        '''Historical mode: loads the complete download into the line
+        buffers in one go instead of bar by bar. Falls back to the standard
+        preload if filters or an input timezone have to be applied'''
+        if (self._state != self._ST_HISTORBACK or self._filters or self._ffilters or
+                self._tzinput or self._barstack or self._barstash):
+            return super(CapitalcomData, self).preload()
+
+        batches = []
+        while True:
+            msg = self.qhist.get()
+            if isinstance(msg, CandleBatch):
+                batches.append(msg)
+            elif isinstance(msg, Exception):
+                self.o.put_notification("Error loading historical data: " + str(msg))
+            elif msg is None or not msg:
+                break  # disconnected or end of transmission
+
+        self.put_notification(self.DISCONNECTED)
+        self._state = self._ST_OVER
+
+        if batches:
+            columns = self._history_columns(CandleBatch.concat(batches))
+            dt = columns[0]
+            # same checks as load(): increasing times within fromdate / todate
+            seen = np.maximum.accumulate(np.concatenate(([-np.inf], dt[:-1])))
+            keep = (dt > seen) & (dt >= self.fromdate) & (dt <= self.todate)
+            n = int(keep.sum())
+            for alias, column in zip(self._HISTLINES, columns):
+                line = getattr(self.lines, alias)
+                line.forward(size=n)
+                line.array[len(line.array) - n:] = array.array(str('d'), column[keep].tolist())
+
+        self._last()
+        self.home()
+
+
+class CapitalcomBidAskData(CapitalcomData):
+    '''Capitalcom Data Feed with the bid and the ask prices.
+
+    On top of the standard lines (filled as in ``CapitalcomData``, following
+    ``useask`` / ``price``) it has the lines:
+
+      - ``bid_open``, ``bid_high``, ``bid_low``, ``bid_close``
+      - ``ask_open``, ``ask_high``, ``ask_low``, ``ask_close``
+      - ``spread``: ask close - bid close
+      - ``mid``: (ask close + bid close) / 2
+
+    all filled from the same history candle, live quote or live bar, so that
+    a spread aware strategy needs a single data (one download, one
+    subscription).
+    '''
+    lines = ('bid_open', 'bid_high', 'bid_low', 'bid_close',
+             'ask_open', 'ask_high', 'ask_low', 'ask_close',
+             'spread', 'mid',)
+
+    _HISTLINES = CapitalcomData._HISTLINES + lines
+
+    def _history_columns(self, batch):
+        bid, ask = batch.bid, batch.ask
+        columns = super(CapitalcomBidAskData, self)._history_columns(batch)
+        columns += [bid[:, i] for i in range(4)] + [ask[:, i] for i in range(4)]
+        columns += [ask[:, 3] - bid[:, 3], (ask[:, 3] + bid[:, 3]) / 2.0]
+        return columns
+
+    def _load_bidask(self, bid, ask):
+        l = self.lines
+        l.bid_open[0], l.bid_high[0], l.bid_low[0], l.bid_close[0] = bid
+        l.ask_open[0], l.ask_high[0], l.ask_low[0], l.ask_close[0] = ask
+        l.spread[0] = ask[3] - bid[3]
+        l.mid[0] = (ask[3] + bid[3]) / 2.0
+
+    def _load_tick(self, msg):
+        if not super(CapitalcomBidAskData, self)._load_tick(msg):
+            return False
+
+        bid, ask = float(msg['bid']), float(msg['ofr'])
+        self._load_bidask((bid, bid, bid, bid), (ask, ask, ask, ask))
+        return True
+
+    def _load_bar(self, bar):
+        if not super(CapitalcomBidAskData, self)._load_bar(bar):
+            return False
 
+        self._load_bidask(bar['bid'], bar['ask'])
         return True
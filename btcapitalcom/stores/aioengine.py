@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+###############################################################################
+#
+# 2023: Jelle Bloemsma, backtrader store functionality for Capital.com
+# based on https://github.com/mementum/backtrader
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import asyncio
+import threading
+
+import capitalcom
+
+from btcapitalcom.stores.dispatch import OrderDispatcher
+
+
+class _Job(object):
+    __slots__ = ('fn', 'interval', 'name', 'future', 'wakeup', 'woken')
+
+    def __init__(self, fn, interval, name):
+        self.fn = fn
+        self.interval = interval
+        self.name = name
+        self.future = None  # concurrent.futures.Future of the job task
+        self.wakeup = None  # asyncio.Event, created on the loop
+        self.woken = False  # woken before the task created wakeup
+
+
+class AsyncEngine(object):
+    '''Runs the background work of a store as tasks of a single event loop
+    (on its own thread).
+
+    REST requests are made with a ``capitalcom.AsyncClient`` using the
+    session tokens of the synchronous client of the store, which keeps
+    renewing them. Every request times out after ``timeout`` seconds, the
+    tasks themselves are not cancelled: a task that has sent an order
+    always gets to handle its outcome.
+
+    It offers the interface of the Scheduler (``every``, ``wake``,
+    ``cancel``, ``stop``, ``jobs``). Jobs may be coroutine functions, plain
+    functions are run in the default executor of the loop (one run at a
+    time, as with the Scheduler). ``submit`` runs any coroutine on the loop
+    from another thread.
+    '''
+
+    def __init__(self, store, timeout=30.0, pool_maxsize=10, name='capitalcom-engine'):
+        if capitalcom.AsyncClient is None:
+            raise ValueError("engine 'asyncio' requires aiohttp")
+
+        self.store = store
+        self.timeout = timeout
+        self.notify = store.put_notification
+        self._jobs = []
+        self._stopped = False
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._t_loop, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+        CAPI = store.CAPI
+        self.client = capitalcom.AsyncClient(CAPI.login, CAPI.password, CAPI.api_key,
+                                             CAPI.environment, pool_maxsize=pool_maxsize,
+                                             timeout=timeout)
+        # the aiohttp session must be created on the loop
+        self.submit(self._open()).result()
+
+    def _t_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+        self.loop.close()
+
+    async def _open(self):
+        import aiohttp  # available, AsyncClient exists
+        self.client.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.client.pool_maxsize),
+            timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    def _sync_session(self):
+        CAPI = self.store.CAPI
+        self.client.cst = CAPI.cst
+        self.client.x_security_token = CAPI.x_security_token
+
+    def submit(self, coro):
+        '''Schedules ``coro`` on the loop, returns a concurrent Future'''
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def call(self, coro):
+        '''Awaits ``coro`` (on the loop) with the current session tokens'''
+        self._sync_session()
+        return await coro
+
+    async def confirm(self, deal_reference):
+        self._sync_session()
+        return await capitalcom.confirm_async(self.client, deal_reference,
+                                              timeout=self.store.p.confirm_timeout)
+
+    # Scheduler interface
+    def every(self, interval, fn, name=None, delay=0.0):
+        job = _Job(fn, interval, name or getattr(fn, '__name__', 'job'))
+        if not self._stopped:
+            job.future = self.submit(self._t_job(job, delay))
+            self._jobs.append(job)
+        return job
+
+    def wake(self, job):
+        if job is not None and not self._stopped:
+            self.loop.call_soon_threadsafe(self._wake, job)
+
+    @staticmethod
+    def _wake(job):
+        # on the loop
+        if job.wakeup is None:
+            job.woken = True  # the task sets it once it has created wakeup
+        else:
+            job.wakeup.set()
+
+    def cancel(self, job):
+        if job is not None and job.future is not None:
+            job.future.cancel()
+
+    def jobs(self):
+        return [job.name for job in self._jobs if not job.future.done()]
+
+    async def _t_job(self, job, delay):
+        job.wakeup = asyncio.Event()
+        if job.woken:
+            job.wakeup.set()
+        while True:
+            try:
+                await asyncio.wait_for(job.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            job.wakeup.clear()
+
+            try:
+                if asyncio.iscoroutinefunction(job.fn):
+                    delay = await self.call(job.fn())
+                else:
+                    # not timed out here: a run that is not over must not
+                    # overlap the next one (the sync client has a timeout)
+                    delay = await self.loop.run_in_executor(None, job.fn)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.notify(e)  # a failing run does not stop the job
+                delay = None
+
+            if delay is None:
+                delay = job.interval
+
+    def stop(self):
+        '''Cancels all the tasks, closes the http session and ends the loop'''
+        if self._stopped:
+            return
+        self._stopped = True
+        try:
+            self.submit(self._shutdown()).result(self.timeout)
+        except Exception as e:
+            self.notify(e)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def _shutdown(self):
+        current = asyncio.current_task()
+        tasks = [t for t in asyncio.all_tasks() if t is not current]
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.client.close()
+
+
+class AsyncDispatcher(OrderDispatcher):
+    '''OrderDispatcher running the jobs (coroutine functions) as tasks of an
+    AsyncEngine. Jobs of the same ``key`` run one at a time in submission
+    order, up to ``workers`` jobs run at the same time'''
+
+    def __init__(self, engine, workers=4, notify=None, history=1000):
+        super(AsyncDispatcher, self).__init__(workers=0, notify=notify, history=history)
+        self.engine = engine
+        self._workers = workers
+        self._slots = None  # asyncio.Semaphore, created on the loop
+        self._keylocks = dict()  # key -> asyncio.Lock
+
+    def submit(self, key, oref, fn, *args):
+        with self._lock:
+            self._track(oref, key)
+        # run_coroutine_threadsafe keeps the submission order, and so do
+        # the (FIFO) waiters of the lock of the key
+        self.engine.submit(self._run(key, fn, args))
+
+    async def _run(self, key, fn, args):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self._workers)
+        lock = self._keylocks.get(key)
+        if lock is None:
+            lock = self._keylocks[key] = asyncio.Lock()
+
+        async with lock:
+            async with self._slots:
+                try:
+                    await self.engine.call(fn(*args))
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    # a failing job must not block the lane
+                    self.notify(e)
+
+    def stop(self):
+        pass  # the tasks end with the loop of the engine
@@ -22,78 +22,178 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+import asyncio
 import collections
-import copy
-from datetime import datetime, timedelta, time
+from datetime import datetime
 import time as _time
+import itertools
 import json
 import threading
 
 import capitalcom.client
-from capitalcom.contrib.factories import EpicCandlesFactory
+from capitalcom.contrib.candlecache import CandleCache
+from capitalcom.contrib.columnar import CandleBatch, expand_subminute
+from capitalcom.contrib.tickrecorder import TickRecorder
+from capitalcom.contrib.factories import (ParallelEpicCandlesFactory, CachedEpicCandlesFactory,
+                                          AsyncEpicCandlesFactory)
+from capitalcom.contrib.factories.history import MAX_BATCH
+from btcapitalcom.stores.aioengine import AsyncDispatcher, AsyncEngine
+from btcapitalcom.stores.dispatch import OrderDispatcher
+from btcapitalcom.stores.orderbook import OrderBook, OrderBookError, OrderState
+from btcapitalcom.stores.quotequeue import QuoteQueue
+from btcapitalcom.stores.scheduler import MarketHours, Scheduler
+from btcapitalcom.stores.tickbars import TickAggregator
 import requests  # capitalcompy depdendency
 
 import backtrader as bt
 from backtrader.metabase import MetaParams
 from backtrader.utils.py3 import queue, with_metaclass
 from backtrader.utils import AutoDict
-import pandas as pd
 
 import websocket
 
 
 class Streamer():
-    def __init__(self, STORE, q, cst, x_security_token, dataname, log_ticks):
+    '''One websocket per store, multiplexing the quotes of all epics.
+
+    Feeds register a queue for their epic with ``add`` and receive the quote
+    payloads of that epic only. All registered epics are subscribed with a
+    single ``marketData.subscribe`` when the socket opens, epics added or
+    removed later are (un)subscribed on the open socket. When the socket
+    breaks ``None`` is put on every queue and the registrations are dropped,
+    feeds register again when they reconnect, which reopens the socket.
+    '''
+    URL = 'wss://api-streaming-capital.backend-capital.com/connect'
+    RECONNECT_DELAY = 5.0
+    PING_OPEN = 300.0  # seconds between pings while quotes flow
+    PING_CLOSED = 45.0  # ... and while all markets are closed (no traffic)
+
+    def __init__(self, STORE, log_ticks=False, recorder=None):
         self.STORE = STORE
-        self.q = q
-        self.cst = cst
-        self.x_security_token = x_security_token
-        self.epics = dataname
         self.log_ticks = log_ticks
-        self.ping = {'destination': 'ping',
-                     'correlationId': 2,
-                     'cst': self.cst,
-                     'securityToken': self.x_security_token}
-        self.ping = json.dumps(self.ping)
+        self.recorder = recorder  # TickRecorder getting every quote
+        self.sinks = collections.defaultdict(list)  # epic -> queues of the feeds
+        self.ws = None
+        self.connected = False
+        self._lock = threading.Lock()
+        self._correlation = itertools.count(1)
+        self._thread = None
+        self._pinger = None
+        self._stopped = threading.Event()
+
+    def add(self, epic, q, delay=None):
+        '''Routes the quotes of ``epic`` to ``q``, connecting if needed'''
+        with self._lock:
+            new = epic not in self.sinks
+            self.sinks[epic].append(q)
+            connected = self.connected
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._t_run, args=(delay,))
+                self._thread.daemon = True
+                self._thread.start()
+
+        if new and connected:
+            self._send('marketData.subscribe', {'epics': [epic]})
+
+    def remove(self, epic, q):
+        with self._lock:
+            queues = self.sinks.get(epic, [])
+            if q in queues:
+                queues.remove(q)
+            drop = epic in self.sinks and not queues
+            if drop:
+                del self.sinks[epic]
+            connected = self.connected
+
+        if drop and connected:
+            self._send('marketData.unsubscribe', {'epics': [epic]})
 
-        try:
-            self.ws = websocket.WebSocketApp('wss://api-streaming-capital.backend-capital.com/connect',
+    def stop(self):
+        self._stopped.set()
+        self.STORE.scheduler.cancel(self._pinger)
+        if self.ws is not None:
+            self.ws.close()
+
+    def _t_run(self, delay):
+        while True:
+            if delay:
+                self._stopped.wait(delay)
+            if self._stopped.is_set():
+                with self._lock:
+                    self._thread = None
+                return
+
+            self.ws = websocket.WebSocketApp(self.URL,
                         on_message = lambda ws,msg: self._on_message(ws, msg),
                         on_error   = lambda ws,msg: self._on_error(ws, msg),
-                        on_close   = lambda ws:     self._on_close(ws),
+                        on_close   = lambda ws, *args: self._on_close(ws),
                         on_open    = lambda ws:     self._on_open(ws))
-            self.ws.run_forever()
-            #self.ws.run_forever(ping_interval=50, ping_timeout=10)
+            try:
+                self.ws.run_forever()
+            except Exception as e:
+                self.STORE.put_notification(e)
+                self._broken()
+
+            # feeds registering again after the break get a new connection;
+            # the decision to end and the reset of _thread are one step, so
+            # that an add() in between starts a new thread
+            with self._lock:
+                self.connected = False
+                if not self.sinks or self._stopped.is_set():
+                    self._thread = None
+                    return
+            delay = self.RECONNECT_DELAY
+
+    def _send(self, destination, payload=None):
+        # tokens are taken from the client, a reconnect may have renewed them
+        msg = {'destination': destination,
+               'correlationId': str(next(self._correlation)),
+               'cst': self.STORE.CAPI.cst,
+               'securityToken': self.STORE.CAPI.x_security_token}
+        if payload is not None:
+            msg['payload'] = payload
+        try:
+            self.ws.send(json.dumps(msg))
         except Exception as e:
-            self.put_notification(e)
-            self.STORE.lost_connection = True
-            return None
-
+            print('Websocket - send failed: ' + str(e))
 
     def ping_webservice(self):
-        while True:
-            #ping more often (<1 min) when capital.com doesn't provide quotes which will kill the websocket.
-            if time(20,45) < datetime.utcnow().time() < time(22,1):
-                self.ws.send(self.ping)
-                _time.sleep(45)
-            else:
-                self.ws.send(self.ping)
-                _time.sleep(300)
+        '''Scheduled job: pings the websocket, returns the seconds until the
+        next ping'''
+        if self.connected:
+            self._send('ping')
+        return self.ping_interval()
+
+    def ping_interval(self):
+        '''Capital.com closes a websocket without traffic. Ping every
+        PING_OPEN seconds while one of the subscribed markets is open (and
+        quotes come in), else every PING_CLOSED seconds'''
+        now = _time.time()
+        hours = [h for h in (self.STORE.get_market_hours(epic) for epic in list(self.sinks))
+                 if h is not None]
+        closing = [h.next_change(now) for h in hours if h.is_open(now)]
+        if not closing:
+            return self.PING_CLOSED  # all closed, or the hours are unknown
+
+        # ping often again as soon as the last open market closes
+        return max(1.0, min(self.PING_OPEN, max(closing)))
 
     def _on_message(self, ws, message):
             msg = json.loads(message)
             if msg['status'] == 'OK':
                 if msg['destination'] == 'quote':
-                    self.q.put(msg['payload'])
+                    payload = msg['payload']
+                    if self.recorder is not None:
+                        self.recorder.record(payload)
+                    for q in self.sinks.get(payload['epic'], ()):
+                        q.put(payload)
+                    self.STORE.on_quote(payload)
                     if self.log_ticks:
                         print(msg)
                 elif msg['destination'] == 'marketData.subscribe':
                     print("Subscribed to: " + str(msg['payload']['subscriptions']))
-                    # start pinging the capital.com webservice
-                    x = threading.Thread(target=self.ping_webservice, args=())
-                    x.daemon = True
-                    x.start()
-
+                elif msg['destination'] == 'marketData.unsubscribe':
+                    print("Unsubscribed from: " + str(msg['payload']['subscriptions']))
                 elif msg['destination'] == 'ping':
                     print("Broker webservice ping result: " + str(msg))
                 else:
@@ -103,23 +203,34 @@ class Streamer():
 
     def _on_error(self, ws, message):
             print('Websocket - ERROR: ' + str(message))
-            self.q.put(None)
+            self._broken()
             self.STORE.lost_connection = True
+            self.STORE.scheduler.wake(self.STORE._keepalive)  # renew the session now
+
+    def _broken(self):
+        with self._lock:
+            self.connected = False
+            sinks, self.sinks = self.sinks, collections.defaultdict(list)
+        for queues in sinks.values():
+            for q in queues:
+                q.put(None)
 
     def _on_open(self, ws):
-            subscribe = {}
-            payload = {}
-            payload['epics'] = [self.epics]
-            subscribe['destination'] = 'marketData.subscribe'
-            subscribe['correlationId'] = '1'
-            subscribe['cst'] = self.cst
-            subscribe['securityToken'] = self.x_security_token
-            subscribe['payload'] = payload
-            subscribe = json.dumps(subscribe)
-            self.ws.send(subscribe)
+            with self._lock:
+                self.connected = True
+                epics = list(self.sinks)
+            if epics:
+                self._send('marketData.subscribe', {'epics': epics})
+
+            # start pinging the capital.com webservice
+            if self._pinger is None:
+                self._pinger = self.STORE.scheduler.every(
+                    self.PING_CLOSED, self.ping_webservice, name='websocket-ping')
 
     def _on_close(self, ws):
          print('Websocket closed')
+         if not self._stopped.is_set():
+             self._broken()
 
 class MetaSingleton(MetaParams):
     '''Metaclass to make a metaclassed class a singleton'''
@@ -152,6 +263,66 @@ class CapitalcomStore(with_metaclass(MetaSingleton, object)):
 
       - ``account_tmout`` (default: ``10.0``): refresh period for account
         value/cash refresh
+
+      - ``pool_maxsize`` (default: ``10``): number of persistent (keep-alive)
+        connections to Capital.com shared by the store threads
+
+      - ``metadata_cache`` (default: ``True``): cache the market details and
+        navigation, and the account preferences, for the TTLs of
+        ``capitalcom.Client.CACHE_TTL``
+
+      - ``cache_path`` (default: ``None``): json file to persist the metadata
+        cache to, so that a restart doesn't request them again
+
+      - ``session_cache`` (default: ``None``): json file to keep the session
+        tokens in. A restart or reconnect validates the stored tokens with a
+        single ping instead of logging in again
+
+      - ``history_workers`` (default: ``4``): number of concurrent requests
+        used to download history (backfilling)
+
+      - ``candle_cache`` (default: ``None``): SQLite file keeping downloaded
+        candles. History is read from it and only the missing ranges are
+        requested from Capital.com
+
+      - ``order_workers`` (default: ``4``): number of orders sent to
+        Capital.com concurrently. Orders of the same epic are always sent one
+        after the other, in the order they were created
+
+      - ``confirm_timeout`` (default: ``10.0``): seconds to wait for the
+        confirmation of a deal. The confirms endpoint is polled after 20ms,
+        50ms, 100ms ... until it is confirmed or the time is up
+
+      - ``monitor_min`` (default: ``2.0``): seconds between checks of the
+        working orders and monitored positions right after a change or a
+        quote crossing one of their levels. Quotes crossing a level trigger
+        a check at most once per ``monitor_min``
+
+      - ``monitor_max`` (default: ``30.0``): the interval between checks
+        doubles up to this value while nothing changes
+
+      - ``subminute_fill`` (default: ``flat``): how SECONDS_5/15/30 history is
+        synthesized from MINUTE candles: ``flat`` repeats the minute candle,
+        ``interpolate`` moves the price from its open to its close (see
+        ``capitalcom.contrib.columnar.expand_subminute``)
+
+      - ``engine`` (default: ``threads``): ``asyncio`` runs the order jobs,
+        deal confirmations, account refreshes, order monitor polls, history
+        downloads (without ``candle_cache``) and the scheduled jobs as tasks
+        of a single background event loop (requires aiohttp). The live
+        quotes keep their websocket thread
+
+      - ``request_timeout`` (default: ``30.0``): seconds a REST request may
+        take. A hung request then fails instead of holding back the
+        scheduled jobs (keepalives, websocket pings, account refreshes and
+        order monitor polls share one thread)
+
+      - ``tick_recorder`` (default: ``None``): directory to record every
+        live quote to (see ``capitalcom.contrib.tickrecorder``), read them
+        back with ``capitalcom.contrib.tickrecorder.read_ticks``
+
+      - ``tick_segment`` (default: ``hour``): ``hour`` or ``day``, the
+        period of a tick recorder segment file
     '''
 
     BrokerCls = None  # broker class will autoregister
@@ -166,7 +337,22 @@ class CapitalcomStore(with_metaclass(MetaSingleton, object)):
         notif_transactions=True,
         stream_timeout=10,
         account_tmout=10.0,
-        log_ticks=False
+        log_ticks=False,
+        pool_maxsize=10,
+        metadata_cache=True,
+        cache_path=None,
+        session_cache=None,
+        history_workers=4,
+        candle_cache=None,
+        subminute_fill='flat',
+        order_workers=4,
+        confirm_timeout=10.0,
+        monitor_min=2.0,
+        monitor_max=30.0,
+        engine='threads',
+        request_timeout=30.0,
+        tick_recorder=None,
+        tick_segment='hour',
     )
 
     @classmethod
@@ -192,8 +378,13 @@ class CapitalcomStore(with_metaclass(MetaSingleton, object)):
         self._ordersrev = collections.OrderedDict()  # map oid to order.ref
         self._transpend = collections.defaultdict(collections.deque)
 
-        self.CAPI = capitalcom.client.Client(self.p.account, self.p.password, self.p.apikey, self.p.environment)
-        self.CAPI.switch_account(self.p.accountID)
+        self.CAPI = capitalcom.client.Client(self.p.account, self.p.password, self.p.apikey, self.p.environment,
+                                             pool_maxsize=self.p.pool_maxsize,
+                                             timeout=self.p.request_timeout,
+                                             response_mode=capitalcom.ResponseMode.OBJECT,
+                                             cache=self._metadata_cache(),
+                                             session_cache=self._session_cache())
+        self._switch_account()
         self.RFC3339 = "%Y-%m-%dT%H:%M:%S"
 
         self.contractLotSize = 1
@@ -201,11 +392,56 @@ class CapitalcomStore(with_metaclass(MetaSingleton, object)):
         self._cash = 0.0
         self._value = 0.0
         self._evt_acct = threading.Event()
-        self.btcpositions = pd.DataFrame(columns = ['bt_oref','tradeid', 'size','executiontype',
-                                                    'status', 'dealid', 'affectedDeals','monitor', 'dealreference'])
+        self.orderbook = OrderBook()
         self.monitor_orders = False
         self.lost_connection = False
+        self._evt_stop = threading.Event()  # cancels history downloads
+        # keepalives, websocket pings, account refreshes and order monitor polls
+        self.engine = None
+        if self.p.engine == 'asyncio':
+            # all background work as tasks of one event loop, which also schedules
+            self.engine = AsyncEngine(self, timeout=self.p.request_timeout,
+                                      pool_maxsize=self.p.pool_maxsize)
+            self.scheduler = self.engine
+        else:
+            self.scheduler = Scheduler(notify=self.put_notification, name='capitalcom-scheduler')
+        self._account = self._monitor = None  # scheduler jobs of the broker
+        self._monitor_woken = False
+        self._monitor_interval = self.p.monitor_min
+        self._monitor_ran = float('-inf')  # monotonic time of the last monitor pass
+        self._monitor_triggers = dict()  # bt_oref -> monotonic time a quote woke the monitor
+        self._market_hours = dict()  # epic -> MarketHours
+        self.candle_cache = None
+        if self.p.candle_cache is not None:
+            self.candle_cache = CandleCache(self.p.candle_cache)
+        self.recorder = None
+        if self.p.tick_recorder is not None:
+            self.recorder = TickRecorder(self.p.tick_recorder, segment=self.p.tick_segment)
+        self.streamer = Streamer(self, self.p.log_ticks, self.recorder)  # shared by all feeds
+        self._aggregators = dict()  # epic -> TickAggregator of the live bars
+        self._aggregators_lock = threading.Lock()
+        self._keepalive = None
+
+
+    def _session_cache(self):
+        if self.p.session_cache is None:
+            return None
+        return capitalcom.SessionCache(self.p.session_cache)
 
+    def _switch_account(self):
+        if not self.p.accountID or self.CAPI.account_id == self.p.accountID:
+            return  # a resumed session may already be on the account
+        try:
+            self.CAPI.switch_account(self.p.accountID)
+        except capitalcom.CapitalComError as e:
+            # the account may already be the active one
+            if e.error_code != 'error.not-different.accountId':
+                self.put_notification(e)
+
+    def _metadata_cache(self):
+        if not self.p.metadata_cache:
+            return None
+        return capitalcom.TTLCache(path=self.p.cache_path)
 
     def start(self, data=None, broker=None):
         # Datas require some processing to kickstart data reception
@@ -227,10 +463,16 @@ class CapitalcomStore(with_metaclass(MetaSingleton, object)):
 
     def stop(self):
         # signal end of thread
+        self._evt_stop.set()
         if self.broker is not None:
-            self.q_ordercreate.put(None)
-            self.q_orderclose.put(None)
-            self.q_account.put(None)
+            self.dispatcher.stop()
+            self.scheduler.cancel(self._account)
+            self.scheduler.cancel(self._monitor)
+        if not self.streamer.sinks:
+            self.streamer.stop()  # the last feed has stopped
+            self.scheduler.stop()
+            if self.recorder is not None:
+                self.recorder.close()
 
     def put_notification(self, msg, *args, **kwargs):
         self.notifs.append((msg, args, kwargs))
@@ -258,7 +500,7 @@ class CapitalcomStore(with_metaclass(MetaSingleton, object)):
 
     def get_positions(self):
         try:
-            response = json.loads(self.CAPI.all_positions())
+            response = self.CAPI.all_positions()
             pos = response["positions"]
         except Exception as e:
             self.put_notification(e)
@@ -271,7 +513,7 @@ class CapitalcomStore(with_metaclass(MetaSingleton, object)):
 
     def get_instrument(self, dataname):
         try:
-            response = json.loads(self.CAPI.market_details(dataname))
+            response = self.CAPI.market_details(dataname)
             inst = response["marketDetails"][0]
 
         except Exception as e:
@@ -281,10 +523,17 @@ class CapitalcomStore(with_metaclass(MetaSingleton, object)):
         return inst or None
 
     def candles(self, dataname, dtbegin, dtend, timeframe, compression):
+        '''Downloads candles in a background thread, returns the queue they
+        are put on (``None`` if the connection is lost). Sub-minute
+        timeframes are requested as minute candles and expanded with
+        ``subminute_fill``'''
         if not self.lost_connection:
             kwargs = locals().copy()
             kwargs.pop('self')
             kwargs['q'] = q = queue.Queue()
+            if self.engine is not None and self.candle_cache is None:
+                self.engine.submit(self._acandles(**kwargs))
+                return q
             t = threading.Thread(target=self._t_candles, kwargs=kwargs)
             t.daemon = True
             t.start()
@@ -292,6 +541,17 @@ class CapitalcomStore(with_metaclass(MetaSingleton, object)):
         else:
             return None
 
+    # sub-minute granularities, requested as MINUTE candles
+    _SUBMINUTE = {'SECONDS_5': 5, 'SECONDS_15': 15, 'SECONDS_30': 30}
+
+    def _put_page(self, q, page, step):
+        # a page is handed over as a single columnar CandleBatch
+        if page['prices']:
+            batch = CandleBatch.from_candles(page['prices'])
+            if step:
+                batch = expand_subminute(batch, step, fill=self.p.subminute_fill)
+            q.put(batch)
+
     def _t_candles(self, dataname, dtbegin, dtend, timeframe, compression, q):
 
         granularity = self.get_granularity(timeframe, compression)
@@ -300,49 +560,35 @@ class CapitalcomStore(with_metaclass(MetaSingleton, object)):
             q.put(e.error_response)
             return
 
-        _FAKE_HITORY = {'SECONDS_5': 5,
-                  'SECONDS_15': 15,
-                  'SECONDS_30': 30}
-
-        if _FAKE_HITORY.get(granularity) != None:
-            _granularity_org = granularity
-            _step = _FAKE_HITORY.get(granularity)
-            _generate_candles = True
+        _step = None
+        if granularity in self._SUBMINUTE:
+            _step = self._SUBMINUTE[granularity]
             granularity = 'MINUTE'
 
-
         try:
             params = {
                 "resolution": granularity,
-                "max": 100,
+                "max": MAX_BATCH,
                 "from": dtbegin,
                 "to": dtend,
             }
 
-            for data in EpicCandlesFactory(self.CAPI, epic=dataname, params=params):
-                #check if there is real candle data in the calls. We dont want to stop processing in case of a
-                #{"errorCode":"error.prices.not-found"} which is thrown if part of the data is not available.
-                batch = json.loads(data)
-                if not "error" in data:
-                    if not _generate_candles:
-                        for candle in batch['prices']:
-                            q.put(candle)
-                    else:
-                        for candle in batch['prices']:
-
-                            for s in range(0, 59, _step):
-                                generated_candle = copy.deepcopy(candle)
-                                generated_candle['snapshotTime'] = datetime.strftime(
-                                                                    (datetime.strptime(candle['snapshotTime'],
-                                                                    self.RFC3339) + timedelta(0,s)), self.RFC3339)
-                                generated_candle['snapshotTimeUTC'] = datetime.strftime(
-                                                                    (datetime.strptime(candle['snapshotTimeUTC'],
-                                                                    self.RFC3339) + timedelta(0,s)), self.RFC3339)
-                                q.put(generated_candle)
+            # pages with {"errorCode":"error.prices.not-found"}, thrown if part of the data is not
+            # available, are skipped by the factory
+            if self.candle_cache is not None:
+                pages = CachedEpicCandlesFactory(self.CAPI, dataname, params, self.candle_cache,
+                                                 workers=self.p.history_workers, cancel=self._evt_stop)
+            else:
+                pages = ParallelEpicCandlesFactory(self.CAPI, epic=dataname, params=params,
+                                                   workers=self.p.history_workers, cancel=self._evt_stop)
+
+            for page in pages:
+                self._put_page(q, page, _step)
 
-                else:
-                    self.put_notification("Error loading historical data" + data)
+            q.put({})  # end of transmission
 
+        except capitalcom.CapitalComError as e:
+            self.put_notification("Error loading historical data: " + str(e))
             q.put({})  # end of transmission
 
         except Exception as e:
@@ -351,58 +597,133 @@ class CapitalcomStore(with_metaclass(MetaSingleton, object)):
             self.lost_connection = True
             return
 
-    def keepalive_ping(self):
-        while True:
-            if not self.lost_connection:
-                _time.sleep(180)
-                try:
-                    result = json.loads(self.CAPI.keepalive_ping())
-                    print("Broker client ping result: " + result['status'])
-                except Exception as e:
-                    self.lost_connection = True
-                    continue
-            else:
-                try:
-                    self.CAPI = capitalcom.client.Client(self.p.account, self.p.password, self.p.apikey,
-                                                         self.p.environment)
-
-                    result = self.CAPI.keepalive_ping()
-                    if 'OK' in result:
-                        self.lost_connection = False
-                except Exception as e:
-                    _time.sleep(30)
-                    continue
+    async def _acandles(self, dataname, dtbegin, dtend, timeframe, compression, q):
+        # engine version of _t_candles (without candle cache)
+        granularity = self.get_granularity(timeframe, compression)
+        _step = None
+        if granularity in self._SUBMINUTE:
+            _step = self._SUBMINUTE[granularity]
+            granularity = 'MINUTE'
 
+        params = {"resolution": granularity, "max": MAX_BATCH, "from": dtbegin, "to": dtend}
+        try:
+            self.engine._sync_session()
+            pages = AsyncEpicCandlesFactory(self.engine.client, dataname, params,
+                                            workers=self.p.history_workers, cancel=self._evt_stop)
+            async for page in pages:
+                self._put_page(q, page, _step)
+
+            q.put({})  # end of transmission
 
-    def streaming_prices(self, dataname, tmout=None):
-        q = queue.Queue()
-        kwargs = {'q': q, 'dataname': dataname, 'tmout': tmout}
-        t = threading.Thread(target=self._t_streaming_prices, kwargs=kwargs)
-        t.daemon = True
-        t.start()
+        except capitalcom.CapitalComError as e:
+            self.put_notification("Error loading historical data: " + str(e))
+            q.put({})  # end of transmission
 
-        #start pinging the capital.com REST api
-        x = threading.Thread(target=self.keepalive_ping, args=())
-        x.daemon = True
-        x.start()
+        except asyncio.CancelledError:
+            q.put(None)  # the engine is stopping
+            raise
 
-        return q
+        except Exception as e:
+            q.put(e)
+            q.put(None)
+            self.lost_connection = True
+
+    def get_market_hours(self, dataname):
+        '''MarketHours of ``dataname`` from the instrument details of its
+        feed, ``None`` if they are not known'''
+        hours = self._market_hours.get(dataname)
+        if hours is None:
+            for data in self.datas:
+                cd = getattr(data, 'contractdetails', None)
+                if data.p.dataname == dataname and cd:
+                    opening = cd.get('instrument', {}).get('openingHours')
+                    if opening:
+                        hours = self._market_hours[dataname] = MarketHours(opening)
+                    break
+        return hours
+
+    def keepalive_ping(self):
+        '''Scheduled job: pings the REST session every 180 seconds, or
+        restores it when the connection has been lost'''
+        if not self.lost_connection:
+            try:
+                result = self.CAPI.keepalive_ping()
+                print("Broker client ping result: " + result['status'])
+                return 180.0
+            except Exception as e:
+                self.lost_connection = True
+                return 0.0  # reconnect right away
+
+        try:
+            # keeps the session if its tokens are still valid (one ping), logs
+            # in again otherwise
+            if self.CAPI.reconnect():
+                self._switch_account()
+            self.lost_connection = False
+            return 180.0
+        except Exception as e:
+            pass
+        return 30.0
 
-    def _t_streaming_prices(self, dataname, q, tmout):
-        if tmout is not None:
-            _time.sleep(tmout)
+    def _start_keepalive(self):
+        #start pinging the capital.com REST api, once for all feeds
+        if self._keepalive is None:
+            self._keepalive = self.scheduler.every(180.0, self.keepalive_ping,
+                                                   name='keepalive', delay=180.0)
 
+    def streaming_prices(self, dataname, tmout=None, conflate=QuoteQueue.ALL, maxsize=10000,
+                         interval=0.25):
         #Make leverage and contract lotSize settings available to store
         self.contractLotSize = self.datas[0].contractdetails['instrument']['lotSize']
         self.leverage = self.datas[0].leverage
         self.dataname = dataname
 
-        streamer = Streamer(self,
-                            q,
-                            self.CAPI.cst,
-                            self.CAPI.x_security_token,
-                            dataname, self.p.log_ticks)
+        q = QuoteQueue(conflate, maxsize=maxsize, interval=interval,
+                       notify=self.put_notification, name=dataname)
+        self.streamer.add(dataname, q, delay=tmout)
 
+        self._start_keepalive()
+
+        return q
+
+    def streaming_bars(self, dataname, seconds, tmout=None, maxsize=10000):
+        '''Returns a queue receiving the bars of ``seconds`` built from the
+        quotes of ``dataname``. All timeframes of an epic share the same
+        aggregator, which processes each quote once'''
+        self.contractLotSize = self.datas[0].contractdetails['instrument']['lotSize']
+        self.leverage = self.datas[0].leverage
+        self.dataname = dataname
+
+        q = QuoteQueue(QuoteQueue.ALL, maxsize=maxsize, notify=self.put_notification, name=dataname)
+        with self._aggregators_lock:
+            aggregator = self._aggregators.get(dataname)
+            if aggregator is None or aggregator.closed:
+                aggregator = self._aggregators[dataname] = TickAggregator(dataname)
+                self.streamer.add(dataname, aggregator, delay=tmout)
+            aggregator.add(seconds, q)
+
+        self._start_keepalive()
+
+        return q
+
+    def flush_bars(self, dataname):
+        '''Completes the live bars of ``dataname`` whose end time has passed.
+        Returns the number of bars delivered'''
+        aggregator = self._aggregators.get(dataname)
+        if aggregator is None:
+            return 0
+        return aggregator.flush()
+
+    def stop_streaming(self, dataname, q):
+        '''Stops routing the quotes (or bars) of ``dataname`` to ``q``'''
+        with self._aggregators_lock:
+            aggregator = self._aggregators.get(dataname)
+            if aggregator is not None and q in aggregator:
+                if aggregator.remove(q):
+                    del self._aggregators[dataname]
+                    self.streamer.remove(dataname, aggregator)
+                return
+        self.streamer.remove(dataname, q)
 
     def get_cash(self):
         return self._cash
@@ -417,62 +738,67 @@ class CapitalcomStore(with_metaclass(MetaSingleton, object)):
     }
 
     def broker_threads(self):
-        self.q_account = queue.Queue()
-        self.q_account.put(True)  # force an immediate update
-        t = threading.Thread(target=self._t_account)
-        t.daemon = True
-        t.start()
-
-        self.q_ordercreate = queue.Queue()
-        t = threading.Thread(target=self._t_order_create)
-        t.daemon = True
-        t.start()
-
-        self.q_positionclose = queue.Queue()
-        t = threading.Thread(target=self._t_position_close)
-        t.daemon = True
-        t.start()
-
-        self.q_orderclose = queue.Queue()
-        t = threading.Thread(target=self._t_order_cancel)
-        t.daemon = True
-        t.start()
-
-        self.q_ordermonitor = queue.Queue()
-        t = threading.Thread(target=self._t_order_monitor)
-        t.daemon = True
-        t.start()
+        if self.engine is not None:
+            # coroutine versions of the jobs, run on the loop of the engine
+            self._jobs = dict(account=self._a_account, monitor=self._a_order_monitor,
+                              create=self._a_order_create, cancel=self._a_order_cancel,
+                              close=self._a_position_close)
+            self.dispatcher = AsyncDispatcher(self.engine, workers=self.p.order_workers,
+                                              notify=self.put_notification)
+        else:
+            self._jobs = dict(account=self._t_account, monitor=self._t_order_monitor,
+                              create=self._order_create, cancel=self._order_cancel,
+                              close=self._position_close)
+            # deal confirmations of all order threads are polled together
+            self.confirms = capitalcom.ConfirmationWaiter(self.CAPI, timeout=self.p.confirm_timeout,
+                                                          workers=self.p.order_workers)
+
+            # order create / close / cancel, FIFO per epic and parallel across epics
+            self.dispatcher = OrderDispatcher(workers=self.p.order_workers,
+                                              notify=self.put_notification)
+
+        # the account is refreshed right away and every account_tmout seconds
+        self._account = self.scheduler.every(self.p.account_tmout, self._jobs['account'],
+                                             name='account')
+        self._monitor = self.scheduler.every(self.p.monitor_min, self._jobs['monitor'],
+                                             name='order-monitor')
 
         # Wait once for the values to be set
         self._evt_acct.wait(self.p.account_tmout)
 
     def _t_account(self):
-        while True:
-            try:
-                msg = self.q_account.get(timeout=self.p.account_tmout)
-                if msg is None:
-                    break  # end of thread
-            except queue.Empty:  # tmout -> time to refresh
-                pass
+        # scheduled job: refreshes cash and value
+        try:
+            allAccounts = self.CAPI.all_accounts()
+        except Exception as e:
+            self._account_failed(e)
+            return
+        self._set_account(allAccounts)
 
-            try:
-                rv = self.CAPI.all_accounts()
-                allAccounts = json.loads(rv)
-            except Exception as e:
-                self.lost_connection = True
-                self.put_notification(e)
-                continue
+    async def _a_account(self):
+        try:
+            allAccounts = await self.engine.client.all_accounts()
+        except Exception as e:
+            self._account_failed(e)
+            return
+        self._set_account(allAccounts)
 
-            try:
-               for account in allAccounts['accounts']:
-                    if account['accountId'] == self.p.accountID:
-                        self._cash = account['balance']['balance']
-                        self._value = account['balance']['available']
+    def _account_failed(self, e):
+        self.lost_connection = True
+        self.put_notification(e)
+        self.scheduler.wake(self._keepalive)
 
-            except KeyError:
-                pass
+    def _set_account(self, allAccounts):
+        try:
+           for account in allAccounts['accounts']:
+                if account['accountId'] == self.p.accountID:
+                    self._cash = account['balance']['balance']
+                    self._value = account['balance']['available']
+
+        except KeyError:
+            pass
 
-            self._evt_acct.set()
+        self._evt_acct.set()
 
     def order_create(self, order, stopside=None, takeside=None, **kwargs):
         #Check if the tradeid has been set
@@ -482,13 +808,13 @@ class CapitalcomStore(with_metaclass(MetaSingleton, object)):
             return
 
         #check if this order is actually meant to flatten an existing position
-        deal = self.btcpositions.loc[self.btcpositions['tradeid'] == order.p.tradeid]
-        if len(deal) == 1:
-            dealid = deal.iloc[0,5]
-            affectedDeals = json.loads(deal.iloc[0,6])
-            for affectedDeal in affectedDeals:
+        deals = self.orderbook.by_tradeid(order.p.tradeid)
+        if len(deals) == 1:
+            deal = deals[0]
+            for affectedDeal in deal.affectedDeals:
                 affectedDealId = affectedDeal['dealId']
-                self.q_positionclose.put((order.ref, order.created.size, dealid, affectedDealId,))
+                self.dispatcher.submit(deal.epic or deal.tradeid, order.ref, self._jobs['close'],
+                                       order.ref, order.created.size, deal.bt_oref, affectedDealId)
 
         else:
             okwargs = dict()
@@ -530,184 +856,381 @@ class CapitalcomStore(with_metaclass(MetaSingleton, object)):
 
             okwargs.update(**kwargs)  # anything from the user
 
-            #store the order information in the internal table
-            #['Created', 'Submitted', 'Accepted', 'Partial', 'Completed', 'Canceled', 'Expired', 'Margin', 'Rejected']
-
-            self.btcpositions = self.btcpositions.append(
-                {'bt_oref': order.ref, 'tradeid': order.p.tradeid, 'size': order.size,
-                 'executiontype': order.exectype, 'status': 'Created', 'dealid': '',
-                 'affectedDeals': '', 'monitor': False, 'dealreference': ''}, ignore_index=True)
+            #store the order information in the order book
+            self.orderbook.add(order.ref, order.p.tradeid, order.size, order.exectype,
+                               epic=okwargs['epic'], level=okwargs.get('level'),
+                               stop_level=okwargs.get('stop_level'),
+                               profit_level=okwargs.get('profit_level', okwargs.get('profitLevel')))
 
-            self.q_ordercreate.put((order.ref, okwargs,))
+            self.dispatcher.submit(okwargs['epic'], order.ref, self._jobs['create'], order.ref, okwargs)
             return order
 
 
-    def _t_order_create(self):
-        while True:
-            msg = self.q_ordercreate.get()
-            if msg is None:
-                break
+    def _order_create(self, oref, okwargs):
+        self.dispatcher.mark(oref, 'sent')
+        try:
+            if okwargs.get('type') == '_MARKET':
+                rv = self.CAPI.place_the_position(**okwargs)
+            else:
+                rv = self.CAPI.place_the_order(**okwargs)
+        except Exception as e:
+            self._order_rejected(oref, e)
+            return
+        self.dispatcher.mark(oref, 'accepted')
 
-            oref, okwargs = msg
+        # Get the DealId that is used for future actions
+        try:
+            dealReference = rv['dealReference']
+            conf = self.confirms.wait(dealReference)
+        except Exception as e:
+            self._order_rejected(oref, e)
+            return
+        self._order_confirmed(oref, okwargs, dealReference, conf)
 
+    async def _a_order_create(self, oref, okwargs):
+        self.dispatcher.mark(oref, 'sent')
+        try:
             if okwargs.get('type') == '_MARKET':
-                try:
-                    rv = self.CAPI.place_the_position(**okwargs)
-                except Exception as e:
-                    self.put_notification(e)
-                    self.broker._reject(oref)
-                    break
+                rv = await self.engine.client.place_the_position(**okwargs)
             else:
-                try:
-                    rv = self.CAPI.place_the_order(**okwargs)
-                except Exception as e:
-                    self.put_notification(e)
-                    self.broker._reject(oref)
-                    return
+                rv = await self.engine.client.place_the_order(**okwargs)
+        except Exception as e:
+            self._order_rejected(oref, e)
+            return
+        self.dispatcher.mark(oref, 'accepted')
 
-            # Get the DealId that is used for future actions
-            try:
-                o = json.loads(rv)
-                dealReference = o['dealReference']
-                rvc = self.CAPI.position_order_confirmation(dealReference)
-                conf = json.loads(rvc)
-                dealId = conf['dealId']
-                affectedDeals = json.dumps(conf['affectedDeals'])
+        try:
+            dealReference = rv['dealReference']
+            conf = await self.engine.confirm(dealReference)
+        except Exception as e:
+            self._order_rejected(oref, e)
+            return
+        self._order_confirmed(oref, okwargs, dealReference, conf)
 
-            except Exception as e:
-                self.put_notification(e)
-                self.broker._reject(oref)
-                break
+    def _order_rejected(self, oref, e):
+        self.put_notification(e)
+        self._book_close(oref, OrderState.REJECTED)
+        self.broker._reject(oref)
 
-            self._orders[oref] = dealId
-            self.broker._submit(oref)
-            self.broker._accept(oref)
-            self.btcpositions.loc[self.btcpositions['bt_oref'] == oref, 'dealid'] = dealId
-            self.btcpositions.loc[self.btcpositions['bt_oref'] == oref, 'affectedDeals'] = affectedDeals
+    def _order_confirmed(self, oref, okwargs, dealReference, conf):
+        try:
+            if conf.get('dealStatus') == 'REJECTED':
+                raise ValueError('Deal {} rejected: {}'.format(dealReference, conf.get('reason')))
+            dealId = conf['dealId']
+            affectedDeals = conf['affectedDeals']
 
-            if okwargs.get('type') == '_MARKET':
-                self.btcpositions.loc[self.btcpositions['bt_oref'] == oref, 'status'] = 'Position'
-                if conf['status'] == 'OPEN':
-                    if conf['direction'] == 'SELL':
-                        size = -1 * conf['size']
-                    else:
-                        size = conf['size']
-                    self.broker._fill(oref,size,conf['level'],'ORDER_FILLED')
-            else:
-                self.btcpositions.loc[self.btcpositions['bt_oref'] == oref, 'status'] = 'Accepted'
-                self.btcpositions.loc[self.btcpositions['bt_oref'] == oref, 'monitor'] = True
-                self.monitor_orders = True
+        except Exception as e:
+            self._order_rejected(oref, e)
+            return
+        self.dispatcher.mark(oref, 'confirmed')
+
+        self._orders[oref] = dealId
+        self.broker._submit(oref)
+        self.broker._accept(oref)
+
+        if okwargs.get('type') == '_MARKET':
+            self.orderbook.transition(oref, OrderState.POSITION, dealid=dealId,
+                                      dealreference=dealReference, affectedDeals=affectedDeals)
+            if conf['status'] == 'OPEN':
+                if conf['direction'] == 'SELL':
+                    size = -1 * conf['size']
+                else:
+                    size = conf['size']
+                self.broker._fill(oref,size,conf['level'],'ORDER_FILLED')
+        else:
+            # the dealId of a working order is the workingOrderId of the position it opens
+            self.orderbook.transition(oref, OrderState.ACCEPTED, workingorderid=dealId,
+                                      affectedDeals=affectedDeals, monitor=True)
+            self.monitor_orders = True
+            self._wake_monitor()  # start polling at the fastest interval
 
     def order_cancel(self, order):
-        print(self.btcpositions.to_markdown())
-        deal = self.btcpositions.loc[self.btcpositions['tradeid'] == order.p.tradeid]
-        if len(deal) == 1:
-            dealid = deal.iloc[0,5]
-            affectedDeals = json.loads(deal.iloc[0,6])
+        deals = self.orderbook.by_tradeid(order.p.tradeid)
+        if len(deals) == 1:
+            deal = deals[0]
             self.broker._accept(order.ref)
-            for affectedDeal in affectedDeals:
+            for affectedDeal in deal.affectedDeals:
                 affectedDealId = affectedDeal['dealId']
-                self.q_orderclose.put((order.ref, dealid, affectedDealId,))
+                self.dispatcher.submit(deal.epic or deal.tradeid, order.ref, self._jobs['cancel'],
+                                       order.ref, deal.bt_oref, affectedDealId)
         return order
 
-    def _t_order_cancel(self):
-        while True:
-            oref, dealid, affectedDealId  = self.q_orderclose.get()
-            if oref is None:
-                break
+    def _book_close(self, oref, status):
+        '''Moves a book entry to a final status, entries not in a state
+        allowing it (or already gone) are simply removed'''
+        try:
+            self.orderbook.transition(oref, status)
+        except (KeyError, OrderBookError):
+            self.orderbook.remove(oref)
 
-            try:
-                o = self.CAPI.close_order(affectedDealId)
-            except Exception as e:
-                break  # not cancelled - FIXME: notify
+    def _order_cancel(self, oref, deal_oref, affectedDealId):
+        self.dispatcher.mark(oref, 'sent')
+        try:
+            o = self.CAPI.close_order(affectedDealId)
+        except Exception as e:
+            self.put_notification(e)  # not cancelled
+            return
+        self._order_cancelled(oref, deal_oref)
 
-            self.btcpositions.drop(self.btcpositions[self.btcpositions.dealid == dealid].index, inplace=True)
-            self.monitor_orders = False
-            self.broker._cancel(oref)
+    async def _a_order_cancel(self, oref, deal_oref, affectedDealId):
+        self.dispatcher.mark(oref, 'sent')
+        try:
+            o = await self.engine.client.close_order(affectedDealId)
+        except Exception as e:
+            self.put_notification(e)  # not cancelled
+            return
+        self._order_cancelled(oref, deal_oref)
 
-    def _t_position_close(self):
-        while True:
-            msg = self.q_positionclose.get()
-            if msg is None:
-                break
+    def _order_cancelled(self, oref, deal_oref):
+        self.dispatcher.mark(oref, 'confirmed')
+        self._book_close(deal_oref, OrderState.CANCELED)
+        self.monitor_orders = bool(self.orderbook.monitored())
+        self.broker._cancel(oref)
 
-            try:
-                oref, size, dealid, affectedDealId = msg
-                rvp = self.CAPI.close_position(affectedDealId)
-                if 'error' in rvp or rvp == '':
-                    self.btcpositions.drop(self.btcpositions[self.btcpositions.dealid == dealid].index,
-                                           inplace=True)
-                    self.put_notification(rvp)
-                    self.broker._reject(oref)
-            except Exception as e:
-                self.put_notification(e)
-                break
+    def _position_close(self, oref, size, deal_oref, affectedDealId):
+        self.dispatcher.mark(oref, 'sent')
+        try:
+            rvp = self.CAPI.close_position(affectedDealId)
+        except Exception as e:
+            self._close_failed(oref, deal_oref, e)
+            return
+        self._close_accepted(oref)
 
-            self.broker._submit(oref)
-            self.broker._accept(oref)  # taken immediately
+        try:
+            dealReference = rvp['dealReference']
+            conf = self.confirms.wait(dealReference)
+        except Exception as e:
+            self.put_notification(e)
+            self.broker._reject(oref)
+            return
+        self._position_closed(oref, deal_oref, conf)
 
-            try:
-                result = json.loads(rvp)
-                dealReference = result['dealReference']
-                rvc = self.CAPI.position_order_confirmation(dealReference)
-                conf = json.loads(rvc)
-            except Exception as e:
-                self.put_notification(e)
-                self.broker._reject(oref)
-                break
+    async def _a_position_close(self, oref, size, deal_oref, affectedDealId):
+        self.dispatcher.mark(oref, 'sent')
+        try:
+            rvp = await self.engine.client.close_position(affectedDealId)
+        except Exception as e:
+            self._close_failed(oref, deal_oref, e)
+            return
+        self._close_accepted(oref)
 
-            if conf['status'] == 'CLOSED':
-                if conf['direction'] == 'SELL':
-                    size = -1 * conf['size']
-                else:
-                    size = conf['size']
-                self.broker._fill(oref, size, conf['level'], 'ORDER_FILLED')
-                self.btcpositions.drop(self.btcpositions[self.btcpositions.dealid == dealid].index, inplace = True)
+        try:
+            dealReference = rvp['dealReference']
+            conf = await self.engine.confirm(dealReference)
+        except Exception as e:
+            self.put_notification(e)
+            self.broker._reject(oref)
+            return
+        self._position_closed(oref, deal_oref, conf)
 
+    def _close_failed(self, oref, deal_oref, e):
+        self.put_notification(e)
+        if isinstance(e, capitalcom.CapitalComError):
+            self.orderbook.remove(deal_oref)
+            self.broker._reject(oref)
 
-    def _t_order_monitor(self):
-        #periodically validate status of limit / stop orders and resulting positions
-        while True:
-            if not self.monitor_orders:
-                #print('order monitor sleeping for  180 secs')
-                _time.sleep(180)
+    def _close_accepted(self, oref):
+        self.broker._submit(oref)
+        self.broker._accept(oref)  # taken immediately
+        self.dispatcher.mark(oref, 'accepted')
+
+    def _position_closed(self, oref, deal_oref, conf):
+        self.dispatcher.mark(oref, 'confirmed')
+
+        if conf['status'] == 'CLOSED':
+            if conf['direction'] == 'SELL':
+                size = -1 * conf['size']
             else:
-                #Check if pending order(s) have been filled:
-                positions = self.CAPI.all_positions()
-                if '[]' not in positions:
-                    positions = json.loads(positions)
-                    if len(positions['positions']) != 0:
-                        monitored_orders = self.btcpositions.loc[(self.btcpositions['monitor'] == True) &
-                                                                 (self.btcpositions['status'] == 'Accepted')]
-                        if len(monitored_orders.index) != 0:
-                            #iterate to df rows. use for loop to preserve naming and data types
-                            for i in range(0, len(monitored_orders.index)):
-                                for position in positions['positions']:
-                                    if position['position']['workingOrderId'] == monitored_orders['dealid'][i]:
-                                        self.btcpositions.loc[self.btcpositions['dealid'] == monitored_orders['dealid'][i],
-                                        'dealid'] = position['position']['dealId']
-                                        self.btcpositions.loc[self.btcpositions['dealid'] == position['position']['dealId'],
-                                        'status'] = 'Position'
-                                        self.btcpositions.loc[self.btcpositions['dealid'] == position['position']['dealId'],
-                                        'dealreference'] = position['position']['dealReference']
-                                        self.broker._fill(monitored_orders['bt_oref'][i], monitored_orders['size'][i],
-                                                          position['position']['level'], 'ORDER_FILLED')
-
-                #check if any of the monitored positions have been closed because of SL /TP
-                monitored_positions = self.btcpositions.loc[(self.btcpositions['monitor'] == True) &
-                                                         (self.btcpositions['status'] == 'Position')]
-                if len(monitored_positions.index) != 0:
-                    for i in range(0, len(monitored_positions.index)):
-                        dealreference = monitored_positions['dealreference'][i]
-                        rvc = self.CAPI.position_order_confirmation(dealreference)
-                        if 'error' in rvc:
-                            break
-                        confirmation = json.loads(rvc)
-                        if confirmation['status'] == 'CLOSED':
-                            self.btcpositions.drop(
-                                self.btcpositions[self.btcpositions.dealreference == dealreference].index,
-                                inplace=True)
-                if (len(self.btcpositions.loc[(self.btcpositions['monitor'] == True)].index) == 0):
-                    self.monitor_orders = False
-                #print('order monitor sleeping for 30 secs')
-                _time.sleep(30)
+                size = conf['size']
+            self.broker._fill(oref, size, conf['level'], 'ORDER_FILLED')
+            self._book_close(deal_oref, OrderState.CLOSED)
+
+
+    def on_quote(self, quote):
+        '''Called by the Streamer for every quote. Wakes up the order monitor
+        when the quote crosses the level of a working order or the stop /
+        profit level of a monitored position of its epic. A quote held
+        across a level wakes it at most once per ``monitor_min`` (per order
+        and since the last check)'''
+        if not self.monitor_orders:
+            return
+
+        now = _time.monotonic()
+        if now - self._monitor_ran < self.p.monitor_min:
+            return  # just checked, or checking
+
+        for entry in self.orderbook.monitored():
+            if entry.epic == quote['epic'] and self._crossed(entry, quote):
+                if now - self._monitor_triggers.get(entry.bt_oref, float('-inf')) < self.p.monitor_min:
+                    continue
+                self._monitor_triggers[entry.bt_oref] = now
+                self._wake_monitor()
+                return
+
+    @staticmethod
+    def _crossed(entry, quote):
+        bid, ofr = float(quote['bid']), float(quote['ofr'])
+        buy = entry.size > 0
+        if entry.status == OrderState.ACCEPTED:
+            # a working order is filled on the side it trades
+            price = ofr if buy else bid
+            if entry.executiontype == bt.Order.Limit:
+                return price <= entry.level if buy else price >= entry.level
+            return price >= entry.level if buy else price <= entry.level
+
+        # a position is closed on the opposite side
+        price = bid if buy else ofr
+        if entry.stop_level is not None:
+            if (price <= entry.stop_level) if buy else (price >= entry.stop_level):
+                return True
+        if entry.profit_level is not None:
+            if (price >= entry.profit_level) if buy else (price <= entry.profit_level):
+                return True
+        return False
+
+    def _wake_monitor(self):
+        self._monitor_woken = True
+        self.scheduler.wake(self._monitor)
+
+    def _t_order_monitor(self):
+        #scheduled job: validates the status of limit / stop orders and resulting positions.
+        #Checks are done right away when a quote crosses a level, polling backs off while
+        #nothing changes. Returns the seconds until the next check
+        triggered, self._monitor_woken = self._monitor_woken, False
+        if not self.monitor_orders:
+            self._monitor_interval = self.p.monitor_min
+            return 180.0
+
+        self._monitor_ran = _time.monotonic()
+        try:
+            # polling must not hold back order placement / close
+            with self.CAPI.priority(capitalcom.Priority.ACCOUNT):
+                changed = self._monitor_pass()
+        except Exception as e:
+            self.put_notification(e)
+            changed = False
+        return self._monitor_next(changed or triggered)
+
+    async def _a_order_monitor(self):
+        triggered, self._monitor_woken = self._monitor_woken, False
+        if not self.monitor_orders:
+            self._monitor_interval = self.p.monitor_min
+            return 180.0
+
+        self._monitor_ran = _time.monotonic()
+        try:
+            client = self.engine.client
+            positions = (await client.all_positions())['positions']
+            orders = activities = None
+            if self.orderbook.monitored(OrderState.ACCEPTED):
+                orders = (await client.all_orders())['workingOrders']
+                period = self._activity_period(positions, orders)
+                if period:
+                    activities = (await client.account_activity_history(
+                        None, None, last_period=period, detailed=True))['activities']
+            changed = self._monitor_apply(positions, orders, activities)
+        except Exception as e:
+            self.put_notification(e)
+            changed = False
+        return self._monitor_next(changed or triggered)
+
+    def _monitor_next(self, changed):
+        if changed:
+            self._monitor_interval = self.p.monitor_min
+        else:
+            self._monitor_interval = min(self._monitor_interval * 2, self.p.monitor_max)
+        return self._monitor_interval
+
+    def _monitor_pass(self):
+        '''Compares the monitored book entries with a single snapshot of the
+        positions (and working orders). Returns True if an entry changed'''
+        positions = self.CAPI.all_positions()['positions']
+        orders = activities = None
+        if self.orderbook.monitored(OrderState.ACCEPTED):
+            orders = self.CAPI.all_orders()['workingOrders']
+            period = self._activity_period(positions, orders)
+            if period:
+                activities = self.CAPI.account_activity_history(
+                    None, None, last_period=period, detailed=True)['activities']
+        return self._monitor_apply(positions, orders, activities)
+
+    def _vanished(self, positions, orders):
+        # accepted working orders that are neither working nor an open position
+        working = set(p['position'].get('workingOrderId') for p in positions)
+        working.update(o['workingOrderData']['dealId'] for o in orders)
+        return [entry for entry in self.orderbook.monitored(OrderState.ACCEPTED)
+                if entry.workingorderid not in working]
+
+    def _activity_period(self, positions, orders):
+        # seconds of account activity covering the vanished working orders,
+        # 0 if there are none (the API serves one day at most)
+        vanished = self._vanished(positions, orders)
+        if not vanished:
+            return 0
+        since = min(entry.updated for entry in vanished)
+        return int(min(86400, _time.time() - since + 60))
+
+    @staticmethod
+    def _order_fill(entry, activities):
+        # the activity of the position opened by the working order of entry
+        for activity in activities or ():
+            details = activity.get('details') or {}
+            if activity.get('type') != 'POSITION':
+                continue
+            if details.get('workingOrderId') == entry.workingorderid or \
+               activity.get('dealId') == entry.workingorderid:
+                for action in details.get('actions') or ():
+                    if action.get('actionType') == 'POSITION_OPENED':
+                        return activity
+        return None
+
+    def _monitor_apply(self, positions, orders, activities=None):
+        # orders: the working orders, None if no entry is waiting for a fill
+        # activities: the account activity since the vanished working orders
+        changed = False
+        accepted = self.orderbook.monitored(OrderState.ACCEPTED) if orders is not None else []
+        # positions opened by a working order carry its id
+        working = {p['position'].get('workingOrderId'): p['position'] for p in positions}
+        opened = set(p['position']['dealId'] for p in positions)
+
+        if accepted:
+            pending = set(o['workingOrderData']['dealId'] for o in orders)
+
+        #Check if pending order(s) have been filled:
+        for entry in accepted:
+            position = working.get(entry.workingorderid)
+            if position is not None:
+                self.orderbook.transition(entry.bt_oref, OrderState.POSITION,
+                                          dealid=position['dealId'],
+                                          dealreference=position['dealReference'])
+                opened.add(position['dealId'])
+                self.broker._fill(entry.bt_oref, entry.size, position['level'], 'ORDER_FILLED')
+                changed = True
+            elif entry.workingorderid not in pending:
+                fill = self._order_fill(entry, activities)
+                if fill is not None:
+                    # filled and already closed (SL / TP) between two polls
+                    details = fill['details']
+                    self.orderbook.transition(entry.bt_oref, OrderState.POSITION,
+                                              dealid=fill.get('dealId'))
+                    self.broker._fill(entry.bt_oref, entry.size,
+                                      details.get('level', entry.level), 'ORDER_FILLED')
+                    self.orderbook.transition(entry.bt_oref, OrderState.CLOSED)
+                else:
+                    # neither working nor filled: expired (good till date) or cancelled outside
+                    self.orderbook.transition(entry.bt_oref, OrderState.CANCELED)
+                    self.broker._expire(entry.bt_oref)
+                changed = True
+
+        #check if any of the monitored positions have been closed because of SL /TP
+        for entry in self.orderbook.monitored(OrderState.POSITION):
+            if entry.dealid not in opened:
+                self.orderbook.transition(entry.bt_oref, OrderState.CLOSED)
+                changed = True
+
+        monitored = set(entry.bt_oref for entry in self.orderbook.monitored())
+        for oref in [oref for oref in self._monitor_triggers if oref not in monitored]:
+            del self._monitor_triggers[oref]
+        if not monitored:
+            self.monitor_orders = False
+        return changed
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+###############################################################################
+#
+# 2023: Jelle Bloemsma, backtrader store functionality for Capital.com
+# based on https://github.com/mementum/backtrader
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import collections
+import threading
+import time
+
+from backtrader.utils.py3 import queue
+
+
+class OrderTiming(object):
+    '''Wall clock times of the stages of an order (``None`` if not reached)'''
+    __slots__ = ('oref', 'key', 'queued', 'sent', 'accepted', 'confirmed')
+
+    STAGES = ('queued', 'sent', 'accepted', 'confirmed')
+
+    def __init__(self, oref, key):
+        self.oref = oref
+        self.key = key
+        self.queued = time.time()
+        self.sent = self.accepted = self.confirmed = None
+
+    def asdict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+class OrderDispatcher(object):
+    '''Runs order jobs on a pool of worker threads.
+
+    Jobs submitted with the same ``key`` (the epic, or the tradeid when the
+    epic is unknown) run one at a time in submission order, jobs of different
+    keys run in parallel on up to ``workers`` threads.
+
+    A lane is kept per key. A key is put on the ready queue when its lane
+    gets its first job and only taken again by a worker after the running job
+    of the key has finished, which gives the per key FIFO guarantee.
+
+    Exceptions raised by a job are passed to ``notify`` (``print`` if not
+    given), they never stop a worker.
+    '''
+
+    def __init__(self, workers=4, notify=None, history=1000):
+        self.notify = notify or print
+        self._lock = threading.Lock()
+        self._lanes = dict()  # key -> deque of (oref, fn, args)
+        self._ready = queue.Queue()  # keys with a job to run and none running
+        self.timings = collections.OrderedDict()  # oref -> OrderTiming
+        self._history = history
+        self._threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self._t_worker, name='order-dispatch-{}'.format(i))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, key, oref, fn, *args):
+        '''Queues ``fn(*args)`` behind the other jobs of ``key``'''
+        with self._lock:
+            self._track(oref, key)
+            lane = self._lanes.get(key)
+            if lane is None:
+                lane = self._lanes[key] = collections.deque()
+                self._ready.put(key)  # nothing queued or running for the key
+            lane.append((oref, fn, args))
+
+    def _track(self, oref, key):
+        # lock held
+        if oref is not None and oref not in self.timings:
+            self.timings[oref] = OrderTiming(oref, key)
+            while len(self.timings) > self._history:
+                self.timings.popitem(last=False)
+
+    def mark(self, oref, stage):
+        '''Records the time ``oref`` reached ``stage`` (see
+        ``OrderTiming.STAGES``)'''
+        timing = self.timings.get(oref)
+        if timing is not None and getattr(timing, stage) is None:
+            setattr(timing, stage, time.time())
+
+    def stats(self):
+        '''Average and maximum seconds from queued to each later stage'''
+        with self._lock:
+            timings = list(self.timings.values())
+
+        stats = dict()
+        for stage in OrderTiming.STAGES[1:]:
+            delays = [getattr(t, stage) - t.queued for t in timings
+                      if getattr(t, stage) is not None]
+            stats[stage] = {'orders': len(delays),
+                            'avg': sum(delays) / len(delays) if delays else 0.0,
+                            'max': max(delays) if delays else 0.0}
+        return stats
+
+    def stop(self):
+        for t in self._threads:
+            self._ready.put(None)
+
+    def _t_worker(self):
+        while True:
+            key = self._ready.get()
+            if key is None:
+                break
+
+            with self._lock:
+                oref, fn, args = self._lanes[key].popleft()
+
+            try:
+                fn(*args)
+            except Exception as e:
+                # a failing job must not take a worker (or the lane) down
+                self.notify(e)
+
+            with self._lock:
+                if self._lanes[key]:
+                    self._ready.put(key)
+                else:
+                    del self._lanes[key]
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+###############################################################################
+#
+# 2023: Jelle Bloemsma, backtrader store functionality for Capital.com
+# based on https://github.com/mementum/backtrader
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import collections
+import threading
+import time
+
+
+class OrderState(object):
+    '''States of an order book entry'''
+    CREATED = 'Created'  # sent to the order create thread
+    ACCEPTED = 'Accepted'  # working (limit / stop) order placed at Capital.com
+    POSITION = 'Position'  # open position
+    CLOSED = 'Closed'  # position closed (by the strategy or a SL / TP)
+    CANCELED = 'Canceled'  # working order cancelled
+    REJECTED = 'Rejected'
+
+    # allowed transitions, any state may go to REJECTED before it is final
+    TRANSITIONS = {
+        CREATED: (ACCEPTED, POSITION, REJECTED),
+        ACCEPTED: (POSITION, CANCELED, REJECTED),
+        POSITION: (CLOSED, REJECTED),
+        CLOSED: (),
+        CANCELED: (),
+        REJECTED: (),
+    }
+
+    FINAL = (CLOSED, CANCELED, REJECTED)
+
+
+class OrderBookError(ValueError):
+    pass
+
+
+class OrderEntry(object):
+    '''An order of the strategy and the Capital.com deal it resulted in'''
+    __slots__ = ('bt_oref', 'tradeid', 'size', 'executiontype', 'epic', 'level',
+                 'stop_level', 'profit_level', 'status', 'dealid', 'workingorderid',
+                 'dealreference', 'affectedDeals', 'monitor', 'created', 'updated')
+
+    # fields with a hash index in the OrderBook
+    INDEXED = ('tradeid', 'dealid', 'workingorderid', 'dealreference')
+
+    def __init__(self, bt_oref, tradeid, size, executiontype, epic=None, level=None,
+                 stop_level=None, profit_level=None):
+        self.bt_oref = bt_oref
+        self.tradeid = tradeid
+        self.size = size
+        self.executiontype = executiontype
+        self.epic = epic
+        self.level = level
+        self.stop_level = stop_level
+        self.profit_level = profit_level
+        self.status = OrderState.CREATED
+        self.dealid = None
+        self.workingorderid = None
+        self.dealreference = None
+        self.affectedDeals = []
+        self.monitor = False
+        self.created = self.updated = time.time()
+
+    def asdict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+class OrderBook(object):
+    '''Thread safe book of the orders of the store.
+
+    Entries are keyed on the backtrader order ref and indexed on ``tradeid``,
+    ``dealid``, ``workingorderid`` and ``dealreference``, so that every lookup
+    is a dict access. Status changes go through ``transition``, which rejects
+    those not allowed by ``OrderState.TRANSITIONS``.
+    '''
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._entries = collections.OrderedDict()  # bt_oref -> OrderEntry
+        self._index = {name: collections.defaultdict(set) for name in OrderEntry.INDEXED}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._entries.values()))
+
+    def _reindex(self, entry, name, old, new):
+        if old is not None:
+            refs = self._index[name][old]
+            refs.discard(entry.bt_oref)
+            if not refs:
+                del self._index[name][old]
+        if new is not None:
+            self._index[name][new].add(entry.bt_oref)
+
+    def add(self, bt_oref, tradeid, size, executiontype, **kwargs):
+        with self._lock:
+            if bt_oref in self._entries:
+                raise OrderBookError('order {} already in the book'.format(bt_oref))
+            entry = OrderEntry(bt_oref, tradeid, size, executiontype, **kwargs)
+            self._entries[bt_oref] = entry
+            self._reindex(entry, 'tradeid', None, tradeid)
+            return entry
+
+    def get(self, bt_oref):
+        with self._lock:
+            return self._entries.get(bt_oref)
+
+    def find(self, name, value):
+        '''Returns the entries whose indexed field ``name`` equals ``value``'''
+        with self._lock:
+            return [self._entries[ref] for ref in self._index[name].get(value, ())]
+
+    def by_tradeid(self, tradeid):
+        return self.find('tradeid', tradeid)
+
+    def by_dealid(self, dealid):
+        entries = self.find('dealid', dealid)
+        return entries[0] if entries else None
+
+    def by_workingorderid(self, workingorderid):
+        entries = self.find('workingorderid', workingorderid)
+        return entries[0] if entries else None
+
+    def by_dealreference(self, dealreference):
+        entries = self.find('dealreference', dealreference)
+        return entries[0] if entries else None
+
+    def update(self, bt_oref, **fields):
+        '''Sets the fields of an entry, keeping the indexes up to date'''
+        with self._lock:
+            entry = self._entries[bt_oref]
+            if 'status' in fields:
+                raise OrderBookError('use transition to change the status')
+            for name, value in fields.items():
+                if name in OrderEntry.INDEXED:
+                    self._reindex(entry, name, getattr(entry, name), value)
+                setattr(entry, name, value)
+            entry.updated = time.time()
+            return entry
+
+    def transition(self, bt_oref, status, **fields):
+        '''Moves an entry to ``status`` (and sets ``fields``). Final states
+        remove the entry from the book'''
+        with self._lock:
+            entry = self._entries[bt_oref]
+            if status not in OrderState.TRANSITIONS[entry.status]:
+                raise OrderBookError('order {}: {} -> {} not allowed'.format(
+                    bt_oref, entry.status, status))
+            self.update(bt_oref, **fields)
+            entry.status = status
+            if status in OrderState.FINAL:
+                self.remove(bt_oref)
+            return entry
+
+    def remove(self, bt_oref):
+        with self._lock:
+            entry = self._entries.pop(bt_oref, None)
+            if entry is not None:
+                for name in OrderEntry.INDEXED:
+                    self._reindex(entry, name, getattr(entry, name), None)
+            return entry
+
+    def monitored(self, status=None):
+        '''Returns the entries to be monitored, optionally in ``status``'''
+        with self._lock:
+            return [e for e in self._entries.values()
+                    if e.monitor and (status is None or e.status == status)]
+
+    def snapshot(self):
+        '''Returns a copy of the book as a list of dicts (for debugging and
+        export)'''
+        with self._lock:
+            return [e.asdict() for e in self._entries.values()]
+
+    def __str__(self):
+        columns = ('bt_oref', 'tradeid', 'size', 'executiontype', 'status',
+                   'dealid', 'workingorderid', 'dealreference', 'monitor')
+        rows = [[str(d[c]) for c in columns] for d in self.snapshot()]
+        widths = [max([len(c)] + [len(r[i]) for r in rows]) for i, c in enumerate(columns)]
+        lines = [' | '.join(c.ljust(w) for c, w in zip(columns, widths))]
+        lines += [' | '.join(v.ljust(w) for v, w in zip(r, widths)) for r in rows]
+        return '\n'.join(lines)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+###############################################################################
+#
+# 2023: Jelle Bloemsma, backtrader store functionality for Capital.com
+# based on https://github.com/mementum/backtrader
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import collections
+import threading
+import time
+
+from backtrader.utils.py3 import queue
+
+
+class QuoteQueue(object):
+    '''Bounded queue of live quotes with a conflation policy.
+
+    Policies:
+
+      - ``all``: every quote is delivered. When ``maxsize`` quotes are
+        waiting the oldest one is dropped
+
+      - ``latest``: a quote replaces the undelivered quote of its epic, the
+        consumer only sees the most recent prices
+
+      - ``snapshot``: like ``latest``, but the quotes are released together
+        every ``interval`` seconds (a top of book snapshot of all epics)
+
+    ``None`` (connection broken) is never conflated or dropped and is
+    delivered right away. ``notify`` is called with a message when quotes
+    start being dropped or conflated, i.e. when the consumer falls behind.
+
+    Like ``queue.Queue`` it offers ``put``, ``get`` and ``qsize``. It does
+    not define ``__len__`` so that an empty queue remains *true*.
+    '''
+    ALL, LATEST, SNAPSHOT = 'all', 'latest', 'snapshot'
+    POLICIES = (ALL, LATEST, SNAPSHOT)
+
+    def __init__(self, policy=ALL, maxsize=10000, interval=0.25, notify=None, name=''):
+        if policy not in self.POLICIES:
+            raise ValueError('unknown conflation policy {!r}'.format(policy))
+        self.policy = policy
+        self.maxsize = maxsize
+        self.interval = interval
+        self.notify = notify
+        self.name = name
+        self._cond = threading.Condition()
+        self._buf = collections.deque()  # [epic, quote, queued at]
+        self._slots = dict()  # epic -> undelivered entry of _buf (latest / snapshot)
+        self._release = 0.0  # snapshot: time of the next release
+        self._ready = 0  # snapshot: entries of the current release left
+        self._behind = False
+        self.received = self.delivered = self.dropped = self.conflated = 0
+        self.lag_max = self.lag_total = 0.0
+
+    def put(self, quote, block=True, timeout=None):
+        with self._cond:
+            now = time.monotonic()
+            if quote is not None:
+                self.received += 1
+                epic = quote.get('epic')
+                if self.policy != self.ALL:
+                    entry = self._slots.get(epic)
+                    if entry is not None:
+                        entry[1] = quote  # same place in the queue, newer prices
+                        self.conflated += 1
+                        self._fell_behind('conflating')
+                        return
+
+                if len(self._buf) >= self.maxsize:
+                    self._drop()
+
+                entry = [epic, quote, now]
+                if self.policy != self.ALL:
+                    self._slots[epic] = entry
+            else:
+                entry = [None, None, now]
+                self._ready = len(self._buf) + 1  # deliver everything up to it
+
+            self._buf.append(entry)
+            self._cond.notify()
+
+    def _drop(self):
+        for i, entry in enumerate(self._buf):
+            if entry[1] is not None:  # keep the connection markers
+                del self._buf[i]
+                if self._slots.get(entry[0]) is entry:
+                    del self._slots[entry[0]]
+                self.dropped += 1
+                self._ready = max(0, self._ready - 1)
+                self._fell_behind('dropping')
+                return
+
+    def _fell_behind(self, what):
+        if not self._behind:
+            self._behind = True
+            if self.notify is not None:
+                self.notify('Quotes {}: {} is falling behind'.format(what, self.name))
+
+    def get(self, block=True, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                wait = self._wait_time()
+                if wait == 0.0:
+                    break
+                if not block:
+                    raise queue.Empty
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0.0:
+                        raise queue.Empty
+                    wait = remaining if wait is None else min(wait, remaining)
+                self._cond.wait(wait)
+
+            entry = self._buf.popleft()
+            epic, quote, queued = entry
+            if self._slots.get(epic) is entry:
+                del self._slots[epic]
+            if self.policy == self.SNAPSHOT:
+                self._ready -= 1
+
+            if quote is not None:
+                self.delivered += 1
+                lag = time.monotonic() - queued
+                self.lag_total += lag
+                self.lag_max = max(self.lag_max, lag)
+            if not self._buf:
+                self._behind = False  # caught up
+            return quote
+
+    def _wait_time(self):
+        '''0.0 if an entry can be delivered, else the seconds to wait for it
+        (None: until something is put)'''
+        if not self._buf:
+            return None
+        if self.policy != self.SNAPSHOT or self._ready > 0:
+            return 0.0
+
+        now = time.monotonic()
+        if now < self._release:
+            return self._release - now
+        self._ready = len(self._buf)
+        self._release = now + self.interval
+        return 0.0
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def put_nowait(self, quote):
+        return self.put(quote, block=False)
+
+    def qsize(self):
+        with self._cond:
+            return len(self._buf)
+
+    def empty(self):
+        return not self.qsize()
+
+    def stats(self):
+        with self._cond:
+            return {'policy': self.policy, 'queued': len(self._buf),
+                    'received': self.received, 'delivered': self.delivered,
+                    'dropped': self.dropped, 'conflated': self.conflated,
+                    'lag_max': self.lag_max,
+                    'lag_avg': self.lag_total / self.delivered if self.delivered else 0.0}
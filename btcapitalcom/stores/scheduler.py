@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+###############################################################################
+#
+# 2023: Jelle Bloemsma, backtrader store functionality for Capital.com
+# based on https://github.com/mementum/backtrader
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import heapq
+import itertools
+import threading
+import time
+
+
+class Job(object):
+    '''A periodic job of the Scheduler, returned by ``every``'''
+    __slots__ = ('fn', 'interval', 'name', 'due', 'running', 'woken', 'cancelled')
+
+    def __init__(self, fn, interval, name):
+        self.fn = fn
+        self.interval = interval
+        self.name = name
+        self.due = None  # monotonic time of the next run
+        self.running = self.woken = self.cancelled = False
+
+
+class Scheduler(object):
+    '''Runs the periodic jobs of a store (keepalives, websocket pings,
+    account refreshes, order monitor polls) on a single thread.
+
+    The jobs are kept in a heap ordered by their next run time. A job
+    returns the seconds until its next run, or ``None`` to use its
+    ``interval``. ``wake`` runs a job as soon as possible (right after its
+    current run if it is running). A job should not block for long, it
+    holds back the others.
+
+    The thread is started with the first job. ``stop`` cancels all jobs and
+    ends the thread once the running job (if any) has returned. Exceptions
+    raised by a job are passed to ``notify`` (``print`` if not given).
+    '''
+
+    def __init__(self, notify=None, name='scheduler'):
+        self.notify = notify or print
+        self.name = name
+        self._cond = threading.Condition()
+        self._heap = []  # (due, seq, job), stale entries are skipped
+        self._seq = itertools.count()
+        self._thread = None
+        self._stopped = False
+
+    def every(self, interval, fn, name=None, delay=0.0):
+        '''Runs ``fn`` after ``delay`` seconds and then every ``interval``
+        seconds (or what it returns). Returns the Job'''
+        job = Job(fn, interval, name or getattr(fn, '__name__', 'job'))
+        with self._cond:
+            if self._stopped:
+                job.cancelled = True
+                return job
+            self._push(job, time.monotonic() + delay)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._t_run, name=self.name)
+                self._thread.daemon = True
+                self._thread.start()
+        return job
+
+    def wake(self, job):
+        '''Runs ``job`` now instead of at its scheduled time'''
+        if job is None:
+            return
+        with self._cond:
+            if job.cancelled or self._stopped:
+                return
+            if job.running:
+                job.woken = True  # rescheduled right away once it returns
+            elif job.due is None or job.due > time.monotonic():
+                self._push(job, time.monotonic())
+
+    def cancel(self, job):
+        if job is None:
+            return
+        with self._cond:
+            job.cancelled = True
+            job.due = None
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            for _, _, job in self._heap:
+                job.cancelled = True
+            del self._heap[:]
+            self._cond.notify()
+
+    def jobs(self):
+        '''(seconds until the next run, name) of the scheduled jobs'''
+        now = time.monotonic()
+        with self._cond:
+            return sorted((due - now, job.name) for due, _, job in self._heap
+                          if not job.cancelled and job.due == due)
+
+    def _push(self, job, due):
+        job.due = due
+        heapq.heappush(self._heap, (due, next(self._seq), job))
+        self._cond.notify()
+
+    def _t_run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopped:
+                        self._thread = None
+                        return
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+
+                    due, _, job = self._heap[0]
+                    if job.cancelled or job.due != due:
+                        heapq.heappop(self._heap)  # cancelled or rescheduled
+                        continue
+
+                    wait = due - time.monotonic()
+                    if wait <= 0.0:
+                        heapq.heappop(self._heap)
+                        job.due = None
+                        job.running = True
+                        job.woken = False
+                        break
+                    self._cond.wait(wait)
+
+            try:
+                delay = job.fn()
+            except Exception as e:
+                self.notify(e)  # a failing run does not stop the job
+                delay = None
+
+            with self._cond:
+                job.running = False
+                if job.cancelled or self._stopped:
+                    continue
+                if job.woken:
+                    delay = 0.0
+                elif delay is None:
+                    delay = job.interval
+                self._push(job, time.monotonic() + delay)
+
+
+class MarketHours(object):
+    '''Weekly opening hours of an instrument.
+
+    ``hours`` is the ``openingHours`` of the market details, e.g.
+    ``{'mon': ['00:00 - 21:00', '21:05 - 00:00'], ..., 'zone': 'UTC'}``. An
+    end time of ``00:00`` is midnight at the end of the day. The hours are
+    taken as UTC, the zone the API reports them in by default.
+    '''
+    DAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+    WEEK = 7 * 86400
+
+    def __init__(self, hours):
+        spans = []
+        for day, name in enumerate(self.DAYS):
+            for span in hours.get(name) or ():
+                begin, end = (self._secs(x) for x in span.split('-'))
+                if end <= begin:
+                    end += 86400  # till midnight (or past it)
+                spans.append([day * 86400 + begin, day * 86400 + end])
+
+        # join the spans continuing each other, also across days
+        spans.sort()
+        merged = []
+        for span in spans:
+            if merged and span[0] <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], span[1])
+            else:
+                merged.append(span)
+        if len(merged) > 1 and merged[-1][1] >= merged[0][0] + self.WEEK:
+            merged[-1][1] = merged.pop(0)[1] + self.WEEK  # sunday into monday
+        self.spans = merged
+
+    @staticmethod
+    def _secs(hhmm):
+        hh, mm = hhmm.strip().split(':')
+        return int(hh) * 3600 + int(mm) * 60
+
+    def _week_secs(self, when):
+        # the epoch was a thursday
+        return (when + 3 * 86400) % self.WEEK
+
+    def is_open(self, when=None):
+        now = self._week_secs(time.time() if when is None else when)
+        return any(b <= t < e for b, e in self.spans for t in (now, now + self.WEEK))
+
+    def next_change(self, when=None):
+        '''Seconds until the market opens or closes (``None`` if never)'''
+        if not self.spans:
+            return None
+        now = self._week_secs(time.time() if when is None else when)
+        changes = [x + k * self.WEEK for b, e in self.spans for x in (b, e) for k in (-1, 0, 1)]
+        return min(x - now for x in changes if x > now)
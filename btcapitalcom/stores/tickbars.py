@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+###############################################################################
+#
+# 2023: Jelle Bloemsma, backtrader store functionality for Capital.com
+# based on https://github.com/mementum/backtrader
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import collections
+import threading
+import time
+
+
+class BarBuilder(object):
+    '''Builds bars of ``seconds`` from ticks.
+
+    Bars are aligned on multiples of ``seconds`` since the epoch (UTC) and
+    hold the open, high, low and close of the bid, the ask and the mid price
+    and the number of ticks. A bar is completed by the first tick of a later
+    bar or by ``flush`` once the wall clock has passed its end, so that it is
+    not held back when the market is quiet.
+    '''
+    __slots__ = ('seconds', 'start', 'bid', 'ask', 'mid', 'ticks')
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.start = None
+
+    def update(self, ts, bid, ask):
+        '''Adds a tick (epoch seconds). Returns the bar it completed or None'''
+        start = ts - ts % self.seconds
+        done = None
+        if self.start is not None:
+            if start < self.start:
+                return None  # late tick of a completed bar
+            if start > self.start:
+                done = self._close()
+
+        mid = (bid + ask) / 2.0
+        if self.start is None:
+            self.start = start
+            self.bid = [bid, bid, bid, bid]
+            self.ask = [ask, ask, ask, ask]
+            self.mid = [mid, mid, mid, mid]
+            self.ticks = 1
+            return done
+
+        for ohlc, price in ((self.bid, bid), (self.ask, ask), (self.mid, mid)):
+            if price > ohlc[1]:
+                ohlc[1] = price
+            elif price < ohlc[2]:
+                ohlc[2] = price
+            ohlc[3] = price
+        self.ticks += 1
+        return done
+
+    def flush(self, now):
+        '''Returns the current bar if ``now`` is past its end'''
+        if self.start is not None and now >= self.start + self.seconds:
+            return self._close()
+        return None
+
+    def _close(self):
+        bar = {'start': self.start, 'seconds': self.seconds, 'ticks': self.ticks,
+               'bid': tuple(self.bid), 'ask': tuple(self.ask), 'mid': tuple(self.mid)}
+        self.start = None
+        return bar
+
+
+class TickAggregator(object):
+    '''Turns the quotes of one epic into bars of several timeframes.
+
+    It is registered with the Streamer in place of a quote queue. Every quote
+    updates the builders of all the requested timeframes in a single pass and
+    completed bars are put on the queues registered for their timeframe.
+    ``None`` (connection broken) is passed on to all queues and closes the
+    aggregator.
+    '''
+
+    def __init__(self, epic):
+        self.epic = epic
+        self.closed = False
+        self._lock = threading.Lock()
+        self._builders = dict()  # seconds -> BarBuilder
+        self._sinks = collections.defaultdict(list)  # seconds -> queues
+
+    def add(self, seconds, q):
+        with self._lock:
+            if seconds not in self._builders:
+                self._builders[seconds] = BarBuilder(seconds)
+            self._sinks[seconds].append(q)
+
+    def remove(self, q):
+        '''Removes the queue, returns True if the aggregator has none left'''
+        with self._lock:
+            for seconds, queues in list(self._sinks.items()):
+                if q in queues:
+                    queues.remove(q)
+                if not queues:
+                    del self._sinks[seconds]
+                    del self._builders[seconds]
+            return not self._sinks
+
+    def __contains__(self, q):
+        with self._lock:
+            return any(q in queues for queues in self._sinks.values())
+
+    def put(self, quote):
+        if quote is None:
+            with self._lock:
+                self.closed = True
+                queues = [q for qs in self._sinks.values() for q in qs]
+            for q in queues:
+                q.put(None)
+            return
+
+        ts = int(quote['timestamp']) / 1000.0
+        bid, ask = float(quote['bid']), float(quote['ofr'])
+        with self._lock:
+            bars = [bar for bar in (b.update(ts, bid, ask) for b in self._builders.values())
+                    if bar is not None]
+        self._deliver(bars)
+
+    def flush(self, now=None):
+        '''Completes the bars whose end has passed. Returns how many'''
+        now = time.time() if now is None else now
+        with self._lock:
+            bars = [bar for bar in (b.flush(now) for b in self._builders.values())
+                    if bar is not None]
+        self._deliver(bars)
+        return len(bars)
+
+    def _deliver(self, bars):
+        for bar in bars:
+            bar['epic'] = self.epic
+            for q in list(self._sinks.get(bar['seconds'], ())):
+                q.put(bar)
@@ -1,2 +1,11 @@
-from .client import Client, CapitalComConstants, DirectionType, OrderType, SourceType, StatusType, FilterType, TranslationType
+from .client import Client, CapitalComConstants, DirectionType, OrderType, SourceType, StatusType, FilterType, TranslationType, \
+    ResponseMode, Response, CapitalComError
+from .ratelimit import Priority, RateLimiter, get_default_limiter
+from .cache import TTLCache
+from .session import SessionCache
+from .confirms import ConfirmationWaiter, ConfirmationTimeout, confirm_async
 
+try:
+    from .aioclient import AsyncClient
+except ImportError:  # aiohttp is only required for the asyncio client
+    AsyncClient = None
@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+"""asyncio version of the Capital.com client.
+
+``AsyncClient`` offers the same methods as :class:`capitalcom.client.Client`
+as coroutines. All requests share one aiohttp connection pool, so a single
+event loop can drive many concurrent history requests and polls::
+
+    async with AsyncClient(log, pas, api_key, environment) as client:
+        pages = await asyncio.gather(*[
+            client.prices(epic, 'MINUTE', fr, to, 1000) for (fr, to) in windows])
+
+        async for quote in client.stream_quotes(['US100', 'BTCUSD']):
+            print(quote)
+"""
+import asyncio
+import json
+
+import aiohttp
+
+from .client import (CapitalComConstants, Client, DirectionType, OrderType,
+                     ResponseMode, TranslationType, make_result)
+from .transport import DEFAULT_POOL_MAXSIZE
+from .ratelimit import Priority, get_default_limiter
+
+
+class AsyncClient():
+    """
+    asyncio API for market Capital.com, mirroring capitalcom.client.Client
+
+    The session is opened with ``await client.login_session()`` or by using the
+    client as an async context manager. Unlike Client the default
+    ``response_mode`` is OBJECT: methods return the decoded json body and
+    raise CapitalComError on errors.
+    """
+
+    """Starting session"""
+    def __init__(self, log, pas, api_key, environment, session=None, pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                 response_mode=ResponseMode.OBJECT, timeout=None, rate_limiter=None):
+        """
+        ``session`` is an optional aiohttp.ClientSession to share its
+        connection pool with other clients. A new one limited to
+        ``pool_maxsize`` connections is created (and closed by ``close``)
+        if not given.
+
+        Requests are throttled by ``rate_limiter``, by default the limiter
+        shared with the synchronous clients of the process.
+        """
+        self.login = log
+        self.password = pas
+        self.api_key = api_key
+        self.environment = environment
+        self.response_mode = ResponseMode(response_mode)
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter or get_default_limiter()
+        self.session = session
+        self._own_session = session is None
+        self.cst = None
+        self.x_security_token = None
+        if self.environment == 'live':
+            CapitalComConstants.BASE_URL = 'https://api-capital.backend-capital.com/api/{}/'.format(
+                CapitalComConstants.API_VERSION
+            )
+
+    async def __aenter__(self):
+        await self.login_session()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def login_session(self):
+        """Fetch the encryption key, encrypt the password and open the session"""
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_maxsize),
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+        await self._acquire(Priority.SESSION)
+        async with self.session.get(CapitalComConstants.ENCRYPTION_KEY_ENDPOINT,
+                                    headers={'X-CAP-API-KEY': self.api_key}) as r:
+            _response = await r.json(content_type=None)
+
+        _password = Client.encryptPasswd(_response['encryptionKey'], _response['timeStamp'], self.password)
+
+        await self._acquire(Priority.SESSION)
+        async with self.session.post(CapitalComConstants.SESSION_ENDPOINT,
+                                     json={'identifier': self.login, 'password': _password,
+                                           'encryptedPassword': 'true'},
+                                     headers={'X-CAP-API-KEY': self.api_key}) as r:
+            if r.status == 200:
+                self.cst = r.headers['CST']
+                self.x_security_token = r.headers['X-SECURITY-TOKEN']
+            else:
+                print("Error occurred: ", await r.read())
+
+    async def close(self):
+        if self._own_session and self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    """Rest API Methods"""
+
+    async def _acquire(self, priority):
+        await self.rate_limiter.acquire_async(priority)
+
+    async def _request(self, method, url, priority, **kwargs):
+        for attempt in range(Client.MAX_RETRIES + 1):
+            await self._acquire(priority)
+            async with self.session.request(method, url, headers=self._get_headers(), **kwargs) as r:
+                if r.status == 429 and attempt < Client.MAX_RETRIES:
+                    try:
+                        retry_after = float(r.headers.get('Retry-After', 1))
+                    except ValueError:
+                        retry_after = 1.0
+                    self.rate_limiter.penalize(retry_after)
+                    continue
+
+                body = await r.json(content_type=None) if await r.read() else None
+                return make_result(self.response_mode, r.status, r.headers, body)
+
+    async def _get_with_headers(self, url, priority=Priority.ACCOUNT):
+        return await self._request('GET', url, priority)
+
+    async def _get_with_params_and_headers(self, url, priority=Priority.ACCOUNT, **kwargs):
+        # aiohttp refuses None values in the query string
+        params = {k: str(v).lower() if isinstance(v, bool) else v
+                  for k, v in kwargs.items() if v is not None}
+        return await self._request('GET', url, priority, params=params)
+
+    async def _post(self, url, priority=Priority.ORDER, **kwargs):
+        return await self._request('POST', url, priority, json=kwargs)
+
+    async def _delete(self, url, priority=Priority.ORDER, **kwargs):
+        return await self._request('DELETE', url, priority, json=kwargs)
+
+    async def _put(self, url, priority=Priority.ORDER, **kwargs):
+        return await self._request('PUT', url, priority, json=kwargs)
+
+    """Headers"""
+    def _get_headers(self, **kwargs):
+        return {
+                **kwargs,
+                'CST': self.cst,
+                'X-SECURITY-TOKEN': self.x_security_token
+            }
+
+    """ping"""
+    async def keepalive_ping(self):
+        return await self._get_with_headers(CapitalComConstants.PING_INFORMATION_ENDPOINT, Priority.SESSION)
+
+    """SESSION"""
+    async def get_sesion_details(self):
+        return await self._get_with_headers(CapitalComConstants.SESSION_ENDPOINT, Priority.SESSION)
+
+    async def switch_account(self, accountId):
+        return await self._put(CapitalComConstants.SESSION_ENDPOINT, Priority.SESSION, accountId=accountId)
+
+    async def log_out_account(self):
+        return await self._delete(CapitalComConstants.SESSION_ENDPOINT, Priority.SESSION)
+
+    """ACCOUNTS"""
+    async def all_accounts(self):
+        return await self._get_with_headers(CapitalComConstants.ACCOUNTS_ENDPOINT)
+
+    async def account_preferences(self):
+        return await self._get_with_headers(CapitalComConstants.ACCOUNT_PREFERENCES_ENDPOINT)
+
+    async def update_account_preferences(self, leverages: dict = None, hedgingmode: bool = None):
+        return await self._put(
+            CapitalComConstants.ACCOUNT_PREFERENCES_ENDPOINT,
+            Priority.ACCOUNT,
+            leverages=leverages,
+            hedgingMode=hedgingmode
+        )
+
+    async def account_activity_history(self,
+                                       fr: str,
+                                       to: str,
+                                       last_period: int = 600,
+                                       detailed: bool = True,
+                                       dealid: str = None,
+                                       epic: str = None,
+                                       filter: str = None):
+        return await self._get_with_params_and_headers(
+            CapitalComConstants.ACCOUNT_ACTIVITY_HISTORY_ENDPOINT,
+            f=fr,
+            to=to,
+            lastPeriod=last_period,
+            detailed=detailed,
+            dealId=dealid,
+            epic=epic,
+            filter=filter
+        )
+
+    async def account_transaction_history(self,
+                                          fr: str,
+                                          to: str,
+                                          last_period: int = 600,
+                                          type: TranslationType = None):
+        return await self._get_with_params_and_headers(
+            CapitalComConstants.ACCOUNT_TRANSACTION_HISTORY_ENDPOINT,
+            f=fr,
+            to=to,
+            lastPeriod=last_period,
+            type=type.value
+        )
+
+    """MARKETS"""
+    async def market_categories(self):
+        return await self._get_with_headers(CapitalComConstants.MARKET_NAVIGATION_ENDPOINT, Priority.HISTORY)
+
+    async def market_sub_nodes(self, nodeid: str):
+        return await self._get_with_headers(CapitalComConstants.MARKET_NAVIGATION_ENDPOINT + '/' + nodeid,
+                                            Priority.HISTORY)
+
+    async def market_details(self, epics: str):
+        return await self._get_with_headers(CapitalComConstants.MARKET_INFORMATION_ENDPOINT + '?epics=' + epics)
+
+    """PRICES"""
+    async def prices(self, epic, granularity, start_date, end_date, max):
+        return await self._get_with_headers(
+            CapitalComConstants.PRICES_INFORMATION_ENDPOINT + '/' + epic + '?' +
+            'resolution=' + granularity +
+            '&max=' + str(max) +
+            '&from=' + start_date +
+            '&to=' + end_date,
+            Priority.HISTORY,
+        )
+
+    """POSITIONS"""
+    async def position_order_confirmation(self, deal_reference: str):
+        return await self._get_with_headers(CapitalComConstants.ACCOUNT_ORDER_CONFIRMATION + '/' + deal_reference,
+                                            Priority.ORDER)
+
+    async def all_positions(self):
+        return await self._get_with_headers(CapitalComConstants.POSITIONS_ENDPOINT)
+
+    async def place_the_position(self,
+                                 direction: DirectionType,
+                                 epic: str,
+                                 type: str,
+                                 size: float,
+                                 gsl: bool = False,
+                                 tsl: bool = False,
+                                 stop_level: float = None,
+                                 stop_distance: float = None,
+                                 stop_amount: float = None,
+                                 profit_level: float = None,
+                                 profit_distance: float = None,
+                                 profit_amount: float = None):
+        return await self._post(
+            CapitalComConstants.POSITIONS_ENDPOINT,
+            direction=direction.value,
+            epic=epic,
+            size=size,
+            guaranteedStop=gsl,
+            trailingStop=tsl,
+            stopLevel=stop_level,
+            stopDistance=stop_distance,
+            stopAmount=stop_amount,
+            profitLevel=profit_level,
+            profitDistance=profit_distance,
+            profitAmount=profit_amount
+        )
+
+    async def check_position(self, dealid: str):
+        return await self._get_with_headers(CapitalComConstants.POSITIONS_ENDPOINT + '/' + dealid)
+
+    async def update_the_position(self,
+                                  dealid: str,
+                                  gsl: bool = False,
+                                  tsl: bool = False,
+                                  stop_level: float = None,
+                                  stop_distance: float = None,
+                                  stop_amount: float = None,
+                                  profit_level: float = None,
+                                  profit_distance: float = None,
+                                  profit_amount: float = None):
+        return await self._put(
+            CapitalComConstants.POSITIONS_ENDPOINT + '/' + dealid,
+            guaranteedStop=gsl,
+            trailingStop=tsl,
+            stopLevel=stop_level,
+            stopDistance=stop_distance,
+            stopAmount=stop_amount,
+            profitLevel=profit_level,
+            profitDistance=profit_distance,
+            profitAmount=profit_amount
+        )
+
+    async def close_position(self, dealid):
+        return await self._delete(CapitalComConstants.POSITIONS_ENDPOINT + '/' + dealid)
+
+    """ORDER"""
+    async def all_orders(self):
+        return await self._get_with_headers(CapitalComConstants.ORDERS_ENDPOINT)
+
+    async def place_the_order(self,
+                              direction: DirectionType,
+                              epic: str,
+                              size: float,
+                              level: float,
+                              type: OrderType,
+                              gsl: bool = False,
+                              tsl: bool = False,
+                              good_till_date: str = None,
+                              stop_level: float = None,
+                              stop_distance: float = None,
+                              stop_amount: float = None,
+                              profit_level: float = None,
+                              profit_distance: float = None,
+                              profit_amount: float = None):
+        return await self._post(
+            CapitalComConstants.ORDERS_ENDPOINT,
+            direction=direction.value,
+            epic=epic,
+            size=size,
+            level=level,
+            type=type.value,
+            goodTillDate=good_till_date,
+            guaranteedStop=gsl,
+            trailingStop=tsl,
+            stopLevel=stop_level,
+            stopDistance=stop_distance,
+            stopAmount=stop_amount,
+            profitLevel=profit_level,
+            profitDistance=profit_distance,
+            profitAmount=profit_amount
+        )
+
+    async def update_the_order(self,
+                               level: float = None,
+                               good_till_date: str = None,
+                               gsl: bool = False,
+                               tsl: bool = False,
+                               stop_level: float = None,
+                               stop_distance: float = None,
+                               stop_amount: float = None,
+                               profit_level: float = None,
+                               profit_distance: float = None,
+                               profit_amount: float = None):
+        return await self._put(
+            CapitalComConstants.ORDERS_ENDPOINT,
+            level=level,
+            goodTillDate=good_till_date,
+            guaranteedStop=gsl,
+            trailingStop=tsl,
+            stopLevel=stop_level,
+            stopDistance=stop_distance,
+            stopAmount=stop_amount,
+            profitLevel=profit_level,
+            profitDistance=profit_distance,
+            profitAmount=profit_amount
+        )
+
+    async def close_order(self, dealid):
+        return await self._delete(CapitalComConstants.ORDERS_ENDPOINT + '/' + dealid)
+
+    """STREAMING"""
+    def _ws_message(self, destination, correlation_id, payload=None):
+        msg = {'destination': destination,
+               'correlationId': str(correlation_id),
+               'cst': self.cst,
+               'securityToken': self.x_security_token}
+        if payload is not None:
+            msg['payload'] = payload
+        return msg
+
+    async def stream_quotes(self, epics, ping_interval=45):
+        """
+        Async generator yielding the quote payloads of ``epics``
+        {
+        "epic": "BTCUSD",
+        "product": "CFD",
+        "bid": 43095.5,
+        "bidQty": 1.0,
+        "ofr": 43125.5,
+        "ofrQty": 1.0,
+        "timestamp": 1707470000000
+        }
+        A websocket ping is sent every ``ping_interval`` seconds to keep the
+        socket open when the markets don't provide quotes. The generator
+        ends when the socket is closed.
+        """
+        if isinstance(epics, str):
+            epics = [epics]
+
+        async with self.session.ws_connect(CapitalComConstants.WSS_URL) as ws:
+            await ws.send_json(self._ws_message('marketData.subscribe', 1, {'epics': list(epics)}))
+
+            async def ping():
+                while True:
+                    await asyncio.sleep(ping_interval)
+                    await ws.send_json(self._ws_message('ping', 2))
+
+            pinger = asyncio.ensure_future(ping())
+            try:
+                async for message in ws:
+                    if message.type != aiohttp.WSMsgType.TEXT:
+                        break
+                    msg = json.loads(message.data)
+                    if msg.get('status') == 'OK' and msg.get('destination') == 'quote':
+                        yield msg['payload']
+            finally:
+                pinger.cancel()
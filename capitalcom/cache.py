@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""Size bounded TTL cache for rarely changing Capital.com endpoints.
+
+Market details, the market navigation tree and the account preferences
+change rarely, but are requested by every feed at start and by every run of
+the navigation crawl. :class:`TTLCache` keeps their responses for a per
+endpoint time to live. It evicts the least recently used entries when
+``maxsize`` is exceeded and can be persisted to a json file so that a
+restart begins with a warm cache.
+"""
+import atexit
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache():
+    """Thread safe LRU cache whose entries expire after their own ttl.
+
+    Parameters
+    ----------
+
+    maxsize : int (optional)
+        maximum number of entries, the least recently used are evicted first
+
+    path : string (optional)
+        json file the cache is loaded from at creation and saved to
+        ``save_delay`` seconds after a change (and at exit). ``None`` keeps
+        the cache in memory only
+
+    save_delay : float (optional)
+        seconds the save waits for more changes, a burst of inserts (e.g. a
+        navigation crawl) is written once
+
+    Keys are tuples of json serializable values. Expiry uses the wall clock
+    so that persisted entries remain valid across restarts.
+    """
+
+    def __init__(self, maxsize=512, path=None, save_delay=5.0):
+        self.maxsize = maxsize
+        self.path = path
+        self.save_delay = save_delay
+        self._lock = threading.RLock()
+        self._save_lock = threading.Lock()  # one writer of the file at a time
+        self._data = collections.OrderedDict()  # key -> (expires, value)
+        self._timer = None  # pending save
+        self.hits = self.misses = self.evictions = 0
+        if path is not None:
+            self.load()
+            atexit.register(self.flush)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (time.time() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+            self._changed()
+
+    def invalidate(self, endpoint=None):
+        """Remove all entries (``endpoint=None``) or those whose key starts
+        with ``endpoint``"""
+        with self._lock:
+            if endpoint is None:
+                self._data.clear()
+            else:
+                for key in [k for k in self._data if k[0] == endpoint]:
+                    del self._data[key]
+            self._changed()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._data), 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+    def _changed(self):
+        # under the lock
+        if self.path is not None and self._timer is None:
+            self._timer = threading.Timer(self.save_delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        """Saves the cache now if a save is pending"""
+        with self._lock:
+            if self._timer is None:
+                return
+        self.save()
+
+    def save(self):
+        with self._save_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                now = time.time()
+                entries = [[list(k), e[0], e[1]] for k, e in self._data.items() if e[0] >= now]
+
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as file:
+                json.dump(entries, file)
+            os.replace(tmp, self.path)  # never leave a half written cache
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as file:
+                entries = json.load(file)
+        except (OSError, ValueError) as e:
+            logger.info("cache %s not loaded: %s", self.path, e)
+            return
+
+        now = time.time()
+        with self._lock:
+            for key, expires, value in entries:
+                if expires >= now:
+                    self._data[tuple(key)] = (expires, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
@@ -1,6 +1,9 @@
 import capitalcom.client
+from capitalcom.contrib.columnar import CandleBatch
 from capitalcom.contrib.factories import EpicCandlesFactory
+from capitalcom.contrib.timeconv import format_rfc3339_array
 import threading
+import numpy as np
 import pandas as pd
 import json
 import time
@@ -36,8 +39,7 @@ def ping_function():
             print("Finishing ping thread.")
 
 def getnodes(nodeid):
-    rv = CAPI.market_sub_nodes(nodeid)
-    sub_nodes = json.loads(rv)
+    sub_nodes = CAPI.market_sub_nodes(nodeid)
     return sub_nodes
 
 
@@ -49,7 +51,10 @@ account = config["capitalcom"]["account"]
 password = config["capitalcom"]["password"]
 environment = config["capitalcom"]["environment"]
 
-CAPI = capitalcom.client.Client(account, password, apikey, environment)
+#market navigation responses are cached (and kept on disk) so that a rerun doesn't request them again
+CAPI = capitalcom.client.Client(account, password, apikey, environment,
+                                response_mode=capitalcom.client.ResponseMode.OBJECT,
+                                cache=capitalcom.TTLCache(maxsize=4096, path=path + 'capitalcom_cache.json'))
 
 sessionrunning = True
 x = threading.Thread(target=ping_function, args=())
@@ -59,14 +64,13 @@ x.start()
 
 #Write a csv file listing all accounts to the data directory
 rv = CAPI.all_accounts()
-accounts = pd.read_json(rv)
+accounts = pd.DataFrame(rv)
 accounts.to_csv(path + 'capitalcom_accounts_' + environment + '.csv', index=False)
 
 
 if get_instruments:
     result_list = []
-    rv = CAPI.market_categories()
-    nodes0 = json.loads(rv)
+    nodes0 = CAPI.market_categories()
 
     for node0 in nodes0['nodes']:
         nodeid = (node0['id'])
@@ -85,9 +89,8 @@ if get_instruments:
                 level_response = pd.json_normalize(nodes2, record_path=['nodes'])
                 if len(nodes2['nodes']) > 0:
                     for node2 in nodes2['nodes']:
+                        # the client's rate limiter prevents hitting the 10 api calls per second limit
                         nodes3 = getnodes(node2['id'])
-                        'add a sleep timer to prevent hitting the 10 api calls per second limit'
-                        time.sleep(0.100)
                         if len(nodes3) > 1:
                             level_response = pd.json_normalize(nodes3, record_path=['markets'])
                             result_list.append(level_response)
@@ -102,43 +105,30 @@ if download:
        "from": _from,
        "to": _to,
     }
-    if export_format_forextester:
-        for epic in epics:
-            # The factory returns a generator generating consecutive
-            # requests to retrieve full history from date '_from' till '_to'
-            df = pd.DataFrame()
-            for rv in EpicCandlesFactory(CAPI, epic=epic, params=params):
-                #check if there is real candle data in the calls. We dont want to stop processing in case of a
-                #{"errorCode":"error.prices.not-found"} which is thrown if part of the data is not available.
-                if not "errorCode" in rv:
-                    data = json.loads(rv)
-                    results = [{"date": x['snapshotTimeUTC'][0:10].replace("-","."), "time": x['snapshotTimeUTC'][11:16],"open": float(x['openPrice'][bidask]), "high": float(x['highPrice'][bidask]),
-                                "low": float(x['lowPrice'][bidask]), "close": float(x['closePrice'][bidask]), "volume": int(x['lastTradedVolume'])} for x in
-                               data['prices']]
-                if len(results) > 0:
-                    tmp_df = pd.DataFrame(results)
-                    #use df = df.append(tmp_df) for panda version < 2.0
-                    df = pd.concat([df, tmp_df])
-                    print("last candle: " + df['date'].iloc[-1] + " " + df['time'].iloc[-1])
-    else:
-        for epic in epics:
-            # The factory returns a generator generating consecutive
-            # requests to retrieve full history from date '_from' till '_to'
-            df = pd.DataFrame()
-            for rv in EpicCandlesFactory(CAPI, epic=epic, params=params):
-                #check if there is real candle data in the calls. We dont want to stop processing in case of a
-                #{"errorCode":"error.prices.not-found"} which is thrown if part of the data is not available.
-                if not "errorCode" in rv:
-                    data = json.loads(rv)
-                    results = [{"time": x['snapshotTimeUTC'], "open": float(x['openPrice'][bidask]), "high": float(x['highPrice'][bidask]),
-                                "low": float(x['lowPrice'][bidask]), "close": float(x['closePrice'][bidask]), "volume": float(x['lastTradedVolume'])} for x in
-                               data['prices']]
-                if len(results) > 0:
-                    tmp_df = pd.DataFrame(results)
-                    # use df = df.append(tmp_df) for panda version < 2.0
-                    df = pd.concat([df, tmp_df])
-                    print("last candle: " + df['time'].iloc[-1])
-
-    print('writing: ' + path + 'capitalcom_' + epic + '_' + resolution + '.csv')
-    df.to_csv(path + 'capitalcom_' + epic + '_' + resolution + '.csv', index=False)
-
+    for epic in epics:
+        # The factory returns a generator generating consecutive
+        # requests to retrieve full history from date '_from' till '_to'
+        frames = []
+        for data in EpicCandlesFactory(CAPI, epic=epic, params=params):
+            # pages with {"errorCode":"error.prices.not-found"}, thrown if part of the data is not
+            # available, are skipped by the factory
+            if len(data['prices']) == 0:
+                continue
+            # convert the whole page at once instead of formatting every candle
+            batch = CandleBatch.from_candles(data['prices'])
+            ohlc = batch.prices(bidask)
+            stamps = format_rfc3339_array(batch.time)
+            if export_format_forextester:
+                columns = {"date": np.char.replace(stamps.astype('U10'), "-", "."),
+                           "time": np.char.partition(stamps.astype('U16'), "T")[:, 2]}
+            else:
+                columns = {"time": stamps}
+            for i, name in enumerate(("open", "high", "low", "close")):
+                columns[name] = ohlc[:, i]
+            columns["volume"] = batch.volume.astype(int) if export_format_forextester else batch.volume
+            frames.append(pd.DataFrame(columns))
+            print("last candle: " + stamps[-1])
+        df = pd.concat(frames) if frames else pd.DataFrame()
+
+        print('writing: ' + path + 'capitalcom_' + epic + '_' + resolution + '.csv')
+        df.to_csv(path + 'capitalcom_' + epic + '_' + resolution + '.csv', index=False)
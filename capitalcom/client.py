@@ -29,16 +29,21 @@
 #
 ###############################################################################
 from enum import Enum
-import requests
 import json
 
 from Cryptodome.Cipher import PKCS1_v1_5
 from Cryptodome.PublicKey import RSA
 import base64
+import contextlib
+import copy
+import threading
 
 #from websocket import create_connection
 import websocket
 
+from .transport import Transport, DEFAULT_POOL_MAXSIZE
+from .ratelimit import Priority, get_default_limiter
+
 class CapitalComConstants():
     HEADER_API_KEY_NAME = 'X-CAP-API-KEY'
     API_VERSION = 'v1'
@@ -123,6 +128,56 @@ class TranslationType(Enum):
     BONUS = 'BONUS'
     TRANSFER = 'TRANSFER'
 
+class ResponseMode(Enum):
+    TEXT = 'text'          # pretty printed json string (legacy)
+    OBJECT = 'object'      # decoded json body (dict / list)
+    RESPONSE = 'response'  # Response carrying status code, headers and body
+
+
+class Response():
+    """Lightweight typed response: status code, headers and decoded body"""
+    __slots__ = ('status_code', 'headers', 'body')
+
+    def __init__(self, status_code, headers, body):
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+
+    @property
+    def ok(self):
+        return self.status_code < 400 and not (isinstance(self.body, dict) and 'errorCode' in self.body)
+
+    def __repr__(self):
+        return 'Response(status_code={}, body={!r})'.format(self.status_code, self.body)
+
+
+class CapitalComError(Exception):
+    """
+    Raised in the OBJECT and RESPONSE modes when Capital.com answers with an
+    error, e.g. {"errorCode": "error.prices.not-found"}
+    """
+    def __init__(self, response):
+        self.response = response
+        self.status_code = response.status_code
+        body = response.body
+        self.error_code = body.get('errorCode') if isinstance(body, dict) else None
+        super(CapitalComError, self).__init__(
+            '{} {}'.format(self.status_code, self.error_code or body))
+
+
+def make_result(response_mode, status_code, headers, body):
+    """Shape a decoded response according to ``response_mode``"""
+    if response_mode is ResponseMode.TEXT:
+        return json.dumps(body, indent=4)
+
+    response = Response(status_code, headers, body)
+    if not response.ok:
+        raise CapitalComError(response)
+    if response_mode is ResponseMode.RESPONSE:
+        return response
+    return response.body
+
+
 class Client():
     """
     This is API for market Capital.com
@@ -131,7 +186,43 @@ class Client():
     """
 
     """Starting session"""
-    def __init__(self, log, pas, api_key, environment):
+    def __init__(self, log, pas, api_key, environment, transport=None, pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                 response_mode=ResponseMode.TEXT, rate_limiter=None, cache=None, cache_ttl=None,
+                 session_cache=None, timeout=None):
+        """
+        All REST calls go through ``transport`` (a pooled keep-alive
+        ``capitalcom.transport.Transport``). A new one holding up to
+        ``pool_maxsize`` persistent connections and the request ``timeout``
+        (seconds, ``None`` waits forever) is created if not given. The
+        transport can be shared by several clients and threads.
+
+        ``response_mode`` (a ResponseMode or its value) controls what the
+        API methods return:
+        - TEXT: the pretty printed json string (legacy behaviour)
+        - OBJECT: the decoded json body, errors raise CapitalComError
+        - RESPONSE: a Response, errors raise CapitalComError
+
+        Every request waits for a token of ``rate_limiter``
+        (capitalcom.ratelimit.RateLimiter), by default the limiter shared by
+        all clients of the process. Order requests are served before
+        polling and history requests.
+
+        With a ``cache`` (capitalcom.cache.TTLCache) the responses of
+        market_details, market_categories, market_sub_nodes and
+        account_preferences are kept for the time (secs) given per endpoint
+        in CACHE_TTL, which ``cache_ttl`` can override.
+
+        With a ``session_cache`` (capitalcom.session.SessionCache) the tokens
+        of a previous session are validated with a single ping and reused;
+        the RSA login is only done when they are no longer accepted.
+        """
+        self.transport = transport or Transport(pool_maxsize=pool_maxsize, timeout=timeout)
+        self.rate_limiter = rate_limiter or get_default_limiter()
+        self._local = threading.local()
+        self.cache = cache
+        self.cache_ttl = dict(self.CACHE_TTL, **(cache_ttl or {}))
+        self.session_cache = session_cache
+        self.response_mode = ResponseMode(response_mode)
         self.login = log
         self.password = pas
         self.api_key = api_key
@@ -141,9 +232,83 @@ class Client():
                 CapitalComConstants.API_VERSION
             )
 
-        self.session = requests.Session()
-        self.response = self.session.get(
+        self.session = self.transport.session
+        self.cst = None
+        self.x_security_token = None
+        self.account_id = None
+        self._saved_session = None  # (cst, x_security_token, account_id) in the session cache
+        if not self._resume_session():
+            self.open_session()
+
+    def _session_key(self):
+        return '{}:{}'.format(self.environment, self.login)
+
+    def _resume_session(self):
+        if self.session_cache is None:
+            return False
+
+        cached = self.session_cache.load(self._session_key())
+        if cached is None:
+            return False
+
+        self.cst = cached['cst']
+        self.x_security_token = cached['x_security_token']
+        self.account_id = cached.get('account_id')
+        self._saved_session = (self.cst, self.x_security_token, self.account_id)
+        if self.validate_session():
+            return True
+
+        self.session_cache.discard(self._session_key())
+        return False
+
+    def _save_session(self):
+        if self.session_cache is None or self.cst is None:
+            return
+        session = (self.cst, self.x_security_token, self.account_id)
+        if session == self._saved_session:
+            self.session_cache.touch(self._session_key())  # extends the expiry
+            return
+        self.session_cache.save(self._session_key(), *session)
+        self._saved_session = session
+
+    def validate_session(self):
+        """Returns True if the current tokens are accepted (single ping)"""
+        if self.cst is None:
+            return False
+        try:
+            r = self._get_with_headers(CapitalComConstants.PING_INFORMATION_ENDPOINT, priority=Priority.SESSION)
+        except Exception:
+            return False
+        if r.status_code != 200:
+            return False
+        self._save_session()
+        return True
+
+    def reconnect(self):
+        """
+        Make sure the session is usable: keep it if the tokens are still
+        accepted, otherwise log in again. Returns True when a new session had
+        to be opened (the active account may then have to be switched again),
+        raises CapitalComError when the login failed
+        """
+        if self.validate_session():
+            return False
+        self.open_session()
+        r = self.response
+        if r.status_code != 200:
+            try:
+                body = r.json()
+            except ValueError:
+                body = r.text
+            raise CapitalComError(Response(r.status_code, r.headers, body))
+        return True
+
+    def open_session(self):
+        """Fetch the encryption key, encrypt the password and open the session"""
+        self.response = self._request(
+            'GET',
             CapitalComConstants.ENCRYPTION_KEY_ENDPOINT,
+            Priority.SESSION,
             headers={'X-CAP-API-KEY': self.api_key}
         )
         _response = self.response.content.decode('utf-8')
@@ -151,18 +316,20 @@ class Client():
         _encryptionKey = _response['encryptionKey']
         timestamp = _response['timeStamp']
 
-        _password = self.encryptPasswd(_encryptionKey, timestamp, pas)
-
+        _password = self.encryptPasswd(_encryptionKey, timestamp, self.password)
 
-        self.session = requests.Session()
-        self.response = self.session.post(
+        self.response = self._request(
+            'POST',
             CapitalComConstants.SESSION_ENDPOINT,
+            Priority.SESSION,
             json={'identifier': self.login, 'password': _password, 'encryptedPassword': 'true'},
             headers={'X-CAP-API-KEY': self.api_key}
         )
         if self.response.status_code == 200:
             self.cst = self.response.headers['CST']
             self.x_security_token = self.response.headers['X-SECURITY-TOKEN']
+            self.account_id = self.response.json().get('currentAccountId')
+            self._save_session()
         else:
             print ("Error occurred: ", self.response.content)
 
@@ -182,32 +349,123 @@ class Client():
         ciphertext = bytes.decode(base64.b64encode(cipher.encrypt(input)))
         return ciphertext
 
-    """Rest API Methods"""
-
-    def _get(self, url, **kwargs):
-        return requests.get(url, **kwargs)
+    """Connection pool"""
+    def pool_stats(self):
+        """
+        Returns the statistics of the keep-alive connection pool
+        {
+        "requests": 120,
+        "hits": 118,
+        "new_connections": 2,
+        "wait_time": 0.0,
+        "max_wait": 0.0
+        }
+        """
+        return self.transport.stats.snapshot()
 
-    def _get_with_headers(self, url, **kwargs):
-        return requests.get(url, **kwargs, headers=self._get_headers())
+    """Rate limiting"""
+    @contextlib.contextmanager
+    def priority(self, priority):
+        """
+        Run the requests of the calling thread with ``priority`` instead of
+        the default priority of each endpoint, e.g. to poll confirmations
+        at account polling priority:
 
-    def _get_with_params_and_headers(self, url, **kwargs):
-        return requests.get(url, params=self._get_params(**kwargs), headers=self._get_headers())
+        with client.priority(Priority.ACCOUNT):
+            client.position_order_confirmation(deal_reference)
+        """
+        previous = getattr(self._local, 'priority', None)
+        self._local.priority = priority
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+
+    def rate_limit_stats(self):
+        return self.rate_limiter.stats()
+
+    """Metadata cache"""
+    CACHE_TTL = {
+        'market_details': 3600,  # note: its 'snapshot' prices are as old as the entry
+        'market_categories': 86400,
+        'market_sub_nodes': 86400,
+        'account_preferences': 600,
+    }
+
+    def _cached(self, endpoint, key, fetch):
+        if self.cache is None:
+            return self._result(fetch())
+
+        key = (endpoint, self.environment) + key
+        entry = self.cache.get(key)
+        if entry is None:
+            r = fetch()
+            if r.status_code != 200:
+                return self._result(r)
+            entry = (r.status_code, dict(r.headers), r.json())
+            self.cache.set(key, entry, self.cache_ttl[endpoint])
+
+        status_code, headers, body = entry
+        # callers may modify the returned objects, keep the cached one intact
+        return make_result(self.response_mode, status_code, headers, copy.deepcopy(body))
+
+    def invalidate_cache(self, endpoint=None):
+        """Drop the cached responses of ``endpoint`` (e.g. 'market_details') or all"""
+        if self.cache is not None:
+            self.cache.invalidate(endpoint)
+
+    def cache_stats(self):
+        return self.cache.stats() if self.cache is not None else None
 
-    def _post(self, url, **kwargs):
-        return requests.post(url, 
+    """Rest API Methods"""
+    MAX_RETRIES = 3  # retries of a request answered with 429 (too many requests)
+
+    def _request(self, method, url, priority, **kwargs):
+        if getattr(self._local, 'priority', None) is not None:
+            priority = self._local.priority
+        for attempt in range(self.MAX_RETRIES + 1):
+            self.rate_limiter.acquire(priority)
+            r = self.transport.request(method, url, **kwargs)
+            if r.status_code != 429 or attempt == self.MAX_RETRIES:
+                return r
+
+            try:
+                retry_after = float(r.headers.get('Retry-After', 1))
+            except ValueError:
+                retry_after = 1.0
+            self.rate_limiter.penalize(retry_after)
+
+    def _get(self, url, priority=Priority.ACCOUNT, **kwargs):
+        return self._request('GET', url, priority, **kwargs)
+
+    def _get_with_headers(self, url, priority=Priority.ACCOUNT, **kwargs):
+        return self._request('GET', url, priority, **kwargs, headers=self._get_headers())
+
+    def _get_with_params_and_headers(self, url, priority=Priority.ACCOUNT, **kwargs):
+        return self._request('GET', url, priority, params=self._get_params(**kwargs), headers=self._get_headers())
+
+    def _post(self, url, priority=Priority.ORDER, **kwargs):
+        return self._request('POST', url, priority,
                                 json=self._get_body_parameters(**kwargs),
                                 headers=self._get_headers())
 
-    def _delete(self, url, **kwargs):
-        return requests.delete(url,
+    def _delete(self, url, priority=Priority.ORDER, **kwargs):
+        return self._request('DELETE', url, priority,
                             json=self._get_body_parameters(**kwargs),
                             headers=self._get_headers())
 
-    def _put(self, url, **kwargs):
-        return requests.put(url,
+    def _put(self, url, priority=Priority.ORDER, **kwargs):
+        return self._request('PUT', url, priority,
                             json=self._get_body_parameters(**kwargs),
                             headers=self._get_headers())
 
+    """Responses"""
+    def _result(self, r):
+        if self.response_mode is ResponseMode.TEXT:
+            return json.dumps(r.json(), indent=4)
+
+        return make_result(self.response_mode, r.status_code, r.headers, r.json() if r.content else None)
+
     """Headers"""
     def _get_headers(self, **kwargs):
         return {
@@ -233,8 +491,11 @@ class Client():
     def keepalive_ping(self):
         r = self._get_with_headers(
             CapitalComConstants.PING_INFORMATION_ENDPOINT,
+            priority=Priority.SESSION,
         )
-        return json.dumps(r.json(), indent=4)
+        if r.status_code == 200:
+            self._save_session()
+        return self._result(r)
 
     """SESSION"""
     def get_sesion_details(self): 
@@ -251,9 +512,10 @@ class Client():
         """
         r = self._get_with_headers(
             CapitalComConstants.SESSION_ENDPOINT,
+            priority=Priority.SESSION,
         )
 
-        return json.dumps(r.json(), indent=4)
+        return self._result(r)
 
 
     def switch_account(self, accountId): 
@@ -268,15 +530,24 @@ class Client():
         """
         r = self._put(
             CapitalComConstants.SESSION_ENDPOINT,
+            priority=Priority.SESSION,
             accountId=accountId,
         )
-        return json.dumps(r.json(), indent=4)
+        self.invalidate_cache('account_preferences')
+        if r.status_code == 200:
+            self.account_id = accountId
+            self._save_session()
+        return self._result(r)
     
     def log_out_account(self):
         r = self._delete(
             CapitalComConstants.SESSION_ENDPOINT,
+            priority=Priority.SESSION,
         )
-        return json.dumps(r.json(), indent=4)
+        if self.session_cache is not None:
+            self.session_cache.discard(self._session_key())
+            self._saved_session = None
+        return self._result(r)
     
     """ACCOUNTS"""
     def all_accounts(self): 
@@ -317,26 +588,27 @@ class Client():
         r = self._get_with_headers(
             CapitalComConstants.ACCOUNTS_ENDPOINT,
         )
-        if r.status_code != 200:
+        if r.status_code != 200 and self.response_mode is ResponseMode.TEXT:
             print(r.reason)
         else:
-            return json.dumps(r.json(), indent=4)
+            return self._result(r)
 
 
     def account_preferences(self): 
-        r = self._get_with_headers(
+        return self._cached('account_preferences', (self.login,), lambda: self._get_with_headers(
             CapitalComConstants.ACCOUNT_PREFERENCES_ENDPOINT,
-        )
-        return json.dumps(r.json(), indent=4)
+        ))
 
 
     def update_account_preferences(self, leverages: dict = None, hedgingmode: bool = None): 
         r = self._put(
             CapitalComConstants.ACCOUNT_PREFERENCES_ENDPOINT,
+            priority=Priority.ACCOUNT,
             leverages=leverages,
             hedgingMode=hedgingmode
         )
-        return json.dumps(r.json(), indent=4)
+        self.invalidate_cache('account_preferences')
+        return self._result(r)
 
 
     def account_activity_history(self, 
@@ -359,7 +631,7 @@ class Client():
             epic=epic,
             filter=filter
         )
-        return json.dumps(r.json(), indent=4)
+        return self._result(r)
 
 
     def account_transaction_history(self, 
@@ -375,26 +647,25 @@ class Client():
             lastPeriod=last_period,
             type=type.value
         )
-        return json.dumps(r.json(), indent=4)
+        return self._result(r)
 
     """MARKETS"""
     def market_categories(self):
-        r = self._get_with_headers(
+        return self._cached('market_categories', (), lambda: self._get_with_headers(
             CapitalComConstants.MARKET_NAVIGATION_ENDPOINT,
-        )
-        return json.dumps(r.json(), indent=4)
+            priority=Priority.HISTORY,
+        ))
 
     def market_sub_nodes(self, nodeid: str):
-        r = self._get_with_headers(
+        return self._cached('market_sub_nodes', (nodeid,), lambda: self._get_with_headers(
             CapitalComConstants.MARKET_NAVIGATION_ENDPOINT + '/' + nodeid,
-        )
-        return json.dumps(r.json(), indent=4)
+            priority=Priority.HISTORY,
+        ))
 
     def market_details(self, epics: str):
-        r = self._get_with_headers(
+        return self._cached('market_details', (epics,), lambda: self._get_with_headers(
             CapitalComConstants.MARKET_INFORMATION_ENDPOINT + '?epics=' + epics,
-        )
-        return json.dumps(r.json(), indent=4)
+        ))
 
     """PRICES"""
     def prices(self, epic, granularity, start_date, end_date, max):
@@ -404,24 +675,26 @@ class Client():
             '&max=' + str(max) +
             '&from=' + start_date +
             '&to=' + end_date,
+            priority=Priority.HISTORY,
         )
-        return json.dumps(r.json(), indent=4)
+        return self._result(r)
 
     """POSITIONS"""
     def position_order_confirmation(self, deal_reference: str):
         r = self._get_with_headers(
             CapitalComConstants.ACCOUNT_ORDER_CONFIRMATION + '/' + deal_reference,
+            priority=Priority.ORDER,
         )
-        return json.dumps(r.json(), indent=4)
+        return self._result(r)
 
     def all_positions(self):   
         r = self._get_with_headers(
             CapitalComConstants.POSITIONS_ENDPOINT,
         )
-        if r.status_code != 200:
+        if r.status_code != 200 and self.response_mode is ResponseMode.TEXT:
             print(r.reason)
         else:
-            return json.dumps(r.json(), indent=4)
+            return self._result(r)
 
     def place_the_position(self, 
                             direction: DirectionType, 
@@ -451,14 +724,14 @@ class Client():
             profitDistance=profit_distance,
             profitAmount=profit_amount
         )
-        return json.dumps(r.json(), indent=4)
+        return self._result(r)
 
 
     def check_position(self, dealid: str):
         r = self._get_with_headers(
             CapitalComConstants.POSITIONS_ENDPOINT + '/' + dealid,
         )
-        return json.dumps(r.json(), indent=4)
+        return self._result(r)
 
 
     def update_the_position(self, 
@@ -483,21 +756,21 @@ class Client():
             profitDistance=profit_distance,
             profitAmount=profit_amount
         )
-        return json.dumps(r.json(), indent=4)
+        return self._result(r)
 
     
     def close_position(self, dealid): 
         r = self._delete(
             CapitalComConstants.POSITIONS_ENDPOINT + '/' + dealid,
         )
-        return json.dumps(r.json(), indent=4)
+        return self._result(r)
 
     """ORDER"""
     def all_orders(self):   
         r = self._get_with_headers(
             CapitalComConstants.ORDERS_ENDPOINT,
         )
-        return json.dumps(r.json(), indent=4)
+        return self._result(r)
 
 
     def place_the_order(self, 
@@ -533,7 +806,7 @@ class Client():
             profitDistance=profit_distance,
             profitAmount=profit_amount
         )
-        return json.dumps(r.json(), indent=4)
+        return self._result(r)
 
     
     def update_the_order(self, 
@@ -562,14 +835,14 @@ class Client():
             profitAmount=profit_amount
         )
 
-        return json.dumps(r.json(), indent=4)
+        return self._result(r)
     
     
     def close_order(self, dealid): 
         r = self._delete(
             CapitalComConstants.ORDERS_ENDPOINT + '/' + dealid,
         )
-        return json.dumps(r.json(), indent=4)
+        return self._result(r)
 
     def on_message(self, ws, message):
             msg = json.loads(message)
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""Waiting for deal confirmations.
+
+A deal placed with a POST is only known to be accepted (and at which level)
+once ``/confirms/{dealReference}`` returns it, which may take a few
+milliseconds after the POST. :class:`ConfirmationWaiter` polls the confirms
+endpoint on a short, growing schedule until a deadline. A single poller
+thread keeps the schedule of all outstanding deal references: callers
+waiting for the same reference share its requests, and the references that
+are due are requested concurrently by a small pool of threads, so that one
+confirmation does not wait for the round trips of the others.
+:func:`confirm_async` does the same polling as a
+coroutine, for an :class:`capitalcom.AsyncClient`.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+from .client import CapitalComError
+
+
+# seconds between the attempts, the last value is repeated until the deadline
+DEFAULT_SCHEDULE = (0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+DEFAULT_TIMEOUT = 10.0
+
+# answers meaning that the deal is not confirmed *yet*
+_NOT_YET = ('error.not-found.dealReference', 'error.not-found.deal.reference')
+
+
+class ConfirmationTimeout(Exception):
+    """Raised when a deal is not confirmed before the deadline"""
+    def __init__(self, deal_reference, attempts):
+        self.deal_reference = deal_reference
+        self.attempts = attempts
+        super(ConfirmationTimeout, self).__init__(
+            'deal {} not confirmed after {} attempts'.format(deal_reference, attempts))
+
+
+class _Pending():
+    __slots__ = ('deal_reference', 'created', 'deadline', 'due', 'attempts',
+                 'result', 'error', 'event')
+
+    def __init__(self, deal_reference, deadline):
+        self.deal_reference = deal_reference
+        self.created = time.monotonic()
+        self.deadline = deadline
+        self.due = self.created  # first attempt right away, None while in flight
+        self.attempts = 0
+        self.result = self.error = None
+        self.event = threading.Event()
+
+
+class ConfirmationWaiter():
+    """Polls the confirmations of outstanding deals.
+
+    Parameters
+    ----------
+
+    client : capitalcom.Client (required)
+        a client in the OBJECT response mode
+
+    schedule : sequence of float (optional)
+        seconds to wait after each unsuccessful attempt
+
+    timeout : float (optional)
+        default seconds to wait for a confirmation
+
+    workers : int (optional)
+        confirmation requests sent at the same time
+    """
+
+    def __init__(self, client, schedule=DEFAULT_SCHEDULE, timeout=DEFAULT_TIMEOUT, workers=4):
+        self.client = client
+        self.schedule = tuple(schedule)
+        self.timeout = timeout
+        self.workers = workers
+        self._cond = threading.Condition()
+        self._pending = {}  # deal reference -> _Pending
+        self._thread = None
+        self._pool = None
+        self._latencies = []
+        self._attempts = 0
+        self._timeouts = 0
+
+    def wait(self, deal_reference, timeout=None):
+        """Returns the confirmation of ``deal_reference``. Raises
+        ConfirmationTimeout, or the CapitalComError of a failed request"""
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        with self._cond:
+            pending = self._pending.get(deal_reference)
+            if pending is None:
+                pending = self._pending[deal_reference] = _Pending(deal_reference, deadline)
+            else:
+                pending.deadline = max(pending.deadline, deadline)
+            if self._thread is None:
+                self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix='confirms')
+                self._thread = threading.Thread(target=self._t_poll, name='confirms')
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+
+        pending.event.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def stats(self):
+        """Confirmation latencies (seconds from ``wait`` to the confirmation)"""
+        with self._cond:
+            latencies = sorted(self._latencies)
+            stats = {'confirmed': len(latencies), 'attempts': self._attempts,
+                     'timeouts': self._timeouts, 'pending': len(self._pending)}
+        if latencies:
+            stats.update(avg=sum(latencies) / len(latencies),
+                         p50=latencies[len(latencies) // 2],
+                         p95=latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+                         max=latencies[-1])
+        return stats
+
+    def _t_poll(self):
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                due = [p for p in self._pending.values() if p.due is not None and p.due <= now]
+                if not due:
+                    waiting = [p.due for p in self._pending.values() if p.due is not None]
+                    if waiting:
+                        self._cond.wait(min(waiting) - now)
+                    else:
+                        self._cond.wait()
+                    continue
+                for pending in due:
+                    pending.due = None  # in flight, rescheduled by _attempt
+
+            # one request per due reference, however many callers wait for it
+            for pending in due:
+                self._pool.submit(self._attempt, pending)
+
+    def _attempt(self, pending):
+        error = result = None
+        try:
+            result = self.client.position_order_confirmation(pending.deal_reference)
+        except CapitalComError as e:
+            if e.status_code != 404 and e.error_code not in _NOT_YET:
+                error = e  # a definitive answer, retrying won't change it
+        except Exception:
+            pass  # network trouble, retry within the deadline
+
+        now = time.monotonic()
+        with self._cond:
+            self._attempts += 1
+            pending.attempts += 1
+            if result is None and error is None:
+                if now < pending.deadline:
+                    step = self.schedule[min(pending.attempts - 1, len(self.schedule) - 1)]
+                    pending.due = min(now + step, pending.deadline)
+                    self._cond.notify()
+                    return
+                error = ConfirmationTimeout(pending.deal_reference, pending.attempts)
+                self._timeouts += 1
+            elif result is not None:
+                self._latencies.append(now - pending.created)
+                del self._latencies[:-1000]
+
+            del self._pending[pending.deal_reference]
+            pending.result, pending.error = result, error
+        pending.event.set()
+
+
+async def confirm_async(client, deal_reference, schedule=DEFAULT_SCHEDULE, timeout=DEFAULT_TIMEOUT):
+    """Coroutine version of ConfirmationWaiter.wait for an AsyncClient in
+    the OBJECT response mode. Raises ConfirmationTimeout, or the
+    CapitalComError of a failed request"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    attempts = 0
+    while True:
+        try:
+            return await client.position_order_confirmation(deal_reference)
+        except CapitalComError as e:
+            if e.status_code != 404 and e.error_code not in _NOT_YET:
+                raise  # a definitive answer, retrying won't change it
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            pass  # network trouble, retry within the deadline
+
+        attempts += 1
+        now = loop.time()
+        if now >= deadline:
+            raise ConfirmationTimeout(deal_reference, attempts)
+        step = schedule[min(attempts - 1, len(schedule) - 1)]
+        await asyncio.sleep(min(step, deadline - now))
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""Local SQLite store of downloaded candles.
+
+Candles are stored per (epic, resolution) with both the bid and the ask
+prices of each candle, so that either side can be served from the same rows.
+Next to the candles the cache records which time ranges have been downloaded
+completely (the *coverage*). Consumers only have to request the ranges
+returned by :meth:`CandleCache.missing` from Capital.com.
+"""
+import sqlite3
+import threading
+import time
+
+from capitalcom.contrib.generic import granularity_to_time
+from capitalcom.contrib.timeconv import format_rfc3339, parse_rfc3339
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS candles (
+    epic TEXT NOT NULL,
+    resolution TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    snapshot TEXT,
+    open_bid REAL, open_ask REAL,
+    high_bid REAL, high_ask REAL,
+    low_bid REAL, low_ask REAL,
+    close_bid REAL, close_ask REAL,
+    volume REAL,
+    PRIMARY KEY (epic, resolution, ts)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS coverage (
+    epic TEXT NOT NULL,
+    resolution TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    end INTEGER NOT NULL,
+    PRIMARY KEY (epic, resolution, start)
+);
+'''
+
+
+def _ts(candle):
+    return parse_rfc3339(candle['snapshotTimeUTC'])
+
+
+class CandleCache():
+    """SQLite backed candle cache, safe to share between threads.
+
+    Parameters
+    ----------
+
+    path : string (required)
+        the database file (``':memory:'`` for a throw-away cache)
+
+    Times are epoch seconds (UTC) of the candle snapshot time. A coverage
+    interval ``(start, end)`` means every candle with ``start <= ts <= end``
+    is in the cache (markets may have been closed, so there may be none).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def coverage(self, epic, resolution):
+        """Returns the merged list of downloaded (start, end) intervals"""
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT start, end FROM coverage WHERE epic=? AND resolution=? ORDER BY start',
+                (epic, resolution)).fetchall()
+        return self._merge(rows, granularity_to_time(resolution))
+
+    @staticmethod
+    def _merge(intervals, step):
+        merged = []
+        for start, end in sorted(intervals):
+            # intervals one candle apart leave no candle uncovered
+            if merged and start <= merged[-1][1] + step:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+    def missing(self, epic, resolution, start, end):
+        """Returns the (start, end) intervals of [start, end] which are not
+        in the cache, in chronological order"""
+        gaps = []
+        step = granularity_to_time(resolution)
+        for cstart, cend in self.coverage(epic, resolution):
+            if cend < start:
+                continue
+            if cstart > end:
+                break
+            if cstart > start:
+                gaps.append((start, cstart - step))
+            start = max(start, cend + step)
+        if start <= end:
+            gaps.append((start, end))
+        return gaps
+
+    def read(self, epic, resolution, start, end):
+        """Returns the cached candles of [start, end] shaped like the
+        candles of the Capital.com prices endpoint"""
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT ts, snapshot, open_bid, open_ask, high_bid, high_ask, low_bid, low_ask, '
+                'close_bid, close_ask, volume FROM candles '
+                'WHERE epic=? AND resolution=? AND ts BETWEEN ? AND ? ORDER BY ts',
+                (epic, resolution, start, end)).fetchall()
+
+        return [{'snapshotTime': r[1],
+                 'snapshotTimeUTC': format_rfc3339(r[0]),
+                 'openPrice': {'bid': r[2], 'ask': r[3]},
+                 'highPrice': {'bid': r[4], 'ask': r[5]},
+                 'lowPrice': {'bid': r[6], 'ask': r[7]},
+                 'closePrice': {'bid': r[8], 'ask': r[9]},
+                 'lastTradedVolume': r[10]} for r in rows]
+
+    def write(self, epic, resolution, start, end, candles):
+        """Store the candles downloaded for [start, end] and mark the range
+        as covered, in a single transaction.
+
+        The candle still being formed (that of *now*) is stored but its
+        range is not marked covered, so that it is downloaded again."""
+        step = granularity_to_time(resolution)
+        end = min(end, int(time.time()) // step * step - step)
+        rows = [(epic, resolution, _ts(c), c.get('snapshotTime'),
+                 c['openPrice']['bid'], c['openPrice']['ask'],
+                 c['highPrice']['bid'], c['highPrice']['ask'],
+                 c['lowPrice']['bid'], c['lowPrice']['ask'],
+                 c['closePrice']['bid'], c['closePrice']['ask'],
+                 c.get('lastTradedVolume', 0)) for c in candles]
+
+        with self._lock:
+            try:
+                self._db.execute('BEGIN IMMEDIATE')
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO candles VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                if start <= end:
+                    self._db.execute('INSERT OR REPLACE INTO coverage VALUES (?, ?, ?, ?)',
+                                     (epic, resolution, start, end))
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+
+    def compact(self, epic=None, resolution=None):
+        """Merge the coverage intervals and reclaim unused space"""
+        with self._lock:
+            keys = self._db.execute('SELECT DISTINCT epic, resolution FROM coverage').fetchall()
+
+        for _epic, _resolution in keys:
+            if epic not in (None, _epic) or resolution not in (None, _resolution):
+                continue
+            merged = self.coverage(_epic, _resolution)
+            with self._lock:
+                self._db.execute('BEGIN IMMEDIATE')
+                self._db.execute('DELETE FROM coverage WHERE epic=? AND resolution=?', (_epic, _resolution))
+                self._db.executemany('INSERT INTO coverage VALUES (?, ?, ?, ?)',
+                                     [(_epic, _resolution, s, e) for s, e in merged])
+                self._db.execute('COMMIT')
+
+        with self._lock:
+            self._db.execute('VACUUM')
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""Columnar (NumPy) representation of candle pages.
+
+The prices endpoint returns one json object per candle. :class:`CandleBatch`
+converts a whole page at once into arrays, so that consumers handle a page
+as a single object instead of one dict per candle and don't parse every
+timestamp and price field separately.
+"""
+import numpy as np
+
+from capitalcom.contrib.timeconv import epoch_to_num_array, parse_rfc3339_array
+
+_PRICE_KEYS = ('openPrice', 'highPrice', 'lowPrice', 'closePrice')
+
+
+class CandleBatch():
+    """A page of candles as arrays.
+
+    - ``time``: float64 epoch seconds (UTC) of the candle snapshot time
+    - ``bid``: float64 array of shape (n, 4) holding open, high, low, close
+    - ``ask``: same as ``bid`` for the ask prices
+    - ``volume``: float64 last traded volume
+    """
+    __slots__ = ('time', 'bid', 'ask', 'volume')
+
+    OPEN, HIGH, LOW, CLOSE = range(4)
+
+    def __init__(self, time, bid, ask, volume):
+        self.time = time
+        self.bid = bid
+        self.ask = ask
+        self.volume = volume
+
+    @classmethod
+    def from_candles(cls, candles):
+        """Build a batch from the ``prices`` list of a prices response"""
+        n = len(candles)
+        time = parse_rfc3339_array([c['snapshotTimeUTC'] for c in candles])
+        # a single pass over the dicts, the conversion to float is done by numpy
+        values = np.array([[c[k]['bid'] for k in _PRICE_KEYS] +
+                           [c[k]['ask'] for k in _PRICE_KEYS] +
+                           [c.get('lastTradedVolume', 0)] for c in candles],
+                          dtype=np.float64).reshape(n, 9)
+        return cls(time, values[:, 0:4], values[:, 4:8], values[:, 8])
+
+    @classmethod
+    def concat(cls, batches):
+        batches = list(batches)
+        return cls(np.concatenate([b.time for b in batches]),
+                   np.concatenate([b.bid for b in batches]),
+                   np.concatenate([b.ask for b in batches]),
+                   np.concatenate([b.volume for b in batches]))
+
+    def __len__(self):
+        return len(self.time)
+
+    def __getitem__(self, index):
+        return CandleBatch(self.time[index], self.bid[index], self.ask[index], self.volume[index])
+
+    def prices(self, side='bid'):
+        """(n, 4) OHLC array of ``side``: 'bid', 'ask' or 'mid'"""
+        if side == 'mid':
+            return (self.bid + self.ask) / 2.0
+        return self.ask if side == 'ask' else self.bid
+
+    def num(self):
+        """Snapshot times as backtrader date numbers (see date2num)"""
+        return epoch_to_num_array(self.time)
+
+
+def expand_subminute(batch, step, fill='flat'):
+    """Synthesizes ``step`` second candles from a batch of MINUTE candles.
+
+    Capital.com has no history below one minute, so every minute is split
+    into ``60 // step`` sub candles, built for the whole batch at once.
+
+    Parameters
+    ----------
+
+    batch : CandleBatch (required)
+        MINUTE candles
+
+    step : int (required)
+        seconds of the synthetic candles, a divisor of 60
+
+    fill : string (optional)
+        ``'flat'`` repeats the minute candle (prices and volume) in every
+        sub candle. ``'interpolate'`` moves the price linearly from the open
+        to the close of the minute, the high and low of a sub candle being
+        those of its own open and close, and splits the volume evenly
+    """
+    if 60 % step:
+        raise ValueError("step must divide 60, got {}".format(step))
+    if fill not in ('flat', 'interpolate'):
+        raise ValueError("unknown fill {!r}".format(fill))
+
+    n = 60 // step
+    time = (batch.time[:, None] + np.arange(n) * step).ravel()
+
+    if fill == 'flat':
+        return CandleBatch(time, np.repeat(batch.bid, n, axis=0),
+                           np.repeat(batch.ask, n, axis=0), np.repeat(batch.volume, n))
+
+    # fractions of the way from open to close at the start and end of each sub candle
+    frac = np.arange(n + 1) / float(n)
+
+    def interpolate(ohlc):
+        first, last = ohlc[:, CandleBatch.OPEN], ohlc[:, CandleBatch.CLOSE]
+        levels = first[:, None] + (last - first)[:, None] * frac
+        opens, closes = levels[:, :-1].ravel(), levels[:, 1:].ravel()
+        return np.column_stack((opens, np.maximum(opens, closes),
+                                np.minimum(opens, closes), closes))
+
+    return CandleBatch(time, interpolate(batch.bid), interpolate(batch.ask),
+                       np.repeat(batch.volume / n, n))
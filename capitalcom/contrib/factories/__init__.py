@@ -1,5 +1,9 @@
-from .history import EpicCandlesFactory
+from .history import (EpicCandlesFactory, ParallelEpicCandlesFactory, CachedEpicCandlesFactory,
+                      AsyncEpicCandlesFactory)
 
 __all__ = (
     'EpicCandlesFactory',
+    'ParallelEpicCandlesFactory',
+    'CachedEpicCandlesFactory',
+    'AsyncEpicCandlesFactory',
 )
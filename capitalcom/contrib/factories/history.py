@@ -1,11 +1,16 @@
 # -*- coding: utf-8 -*-
 
-from datetime import datetime
-import calendar
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import itertools
+import json
 import logging
+import time
 
 import capitalcom.client as prices
-from capitalcom.contrib.generic import granularity_to_time, secs2time
+from capitalcom.contrib.generic import granularity_to_time
+from capitalcom.contrib.timeconv import format_rfc3339, parse_rfc3339
 
 
 logger = logging.getLogger(__name__)
@@ -38,63 +43,286 @@ def EpicCandlesFactory(CAPI, epic, params=None):
 
     params: params (optional)
         the parameters to specify the historical range, and the timeframe
-        If no params are specified, just a single InstrumentsCandles request
-        will be generated acting the same as if you had just created it
-        directly.
+        If no *from* is specified, just a single request for the last *max*
+        candles will be generated.
 
     """
-    RFC3339 = "%Y-%m-%dT%H:%M:%S"
-    # if not specified use the default of 'MINUTE'
-    gs = granularity_to_time(params.get('resolution', 'MINUTE'))
+    resolution, _count, windows = _plan_windows(params)
+
+    # generate EpicCandles requests for all 'bars', each request
+    # requesting max. count records
+    for _epoch_from, to in windows:
+        page = _fetch(CAPI, epic, resolution, _epoch_from, to, _count)
+        if page is not None:
+            yield page
+
+
+def ParallelEpicCandlesFactory(CAPI, epic, params=None, workers=4,
+                               progress=None, cancel=None):
+    """ParallelEpicCandlesFactory - concurrent version of EpicCandlesFactory.
+
+    All time windows of the range are planned up front and requested over a
+    pool of *workers* threads. The requests go through the rate limiter of
+    the client (at history priority) like any other request. Pages are
+    yielded in chronological order and the candle shared by two consecutive
+    windows is only delivered once. Only a bounded number of pages is
+    requested ahead of the consumer.
+
+    Parameters
+    ----------
+
+    epic : string (required)
+        the epic to retrieve the history for
+
+    params: params (optional)
+        as for EpicCandlesFactory
+
+    workers : int (optional)
+        number of concurrent requests
+
+    progress : callable (optional)
+        called as ``progress(done, total)`` after each window
+
+    cancel : threading.Event (optional)
+        when set, no further windows are requested and the generator ends
+
+    Pages are yielded decoded (dict) whatever the response mode of *CAPI*.
+    """
+    resolution, _count, windows = _plan_windows(params)
+    total = len(windows)
+    windows = iter(windows)
+    done = 0
+    lastdt = ''
+    pending = collections.deque()
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+
+    def submit():
+        for _epoch_from, to in itertools.islice(windows, 1):
+            pending.append(executor.submit(_fetch, CAPI, epic, resolution, _epoch_from, to, _count))
+
+    try:
+        for _ in range(2 * workers):
+            submit()
+
+        while pending:
+            if cancel is not None and cancel.is_set():
+                return
+
+            page = pending.popleft().result()
+            submit()
+            done += 1
+            if progress is not None:
+                progress(done, total)
+            if page is None:
+                continue
+
+            page = _page_body(page)
+            candles = [c for c in page.get('prices', []) if c['snapshotTimeUTC'] > lastdt]
+            if not candles:
+                continue
+            lastdt = candles[-1]['snapshotTimeUTC']
+            page['prices'] = candles
+            yield page
+
+    finally:
+        for f in pending:
+            f.cancel()
+        executor.shutdown(wait=False)
+
+
+async def AsyncEpicCandlesFactory(client, epic, params=None, workers=4, cancel=None):
+    """AsyncEpicCandlesFactory - asyncio version of ParallelEpicCandlesFactory.
+
+    An async generator requesting the windows of the range with a
+    capitalcom.AsyncClient, *workers* requests at a time on the running
+    event loop. Pages are yielded decoded, in chronological order and
+    without the candle shared by two consecutive windows.
+
+    Parameters
+    ----------
+
+    client : capitalcom.AsyncClient (required)
+        the client to request the prices with
+
+    epic : string (required)
+        the epic to retrieve the history for
 
-    _from = None
-    _epoch_from = None
-    if 'from' in params:
-        _from = datetime.strptime(params.get('from'), RFC3339)
-        _epoch_from = int(calendar.timegm(_from.timetuple()))
+    params: params (optional)
+        as for EpicCandlesFactory
+
+    workers : int (optional)
+        number of concurrent requests
+
+    cancel : threading.Event (optional)
+        when set, no further windows are requested and the generator ends
+    """
+    resolution, _count, windows = _plan_windows(params)
+    windows = iter(windows)
+    lastdt = ''
+    pending = collections.deque()
+
+    def submit():
+        for _epoch_from, to in itertools.islice(windows, 1):
+            pending.append(asyncio.ensure_future(
+                _afetch(client, epic, resolution, _epoch_from, to, _count)))
+
+    try:
+        for _ in range(workers):
+            submit()
+
+        while pending:
+            if cancel is not None and cancel.is_set():
+                return
+
+            page = await pending.popleft()
+            submit()
+            if page is None:
+                continue
+
+            page = _page_body(page)
+            candles = [c for c in page.get('prices', []) if c['snapshotTimeUTC'] > lastdt]
+            if not candles:
+                continue
+            lastdt = candles[-1]['snapshotTimeUTC']
+            page['prices'] = candles
+            yield page
+
+    finally:
+        for f in pending:
+            f.cancel()
+
+
+def CachedEpicCandlesFactory(CAPI, epic, params, cache, factory=None, **kwargs):
+    """CachedEpicCandlesFactory - serve history from a local candle cache.
+
+    The range of *params* is split in the parts already in *cache* (a
+    capitalcom.contrib.candlecache.CandleCache) and the missing ones. Cached
+    parts are read locally, only the missing ones are downloaded with
+    *factory* (ParallelEpicCandlesFactory by default, called with
+    *kwargs*). Each downloaded range is written back to the cache in one
+    transaction once it is complete.
+
+    Pages are yielded decoded and in chronological order. Without *from*
+    in *params* the cache is bypassed.
+    """
+    factory = factory or ParallelEpicCandlesFactory
+    params = params or {}
+    if params.get('from') is None:
+        for page in factory(CAPI, epic, params, **kwargs):
+            yield _page_body(page)
+        return
+
+    resolution = params.get('resolution', 'MINUTE')
+    _count = params.get('max', DEFAULT_BATCH)
+    _, _, windows = _plan_windows(params)
+    start, end = windows[0][0], windows[-1][1]
 
-    _to = datetime.utcnow()
-    if 'to' in params:
-        _tmp = datetime.strptime(params.get('to'), RFC3339)
+    lastdt = ''
+    cursor = start
+    for gstart, gend in cache.missing(epic, resolution, start, end) + [(None, None)]:
+        # cached part before the gap
+        cend = end if gstart is None else gstart - 1
+        if cursor <= cend:
+            candles = cache.read(epic, resolution, cursor, cend)
+            for i in range(0, len(candles), _count):
+                page = [c for c in candles[i:i + _count] if c['snapshotTimeUTC'] > lastdt]
+                if page:
+                    lastdt = page[-1]['snapshotTimeUTC']
+                    yield {'prices': page}
+        if gstart is None:
+            break
+
+        gparams = dict(params)
+        gparams['from'] = format_rfc3339(gstart)
+        gparams['to'] = format_rfc3339(gend)
+        fetched = []
+        for page in factory(CAPI, epic, gparams, **kwargs):
+            page = _page_body(page)
+            fetched.extend(page.get('prices', []))
+            candles = [c for c in page.get('prices', []) if c['snapshotTimeUTC'] > lastdt]
+            if candles:
+                lastdt = candles[-1]['snapshotTimeUTC']
+                page['prices'] = candles
+                yield page
+
+        cancel = kwargs.get('cancel')
+        if cancel is not None and cancel.is_set():
+            return  # incomplete download, don't mark it as covered
+        cache.write(epic, resolution, gstart, gend, fetched)
+        cursor = gend + 1
+
+
+def _plan_windows(params):
+    """Returns the resolution, the max number of candles per request and the
+    list of (from, to) epoch windows covering the range of *params*"""
+    params = params or {}
+    # if not specified use the default of 'MINUTE'
+    resolution = params.get('resolution', 'MINUTE')
+    gs = granularity_to_time(resolution)
+    _count = params.get('max', DEFAULT_BATCH)
+
+    _epoch_to = int(time.time())
+    if params.get('to') is not None:
+        _tmp = parse_rfc3339(params.get('to'))
         # if specified datetime > now, we use 'now' instead
-        if _tmp > _to:
+        if _tmp > _epoch_to:
             logger.info("datetime %s is in the future, will be set to 'now'",
                         params.get('to'))
-            _to = datetime.strftime(datetime.utcnow(),self.RFC3339)
         else:
-            _to = _tmp
+            _epoch_to = _tmp
 
-    _epoch_to = int(calendar.timegm(_to.timetuple()))
+    if params.get('from') is None:
+        if params.get('to') is not None:
+            raise ValueError("'to' specified without 'from'")
+        # no range: a single request for the last 'max' candles
+        return resolution, _count, [(_epoch_to - _count * gs, _epoch_to)]
+
+    _epoch_from = parse_rfc3339(params.get('from'))
+
+    delta = _epoch_to - _epoch_from
+    nbars = delta / gs
+
+    windows = []
+    for _ in range(_count, int(((nbars//_count)+1))*_count+1, _count):
+        to = _epoch_from + _count * gs
+        if to > _epoch_to:
+            to = _epoch_to
+        windows.append((_epoch_from, to))
+        _epoch_from = to
+
+    return resolution, _count, windows
+
+
+def _fetch(CAPI, epic, resolution, _epoch_from, to, count):
+    try:
+        return CAPI.prices(epic, resolution, format_rfc3339(_epoch_from),
+                           format_rfc3339(to), count)
+    except prices.CapitalComError as e:
+        # Clients in OBJECT/RESPONSE mode raise on error pages. Part
+        # of a range not being available is not fatal: skip the page
+        if e.error_code != 'error.prices.not-found':
+            raise
+        logger.info("no prices for %s from %s to %s", epic,
+                    format_rfc3339(_epoch_from), format_rfc3339(to))
+        return None
+
+
+async def _afetch(client, epic, resolution, _epoch_from, to, count):
+    try:
+        return await client.prices(epic, resolution, format_rfc3339(_epoch_from),
+                                   format_rfc3339(to), count)
+    except prices.CapitalComError as e:
+        if e.error_code != 'error.prices.not-found':
+            raise
+        logger.info("no prices for %s from %s to %s", epic,
+                    format_rfc3339(_epoch_from), format_rfc3339(to))
+        return None
 
-    _count = params.get('max', DEFAULT_BATCH)
 
-    if 'to' in params and 'from' not in params:
-        raise ValueError("'to' specified without 'from'")
-
-    if not params or 'from' not in params:
-        yield instruments.InstrumentsCandles(instrument=instrument,
-                                             params=params)
-
-    else:
-        delta = _epoch_to - _epoch_from
-        nbars = delta / gs
-
-        cpparams = params.copy()
-        for k in ['count', 'from', 'to']:
-            if k in cpparams:
-                del cpparams[k]
-        # force includeFirst
-        cpparams.update({"includeFirst": True})
-
-        # generate EpicCandles requests for all 'bars', each request
-        # requesting max. count records
-        for _ in range(_count, int(((nbars//_count)+1))*_count+1, _count):
-            to = _epoch_from + _count * gs
-            if to > _epoch_to:
-                to = _epoch_to
-            yparams = cpparams.copy()
-            yparams.update({"from": secs2time(_epoch_from).strftime(RFC3339)})
-            yparams.update({"to": secs2time(to).strftime(RFC3339)})
-            yield CAPI.prices(epic, params['resolution'], secs2time(_epoch_from).strftime(RFC3339),
-                              secs2time(to).strftime(RFC3339), _count)
-            _epoch_from = to
+def _page_body(page):
+    if isinstance(page, prices.Response):
+        return page.body
+    if isinstance(page, str):
+        return json.loads(page)
+    return page
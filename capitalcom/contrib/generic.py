@@ -19,13 +19,17 @@ def secs2time(e):
 def granularity_to_time(s):
     """convert a named granularity into seconds.
 
-    get value in seconds for named granularities: MINUTE, MINUTE_5, MINUTE_15, MINUTE_30, HOUR, HOUR_4, DAY, WEEK.
+    get value in seconds for named granularities: SECONDS_5, SECONDS_15, SECONDS_30, MINUTE, MINUTE_5,
+    MINUTE_15, MINUTE_30, HOUR, HOUR_4, DAY, WEEK.
 
     >>> print(granularity_to_time("M5"))
     300
     """
 
     mfact = {
+        'SECONDS_5': 5,
+        'SECONDS_15': 15,
+        'SECONDS_30': 30,
         'MINUTE': 60,
         'MINUTE_5': 300,
         'MINUTE_15': 900,
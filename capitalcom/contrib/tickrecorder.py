@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""Append-only binary log of live quotes.
+
+Capital.com does not serve tick history, :class:`TickRecorder` keeps it
+ourselves. Every quote is appended as a fixed-width record of
+``RECORD.size`` (64) bytes::
+
+    epic          16s  utf-8, zero padded (longer epics are not recorded)
+    timestamp     q    server time, epoch milliseconds
+    received      q    local receive time, epoch microseconds
+    bid, ofr      d d
+    bidQty, ofrQty d d
+
+to a segment file per hour (``ticks-YYYYMMDD-HH.bin``) or per day
+(``ticks-YYYYMMDD.bin``) of the receive time (UTC). Each time a segment is
+closed a line is appended to ``index.jsonl`` with its number of records,
+its first and last server timestamps and its epics, which lets
+:func:`read_ticks` skip the segments that cannot match.
+
+``record`` only appends to an in-memory buffer, a background thread packs
+and writes the buffered quotes in batches and fsyncs the segment every
+``fsync_interval`` seconds, so the quote path never waits for the disk.
+"""
+import collections
+import json
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+
+RECORD = struct.Struct('<16sqqdddd')
+
+TICK_DTYPE = np.dtype([('epic', 'S16'), ('timestamp', '<i8'), ('received', '<i8'),
+                       ('bid', '<f8'), ('ofr', '<f8'), ('bidQty', '<f8'), ('ofrQty', '<f8')])
+
+INDEX = 'index.jsonl'
+
+_SEGMENTS = {'hour': ('ticks-%Y%m%d-%H.bin', 3600), 'day': ('ticks-%Y%m%d.bin', 86400)}
+
+
+class TickRecorder():
+    """Records quote payloads to segment files.
+
+    Parameters
+    ----------
+
+    path : string (required)
+        directory of the segments and the index (created if needed)
+
+    segment : string (optional)
+        ``hour`` or ``day``, the period covered by a segment file
+
+    flush_interval : float (optional)
+        seconds between the writes of the buffered quotes
+
+    fsync_interval : float (optional)
+        seconds between two fsync of the segment being written
+
+    maxsize : int (optional)
+        quotes kept in memory when the disk falls behind, further quotes
+        are dropped (and counted)
+    """
+
+    def __init__(self, path, segment='hour', flush_interval=0.5, fsync_interval=5.0,
+                 maxsize=1000000):
+        if segment not in _SEGMENTS:
+            raise ValueError('unknown segment period {!r}'.format(segment))
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.segment = segment
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.maxsize = maxsize
+        self._buf = collections.deque()  # (quote, received)
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._file = None  # segment being written
+        self._name = None
+        self._period = None
+        self._seg = None  # index entry of the open segment
+        self._synced = time.monotonic()
+        self.recorded = self.dropped = self.errors = self.rejected = 0
+        self._long_epics = set()  # epics not fitting the record, reported once
+        self._thread = threading.Thread(target=self._t_write, name='tick-recorder')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def record(self, quote, received=None):
+        """Queues a quote payload (``epic``, ``timestamp``, ``bid``, ``ofr``
+        and optionally ``bidQty`` / ``ofrQty``) for writing"""
+        if self._closed:
+            return
+        if len(self._buf) >= self.maxsize:
+            self.dropped += 1
+            return
+        self._buf.append((quote, time.time() if received is None else received))
+
+    def close(self):
+        """Writes what is buffered, closes the segment and ends the writer"""
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+
+    def stats(self):
+        return {'recorded': self.recorded, 'dropped': self.dropped, 'errors': self.errors,
+                'rejected': self.rejected, 'buffered': len(self._buf), 'segment': self._name}
+
+    def _t_write(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            closing = self._closed
+            try:
+                self._write_batch()
+            except (OSError, ValueError) as e:
+                self.errors += 1
+                print('Tick recorder - write failed: ' + str(e))
+            if closing:
+                break
+        self._close_segment()
+
+    def _write_batch(self):
+        buf = self._buf
+        chunk = []
+        for _ in range(len(buf)):  # what is there now, more may come
+            quote, received = buf.popleft()
+            epic = quote['epic'].encode('utf-8')
+            if len(epic) > 16:
+                self._reject(quote['epic'])
+                continue
+            period = int(received) // _SEGMENTS[self.segment][1]
+            if period != self._period:
+                self._flush(chunk)
+                chunk = []
+                self._open_segment(period, received)
+
+            ms = int(quote['timestamp'])
+            chunk.append(RECORD.pack(epic, ms, int(received * 1e6),
+                                     float(quote['bid']), float(quote['ofr']),
+                                     float(quote.get('bidQty') or 0.0),
+                                     float(quote.get('ofrQty') or 0.0)))
+            seg = self._seg
+            seg['records'] += 1
+            seg['first'] = ms if seg['first'] is None else min(seg['first'], ms)
+            seg['last'] = ms if seg['last'] is None else max(seg['last'], ms)
+            seg['epics'].add(quote['epic'])
+
+        self._flush(chunk)
+        if self._file is not None and time.monotonic() - self._synced >= self.fsync_interval:
+            os.fsync(self._file.fileno())
+            self._synced = time.monotonic()
+
+    def _reject(self, epic):
+        # cut to 16 bytes the epic would not be found by read_ticks
+        self.rejected += 1
+        if epic not in self._long_epics:
+            self._long_epics.add(epic)
+            print('Tick recorder - epic longer than 16 bytes not recorded: ' + epic)
+
+    def _flush(self, chunk):
+        if chunk:
+            self._file.write(b''.join(chunk))
+            self._file.flush()
+            self.recorded += len(chunk)
+
+    def _open_segment(self, period, received):
+        self._close_segment()
+        self._name = time.strftime(_SEGMENTS[self.segment][0], time.gmtime(received))
+        self._period = period
+        path = os.path.join(self.path, self._name)
+        self._file = open(path, 'ab')
+        tail = self._file.tell() % RECORD.size
+        if tail:
+            self._file.truncate(self._file.tell() - tail)  # partial record of a crash
+        self._seg = {'segment': self._name, 'offset': self._file.tell(), 'records': 0,
+                     'first': None, 'last': None, 'epics': set()}
+
+    def _close_segment(self):
+        if self._file is None:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+        seg = self._seg
+        if seg['records']:
+            seg['epics'] = sorted(seg['epics'])
+            with open(os.path.join(self.path, INDEX), 'ab+') as f:
+                if f.tell():
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        f.write(b'\n')  # after the partial line of a crash
+                f.write(json.dumps(seg).encode('utf-8') + b'\n')
+
+
+def read_index(path):
+    """Index entries of the segments of ``path``, grouped by segment name"""
+    entries = collections.defaultdict(list)
+    try:
+        with open(os.path.join(path, INDEX)) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # partial line of a crash
+                entries[entry['segment']].append(entry)
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def read_ticks(path, epic=None, start=None, end=None):
+    """Recorded ticks as a structured NumPy array of ``TICK_DTYPE``, in
+    receive order.
+
+    Parameters
+    ----------
+
+    path : string (required)
+        the directory of a TickRecorder
+
+    epic : string (optional)
+        only the ticks of this epic
+
+    start, end : float (optional)
+        only the ticks with ``start <= timestamp <= end`` (server time,
+        epoch seconds)
+    """
+    index = read_index(path)
+    lo = None if start is None else int(start * 1000)
+    hi = None if end is None else int(end * 1000)
+
+    parts = []
+    for name in sorted(os.listdir(path)):
+        if not (name.startswith('ticks-') and name.endswith('.bin')):
+            continue
+        fname = os.path.join(path, name)
+        count = os.path.getsize(fname) // RECORD.size
+        entries = index.get(name, [])
+        if sum(e['records'] for e in entries) == count and entries:
+            # the index describes the whole segment
+            if epic is not None and not any(epic in e['epics'] for e in entries):
+                continue
+            if lo is not None and max(e['last'] for e in entries) < lo:
+                continue
+            if hi is not None and min(e['first'] for e in entries) > hi:
+                continue
+
+        ticks = np.fromfile(fname, dtype=TICK_DTYPE, count=count)
+        mask = np.ones(len(ticks), dtype=bool)
+        if epic is not None:
+            mask &= ticks['epic'] == epic.encode('utf-8')
+        if lo is not None:
+            mask &= ticks['timestamp'] >= lo
+        if hi is not None:
+            mask &= ticks['timestamp'] <= hi
+        parts.append(ticks[mask])
+
+    if not parts:
+        return np.empty(0, dtype=TICK_DTYPE)
+    return np.concatenate(parts)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""Fast conversions between Capital.com timestamps and backtrader dates.
+
+Capital.com uses RFC3339 strings without timezone (``2023-05-01T10:15:00``,
+UTC for the ``snapshotTimeUTC`` fields) in the REST API and epoch
+milliseconds in the streaming quotes. backtrader stores dates as float
+day numbers (see ``backtrader.date2num``). Going through ``strptime`` and
+``datetime`` objects for every candle or tick is slow. The functions below
+do the conversions arithmetically, and the ``*_array`` variants do them
+with NumPy for whole batches.
+
+All epoch values are seconds (UTC) unless the name says ``ms``.
+"""
+import calendar
+import time
+
+import numpy as np
+
+
+RFC3339 = "%Y-%m-%dT%H:%M:%S"
+
+# backtrader's date2num of 1970-01-01 (days since 0001-01-01, plus 1)
+EPOCH_NUM = 719163.0
+SECS_PER_DAY = 86400.0
+
+_days_cache = {}  # 'YYYY-MM-DD' -> days since the epoch, dates repeat a lot
+
+
+def _days_from_civil(y, m, d):
+    """Days since 1970-01-01 of a proleptic Gregorian date"""
+    y -= m <= 2
+    era = (y if y >= 0 else y - 399) // 400
+    yoe = y - era * 400
+    doy = (153 * (m + (-3 if m > 2 else 9)) + 2) // 5 + d - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+def parse_rfc3339(s):
+    """Epoch seconds of ``YYYY-MM-DDTHH:MM:SS`` (fractions and a timezone
+    suffix are ignored)"""
+    if s[10:11] != 'T' or s[4:5] != '-' or s[7:8] != '-':
+        # not zero padded (e.g. 2024-2-5T08:00:00), take the slow path
+        return calendar.timegm(time.strptime(s[:19], RFC3339))
+    date = s[:10]
+    days = _days_cache.get(date)
+    if days is None:
+        days = _days_cache[date] = _days_from_civil(int(s[0:4]), int(s[5:7]), int(s[8:10]))
+    return days * 86400 + int(s[11:13]) * 3600 + int(s[14:16]) * 60 + int(s[17:19])
+
+
+def format_rfc3339(secs):
+    """``YYYY-MM-DDTHH:MM:SS`` of epoch seconds"""
+    return time.strftime(RFC3339, time.gmtime(secs))
+
+
+def epoch_to_num(secs):
+    """backtrader date number of epoch seconds"""
+    return secs / SECS_PER_DAY + EPOCH_NUM
+
+
+def epoch_ms_to_num(ms):
+    """backtrader date number of epoch milliseconds (streaming quotes)"""
+    return ms / 86400000.0 + EPOCH_NUM
+
+
+def num_to_epoch(num):
+    """Epoch seconds of a backtrader date number"""
+    return (num - EPOCH_NUM) * SECS_PER_DAY
+
+
+def rfc3339_to_num(s):
+    """backtrader date number of an RFC3339 string"""
+    return parse_rfc3339(s) / SECS_PER_DAY + EPOCH_NUM
+
+
+def parse_rfc3339_array(strings):
+    """Epoch seconds (float64 array) of a sequence of RFC3339 strings"""
+    return np.array(strings, dtype='datetime64[s]').astype(np.float64)
+
+
+def format_rfc3339_array(secs):
+    """RFC3339 strings (unicode array) of an array of epoch seconds"""
+    return np.datetime_as_string(np.asarray(secs).astype('datetime64[s]'), unit='s')
+
+
+def epoch_to_num_array(secs):
+    """backtrader date numbers of an array of epoch seconds"""
+    return np.asarray(secs, dtype=np.float64) / SECS_PER_DAY + EPOCH_NUM
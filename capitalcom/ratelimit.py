@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""Token bucket rate limiter with request priorities.
+
+Capital.com allows about 10 requests per second per user. All clients of the
+process share one :class:`RateLimiter` (see :func:`get_default_limiter`), so
+the store threads, history downloads and scripts cannot exceed the limit
+together.
+
+Waiting requests are served by priority first and arrival order second. Order
+placement/close always goes ahead of history paging and account polling.
+Threads wait with ``acquire``, coroutines with ``acquire_async``, in the same
+queue.
+"""
+import asyncio
+import collections
+from enum import IntEnum
+import heapq
+import itertools
+import threading
+import time
+
+
+class Priority(IntEnum):
+    # lower values are served first
+    ORDER = 0      # order / position placement, close, deal confirmation
+    SESSION = 1    # login, session switch, keep alive pings
+    ACCOUNT = 2    # account, positions and working orders polling
+    HISTORY = 3    # price history paging and market navigation
+
+
+class RateLimiter():
+    """Token bucket shared by all threads of the process.
+
+    Parameters
+    ----------
+
+    rate : float (optional)
+        tokens (requests) added per second. ``None`` disables the limiter
+
+    burst : float (optional)
+        maximum number of tokens in the bucket, i.e. requests that may be
+        sent back to back after an idle period
+    """
+
+    def __init__(self, rate=10.0, burst=10.0):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._cond = threading.Condition(threading.Lock())
+        self._waiters = []  # heap of (priority, seq)
+        self._futures = dict()  # (priority, seq) -> (loop, future) of the coroutines waiting
+        self._seq = itertools.count()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self._stats = {p: {'requests': 0, 'wait_time': 0.0, 'max_wait': 0.0} for p in Priority}
+        self.throttled = 0
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self, priority=Priority.HISTORY):
+        """Block until a request of ``priority`` may be sent. Returns the wait
+        time in seconds"""
+        if self.rate is None:
+            return 0.0
+
+        priority = Priority(priority)
+        start = time.monotonic()
+        with self._cond:
+            entry = (int(priority), next(self._seq))
+            heapq.heappush(self._waiters, entry)
+            while True:
+                self._refill(time.monotonic())
+                if self._waiters[0] == entry:
+                    if self._tokens >= 1.0:
+                        return self._grant(priority, start)
+                    self._cond.wait((1.0 - self._tokens) / self.rate)
+                else:
+                    self._cond.wait()
+
+    async def acquire_async(self, priority=Priority.HISTORY):
+        """Coroutine version of ``acquire``, waits on the event loop without
+        holding a thread. A cancelled waiter leaves the queue without taking
+        a token"""
+        if self.rate is None:
+            return 0.0
+
+        priority = Priority(priority)
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        with self._cond:
+            entry = (int(priority), next(self._seq))
+            heapq.heappush(self._waiters, entry)
+        try:
+            while True:
+                with self._cond:
+                    self._refill(time.monotonic())
+                    timeout = None  # till woken by a change of the queue
+                    if self._waiters[0] == entry:
+                        if self._tokens >= 1.0:
+                            return self._grant(priority, start)
+                        timeout = (1.0 - self._tokens) / self.rate
+                    fut = loop.create_future()
+                    self._futures[entry] = (loop, fut)
+                try:
+                    await asyncio.wait_for(fut, timeout)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            with self._cond:
+                if entry in self._waiters:
+                    self._waiters.remove(entry)
+                    heapq.heapify(self._waiters)
+                    self._wake()
+            raise
+        finally:
+            with self._cond:
+                self._futures.pop(entry, None)
+
+    def _grant(self, priority, start):
+        # under the lock, the first waiter takes a token
+        heapq.heappop(self._waiters)
+        self._tokens -= 1.0
+        self._wake()  # let the next one in line re-evaluate
+
+        waited = time.monotonic() - start
+        stats = self._stats[priority]
+        stats['requests'] += 1
+        stats['wait_time'] += waited
+        stats['max_wait'] = max(stats['max_wait'], waited)
+        return waited
+
+    def _wake(self):
+        self._cond.notify_all()
+        for loop, fut in self._futures.values():
+            loop.call_soon_threadsafe(_resolve, fut)
+
+    def penalize(self, seconds):
+        """The server answered 429: hold back all requests for ``seconds``"""
+        if self.rate is None:
+            return
+
+        with self._cond:
+            self._refill(time.monotonic())
+            self._tokens = min(self._tokens, 0.0) - seconds * self.rate
+            self.throttled += 1
+            self._wake()
+
+    def stats(self):
+        """
+        Returns the queueing delay per priority
+        {
+        "ORDER": {"requests": 12, "wait_time": 0.05, "max_wait": 0.02, "avg_wait": 0.004, "waiting": 0},
+        ...
+        "throttled": 0
+        }
+        """
+        with self._cond:
+            waiting = collections.Counter(p for p, _ in self._waiters)
+            result = {}
+            for p, stats in self._stats.items():
+                s = dict(stats)
+                s['avg_wait'] = s['wait_time'] / s['requests'] if s['requests'] else 0.0
+                s['waiting'] = waiting.get(int(p), 0)
+                result[p.name] = s
+            result['throttled'] = self.throttled
+
+        return result
+
+
+def _resolve(fut):
+    if not fut.done():
+        fut.set_result(None)
+
+
+_default_limiter = None
+_default_lock = threading.Lock()
+
+
+def get_default_limiter():
+    """Returns the process wide limiter shared by all clients"""
+    global _default_limiter
+    with _default_lock:
+        if _default_limiter is None:
+            _default_limiter = RateLimiter()
+        return _default_limiter
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""Persisted Capital.com session tokens.
+
+Opening a session costs a request for the encryption key, an RSA encryption
+of the password and the session POST, which also counts against the
+(stricter) login rate limit. :class:`SessionCache` stores the CST and
+X-SECURITY-TOKEN of an open session together with the time it was last
+used, so that a restarted process or a reconnecting store can validate them
+with a single ping and only log in again when they are no longer accepted.
+
+The file is rewritten when the tokens change. A successful request only
+updates the time the session was used, at most every ``ttl / 2`` seconds.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# Capital.com closes a session after 10 minutes without requests
+SESSION_TTL = 600
+
+
+class SessionCache():
+    """Session tokens per environment and login, kept in a json file.
+
+    Parameters
+    ----------
+
+    path : string (required)
+        the json file. It holds live credentials and is created readable by
+        the owner only
+
+    ttl : int (optional)
+        seconds after the last successful request a session is considered
+        expired
+    """
+
+    def __init__(self, path, ttl=SESSION_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._touched = {}  # key -> time its use was last written
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self, sessions):
+        tmp = self.path + '.tmp'
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as file:
+            json.dump(sessions, file)
+        os.replace(tmp, self.path)
+
+    def load(self, key):
+        """Returns the stored session (dict with ``cst``,
+        ``x_security_token``, ``account_id`` and ``used``) if not expired"""
+        with self._lock:
+            session = self._read().get(key)
+        if session is None or session.get('used', 0) + self.ttl < time.time():
+            return None
+        return session
+
+    def save(self, key, cst, x_security_token, account_id=None):
+        with self._lock:
+            sessions = self._read()
+            sessions[key] = {'cst': cst,
+                             'x_security_token': x_security_token,
+                             'account_id': account_id,
+                             'used': time.time()}
+            self._touched[key] = time.time()
+            try:
+                self._write(sessions)
+            except OSError as e:
+                logger.warning("session cache %s not written: %s", self.path, e)
+
+    def touch(self, key):
+        """The session of ``key`` was used now. Written if the stored time
+        is more than ``ttl / 2`` old"""
+        now = time.time()
+        with self._lock:
+            if now - self._touched.get(key, 0) < self.ttl / 2:
+                return
+            sessions = self._read()
+            if key not in sessions:
+                return
+            sessions[key]['used'] = now
+            self._touched[key] = now
+            try:
+                self._write(sessions)
+            except OSError as e:
+                logger.warning("session cache %s not written: %s", self.path, e)
+
+    def discard(self, key):
+        with self._lock:
+            sessions = self._read()
+            self._touched.pop(key, None)
+            if sessions.pop(key, None) is not None:
+                self._write(sessions)
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""Pooled keep-alive HTTP transport for the Capital.com REST client.
+
+All REST calls of a :class:`capitalcom.client.Client` go through a single
+:class:`Transport`. The transport owns one ``requests.Session`` with an adapter
+that keeps persistent connections in a bounded pool, so consecutive requests
+(pings, orders, history pages) reuse an already established TCP+TLS
+connection instead of doing a new handshake every time.
+
+The session and its pool may be shared by all worker threads of the store.
+"""
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+
+DEFAULT_POOL_CONNECTIONS = 4
+DEFAULT_POOL_MAXSIZE = 10
+
+
+class PoolStats():
+    """Thread safe counters describing the usage of the connection pool.
+
+    - ``requests``: number of connections taken from the pool
+    - ``hits``: requests served by an already open (kept alive) connection
+    - ``new_connections``: connections which had to be created
+    - ``wait_time``: accumulated time (secs) spent waiting for a free
+      connection
+    - ``max_wait``: longest single wait (secs) for a free connection
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.new_connections = 0
+            self.wait_time = 0.0
+            self.max_wait = 0.0
+
+    @property
+    def hits(self):
+        return max(self.requests - self.new_connections, 0)
+
+    def _add_request(self, waited):
+        with self._lock:
+            self.requests += 1
+            self.wait_time += waited
+            if waited > self.max_wait:
+                self.max_wait = waited
+
+    def _add_new_connection(self):
+        with self._lock:
+            self.new_connections += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'hits': self.hits,
+                'new_connections': self.new_connections,
+                'wait_time': self.wait_time,
+                'max_wait': self.max_wait,
+            }
+
+
+def _counting_pool(base, stats):
+    """Return a subclass of the urllib3 pool ``base`` reporting to ``stats``"""
+
+    class CountingPool(base):
+        def _new_conn(self):
+            stats._add_new_connection()
+            conn = super(CountingPool, self)._new_conn()
+            conn._counted = True
+            return conn
+
+        def _get_conn(self, timeout=None):
+            start = time.monotonic()
+            conn = super(CountingPool, self)._get_conn(timeout=timeout)
+            # _new_conn only builds the connection object, the handshake is
+            # done lazily when the request is sent
+            stats._add_request(time.monotonic() - start)
+            if getattr(conn, '_counted', False):
+                conn._counted = False
+            elif conn.sock is None:
+                # a kept connection found dropped (closed by _get_conn) or
+                # closed after an error reconnects without _new_conn
+                stats._add_new_connection()
+            return conn
+
+    CountingPool.__name__ = 'Counting' + base.__name__
+    return CountingPool
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """requests adapter whose connection pools report to a :class:`PoolStats`"""
+
+    def __init__(self, stats, **kwargs):
+        self.stats = stats
+        super(PooledHTTPAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(PooledHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _counting_pool(HTTPConnectionPool, self.stats),
+            'https': _counting_pool(HTTPSConnectionPool, self.stats),
+        }
+
+
+class Transport():
+    """Keep-alive transport shared by all REST calls of a client.
+
+    Parameters
+    ----------
+
+    pool_connections : int (optional)
+        number of host pools to cache (one per host, Capital.com uses 1 or 2)
+
+    pool_maxsize : int (optional)
+        maximum number of persistent connections kept per host. Should be at
+        least the number of threads issuing requests concurrently
+
+    pool_block : bool (optional)
+        if ``True`` (default) a thread waits for a free connection when all
+        ``pool_maxsize`` connections are in use, instead of opening an extra
+        throw-away connection. The waiting time is reported in the stats
+
+    timeout : float or tuple (optional)
+        default timeout passed to ``requests`` for every call
+    """
+
+    def __init__(self, pool_connections=DEFAULT_POOL_CONNECTIONS,
+                 pool_maxsize=DEFAULT_POOL_MAXSIZE, pool_block=True,
+                 timeout=None):
+        self.timeout = timeout
+        self.stats = PoolStats()
+        self.adapter = PooledHTTPAdapter(self.stats,
+                                         pool_connections=pool_connections,
+                                         pool_maxsize=pool_maxsize,
+                                         pool_block=pool_block)
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+    def request(self, method, url, **kwargs):
+        if self.timeout is not None:
+            kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def close(self):
+        self.session.close()
@@ -37,19 +37,24 @@ if __name__ == '__main__':
     broker = capitalcomstore.getbroker()
 
     datakwargs = dict(
-        timeframe=bt.TimeFrame.Ticks,
-        compression=0,
         tz='UTC',
         backfill=True,
         backfill_start=True,
+        livebars=True,  # the feeds build the live bars from the ticks
     )
 
+    # both datas share the websocket subscription and the tick aggregation
     data = capitalcomstore.getdata(dataname="BTCUSD",
+                                   timeframe=bt.TimeFrame.Seconds, compression=15,
                                    fromdate=datetime(2024, 2, 9,9,0),
                                     **datakwargs)
+    data2 = capitalcomstore.getdata(dataname="BTCUSD",
+                                    timeframe=bt.TimeFrame.Minutes, compression=1,
+                                    fromdate=datetime(2024, 2, 9,9,0),
+                                    **datakwargs)
 
-    cerebro.resampledata(data, timeframe=bt.TimeFrame.Seconds, compression=15)
-    cerebro.resampledata(data, timeframe=bt.TimeFrame.Minutes, compression=2)
+    cerebro.adddata(data)
+    cerebro.resampledata(data2, timeframe=bt.TimeFrame.Minutes, compression=2)
     cerebro.setbroker(broker)
     # Set commission
 